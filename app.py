@@ -0,0 +1,809 @@
+from startup import mark as mark_startup, profile_initialized, profile_first_update  # первым: отсчет для --profile-startup
+import sqlite3
+import logging
+import os
+import re
+import html
+import asyncio
+# import httpx # Не нужен
+from io import BytesIO
+from contextlib import nullcontext
+from dotenv import load_dotenv
+# --- ДОБАВЛЕНО для расчета даты по сроку ---
+from datetime import datetime, timedelta, time # Добавляем time
+from dateutil.relativedelta import relativedelta # Используем для корректного добавления месяцев
+# -----------------------------------------
+
+from telegram import (
+    Update,
+    ReplyKeyboardMarkup,
+    KeyboardButton,
+    InputFile,
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    ReplyKeyboardRemove,
+    InlineQueryResultsButton,
+    constants
+)
+from telegram.error import TelegramError, TimedOut, BadRequest
+from telegram.request import BaseRequest
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    MessageHandler,
+    CallbackQueryHandler,
+    InlineQueryHandler,
+    TypeHandler,
+    ContextTypes,
+    filters,
+)
+
+# .env читаем до импорта модулей бота: их настройки берутся из окружения при импорте
+load_dotenv()
+
+from database import (
+    save_client,
+    delete_client_from_db,
+    update_client_status,
+    extend_client,
+    get_client_by_name,
+    get_all_clients,
+    get_expiring_clients,
+    search_clients,
+    run_db,
+    close_all_connections,
+)
+from wg_api import (
+    get_client_directory,
+    create_client_api,
+    delete_client_api,
+    toggle_client_status_api,
+    close_api_clients,
+    ClientExistsError,
+)
+from artifacts import get_client_artifact, remember_file_id, forget_file_id, invalidate_client_artifacts
+from qr_render import shutdown_qr_pool
+from bulk import parse_bulk_rows, provision_clients, BULK_MAX_FILE_SIZE
+from fanout import collect_all_servers, format_overview
+from client_list import build_rows, render_page, parse_list_callback, EXPIRING_DAYS
+from client_search import build_inline_results, parse_card_message, render_card, render_delete_confirm, parse_card_callback, INLINE_CACHE_TIME
+from expiry import enforce_expiry, format_expiry_summary, EXPIRY_CHECK_INTERVAL
+from metrics import InstrumentedHTTPXRequest, instrument_handler, cache_result, start_metrics_server, stop_metrics_server
+from health import with_deadline, deadline, server_state, STATE_EMOJI
+from servers import configure as configure_servers, get_servers, get_server, prepare_server, warm_up as warm_up_servers
+from reconcile import reconcile_all, format_reconcile_summary, format_reconcile_report, RECONCILE_INTERVAL
+from webhook import run as run_updates
+from persistence import SQLitePersistence
+from telemetry import collect_all as collect_telemetry, format_traffic_report, parse_window, TELEMETRY_INTERVAL
+from locks import client_lock, client_locks
+from send_queue import SendScheduler, BULK
+from export import build_export, format_export_caption, EXPORT_MAX_SIZE
+mark_startup("импорт модулей")
+
+# === ЗАГРУЗКА НАСТРОЕК ===
+TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+DB_DIR = os.getenv("DB_DIR", "db")
+# Состояние диалогов администраторов (переживает перезапуск бота)
+STATE_DB = os.getenv("STATE_DB") or os.path.join(DB_DIR, "bot_state.db")
+# Сколько апдейтов обрабатывать одновременно (1 - строго по очереди, как раньше)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+# Действия handle_message, меняющие клиента на API/в БД (выполняются под client_lock)
+CLIENT_MUTATIONS = {"create_client_duration", "create_client_custom_date", "extend_client", "delete_client"}
+
+# === СЕРВЕРЫ ===
+# Реестр серверов (servers.json или SERVER<N>_* из .env) живет в servers.py и
+# перечитывается на лету, поэтому список всегда берется через get_servers().
+configure_servers(DB_DIR)
+mark_startup("настройки и реестр серверов")
+
+# === ДОПУСКАЕМЫЕ ПОЛЬЗОВАТЕЛИ ===
+allowed_users_str = os.getenv("ALLOWED_USERS", "")
+try:
+    ALLOWED_USERS = [int(user_id.strip()) for user_id in allowed_users_str.split(',') if user_id.strip()]
+except ValueError:
+    logging.error("Ошибка чтения ALLOWED_USERS.")
+    ALLOWED_USERS = []
+
+def is_authorized(user_id: int) -> bool:
+    if not ALLOWED_USERS: logging.warning("ALLOWED_USERS пуст."); return False
+    return user_id in ALLOWED_USERS
+
+# === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ для выбранного сервера ===
+def get_user_server(context: ContextTypes.DEFAULT_TYPE) -> dict | None:
+    """Выбранный пользователем сервер из реестра (None, если не выбран или удален из реестра)."""
+    return get_server(context.user_data.get('server_key'))
+
+def get_db_path_for_user(context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    server = get_user_server(context)
+    return server["db_path"] if server else None
+
+def get_api_credentials(context: ContextTypes.DEFAULT_TYPE) -> tuple:
+    """(base_url, password) выбранного сервера или (None, None)."""
+    server = get_user_server(context)
+    return (server["url"], server["password"]) if server else (None, None)
+
+# === КЛАВИАТУРЫ ===
+def get_main_keyboard():
+    keyboard = [
+        [KeyboardButton("📄 Скачать конфиг"), KeyboardButton("🇶 Запросить QR")],
+        [KeyboardButton("➕ Создать клиента"), KeyboardButton("🗑️ Удалить клиента")],
+        [KeyboardButton("⏳ Продлить срок действия"), KeyboardButton("👥 Список клиентов")],
+        [KeyboardButton("📦 Массовое создание"), KeyboardButton("🌍 Все серверы")],
+        [KeyboardButton("🌐 Выбрать другой сервер")],
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+def get_bulk_duration_keyboard():
+    return ReplyKeyboardMarkup([[KeyboardButton("1 мес"), KeyboardButton("6 мес"), KeyboardButton("12 мес")], [KeyboardButton("⬅️ Назад")]], resize_keyboard=True, one_time_keyboard=True)
+def get_back_keyboard():
+    return ReplyKeyboardMarkup([[KeyboardButton("⬅️ Назад")]], resize_keyboard=True, one_time_keyboard=False)
+def get_creation_options_keyboard():
+    keyboard = [
+        [KeyboardButton("1 мес"), KeyboardButton("6 мес"), KeyboardButton("12 мес")],
+        [KeyboardButton("🗓️ Указать дату")],
+        [KeyboardButton("⬅️ Назад")]
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+
+# === СПИСОК КЛИЕНТОВ И ВКЛ/ВЫКЛ ===
+async def render_client_list(context: ContextTypes.DEFAULT_TYPE, page: int, sort: str, flt: str):
+    """Страница списка клиентов текущего сервера: (текст, клавиатура или None)."""
+    db_path = get_db_path_for_user(context)
+    server_name = context.user_data.get('server_name', 'Неизвестный')
+    base_url, password = get_api_credentials(context)
+    try: db_clients = await run_db(get_all_clients, db_path)
+    except Exception as e: logging.error(f"Ошибка БД {db_path}: {e}"); return f"Ошибка БД {server_name}.", None
+    if not db_clients: return f"Клиенты не найдены в БД {server_name}.", None
+    directory = await get_client_directory(base_url, password)
+    rows = build_rows(db_clients, directory)
+    expiring = [row[0] for row in await run_db(get_expiring_clients, db_path, EXPIRING_DAYS)] if flt == "exp" else ()
+    return render_page(rows, page, sort, flt, server_name, api_available=directory is not None, stale=bool(directory and directory.stale),
+                       server_key=context.user_data.get('server_key', ''), expiring=expiring)
+
+async def toggle_client(db_path: str, base_url: str, password: str, client_name: str, enable: bool):
+    """Вкл/выкл клиента на API и в БД. Возвращает (успех API, текст результата)."""
+    api_success, api_msg = await toggle_client_status_api(client_name, enable, base_url, password)
+    db_update_success = False
+    if api_success:
+        try:
+            db_status = "enabled" if enable else "disabled"
+            updated_in_db = await run_db(update_client_status, db_path, client_name, db_status)
+            if updated_in_db: db_update_success = True
+            else: logging.warning(f"'{client_name}' не найден в {os.path.basename(db_path)} для update.")
+        except Exception as db_err: logging.error(f"Ошибка БД update {client_name} в {os.path.basename(db_path)}: {db_err}")
+
+    result_message = api_msg if api_msg else ("Успешно" if api_success else "Ошибка")
+    if api_success and not db_update_success: result_message += "\n⚠️ БД не обновлена!"
+    elif not api_success: result_message += "\n БД не изменена."
+    return api_success, result_message
+
+async def remove_client(db_path: str, base_url: str, password: str, client_name: str):
+    """Удаляет клиента с API и из БД. Возвращает (успех API, текст результата)."""
+    api_success, api_msg = await delete_client_api(client_name, base_url, password)
+    if not api_success: return False, f"Ошибка API: {api_msg}. Удаление из БД отменено."
+    await invalidate_client_artifacts(db_path, client_name)
+    try:
+        deleted_from_db = await run_db(delete_client_from_db, db_path, client_name)
+        return True, f"Клиент '{client_name}' удален с API ({'успешно' if api_msg is None else 'не найден'}) и из БД ({'успешно' if deleted_from_db else 'не найден'}). ✅"
+    except Exception as db_err:
+        logging.error(f"Ошибка БД удал. {client_name} из {db_path}: {db_err}")
+        return True, f"Клиент '{client_name}' удален с API, но ОШИБКА удаления из БД!"
+
+# === ОТПРАВКА КОНФИГОВ И QR (с повторным использованием file_id) ===
+async def send_config(message, db_path: str, artifact: dict, caption: str):
+    cache_result("telegram_file_id", "hit" if artifact["config_file_id"] else "miss")
+    if artifact["config_file_id"]:
+        try: return await message.reply_document(artifact["config_file_id"], caption=caption)
+        except BadRequest as e: cache_result("telegram_file_id", "stale"); logging.info(f"file_id конфига {artifact['client_name']} недействителен: {e}"); await forget_file_id(db_path, artifact, "config")
+    document = InputFile(BytesIO(artifact["config"].encode('utf-8')), filename=f"{artifact['client_name']}.conf")
+    sent = await message.reply_document(document, caption=caption)
+    await remember_file_id(db_path, artifact, "config", sent.document.file_id if sent.document else None)
+    return sent
+
+async def send_qr(message, db_path: str, artifact: dict, caption: str):
+    cache_result("telegram_file_id", "hit" if artifact["qr_file_id"] else "miss")
+    if artifact["qr_file_id"]:
+        try: return await message.reply_photo(artifact["qr_file_id"], caption=caption)
+        except BadRequest as e: cache_result("telegram_file_id", "stale"); logging.info(f"file_id QR {artifact['client_name']} недействителен: {e}"); await forget_file_id(db_path, artifact, "qr")
+        if not artifact["qr_png"]: return await message.reply_text("⚠️ QR-код в кэше устарел, запросите еще раз.")
+    sent = await message.reply_photo(BytesIO(artifact["qr_png"]), caption=caption)
+    await remember_file_id(db_path, artifact, "qr", sent.photo[-1].file_id if sent.photo else None)
+    return sent
+
+# === МАССОВОЕ СОЗДАНИЕ ===
+BULK_PROMPT = ("Отправьте список клиентов (по одному в строке) или CSV-файл.\n"
+               "Формат строки: <code>имя</code>, <code>имя;6</code> (месяцев) или <code>имя;31.12.2025</code>.")
+
+async def run_bulk_create(update: Update, context: ContextTypes.DEFAULT_TYPE, content: str):
+    db_path = get_db_path_for_user(context)
+    base_url, password = get_api_credentials(context)
+    rows, rejected = parse_bulk_rows(content, context.user_data.get("bulk_months", 1))
+    if not rows: await update.message.reply_text("Не найдено ни одной корректной строки.", reply_markup=get_back_keyboard()); return
+    context.user_data.pop("action", None); context.user_data.pop("bulk_months", None)
+    await update.message.reply_text(f"Создание {len(rows)} клиентов...", reply_markup=get_main_keyboard())
+    # Блокировки всех имен: одиночное создание или удаление того же имени не вклинится посередине
+    with deadline(None):  # массовая операция не укладывается в дедлайн одного действия
+        async with client_locks(context.user_data.get('server_key'), [name for name, _ in rows]):
+            archive, report = await provision_clients(rows, db_path, base_url, password, rejected)
+    ok = sum(1 for _, _, result in report if result == "OK")
+    failed = [(name, result) for name, _, result in report if result != "OK"]
+    summary = f"📦 Создано: {ok} из {len(report)}"
+    if failed: summary += "\n" + "\n".join(f"⚠️ {html.escape(name)}: {html.escape(result)}" for name, result in failed[:20])
+    if len(failed) > 20: summary += f"\n... и еще {len(failed) - 20} (см. report.csv)"
+    await update.message.reply_text(summary, parse_mode=constants.ParseMode.HTML, reply_markup=get_main_keyboard())
+    if archive: await update.message.reply_document(InputFile(BytesIO(archive), filename=f"clients_{datetime.now():%Y%m%d_%H%M}.zip"), caption="Конфиги, QR-коды и отчет")
+
+@instrument_handler
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update.effective_user.id): return
+    if context.user_data.get("action") != "bulk_create" or not get_db_path_for_user(context): return
+    document = update.message.document
+    if document.file_size and document.file_size > BULK_MAX_FILE_SIZE: await update.message.reply_text("Файл слишком большой."); return
+    data = await (await document.get_file()).download_as_bytearray()
+    try: content = bytes(data).decode("utf-8-sig")
+    except UnicodeDecodeError: await update.message.reply_text("Файл должен быть в UTF-8 (CSV или текст)."); return
+    await run_bulk_create(update, context, content)
+
+# === ВСЕ СЕРВЕРЫ ===
+async def show_all_servers(message, context: ContextTypes.DEFAULT_TYPE, query: str | None = None):
+    """Сводка по всем серверам (и поиск по имени) одним сообщением."""
+    status_message = await message.reply_text("🌍 Опрос всех серверов...")
+    results = await collect_all_servers(get_servers(), query)
+    text = format_overview(results, query)
+    if query is None: text += "\n\nОтправьте часть имени для поиска по всем серверам."
+    context.user_data["action"] = "search_all"
+    try: await status_message.edit_text(text, parse_mode=constants.ParseMode.HTML)
+    except TelegramError as e: logging.warning(f"Не удалось показать сводку по серверам: {e!r}")
+
+# === ПОИСК И КАРТОЧКА КЛИЕНТА (inline-режим) ===
+async def client_card(server: dict, client_name: str, note: str | None = None):
+    """(текст, клавиатура) карточки клиента по БД сервера и кэшу списка API."""
+    db_path = await prepare_server(server)
+    db_row = await run_db(get_client_by_name, db_path, client_name)
+    directory = await get_client_directory(server["url"], server["password"])
+    api_client = directory.by_name.get(client_name) if directory is not None else None
+    return render_card(server, client_name, db_row, api_client, directory is not None, note)
+
+async def handle_card_callback(query, action: str, server_key: str, client_name: str):
+    """Кнопки карточки клиента (cl:<действие>:<сервер>:<имя>)."""
+    server = get_server(server_key)
+    if not server:
+        try: await query.edit_message_text("Сервер удален из списка. /start", reply_markup=None)
+        except TelegramError: pass
+        return
+    db_path = await prepare_server(server)
+    base_url, password = server["url"], server["password"]
+    note = None
+
+    if action in ("cfg", "qr"):
+        artifact, error = await get_client_artifact(db_path, client_name, base_url, password, with_qr=action == "qr")
+        if action == "cfg" and artifact: await send_config(query.message, db_path, artifact, f"Конфиг {client_name}\n\n{error or ''}"); return
+        if action == "qr" and artifact and (artifact["qr_png"] or artifact["qr_file_id"]): await send_qr(query.message, db_path, artifact, f"QR-код {client_name}\n\n{error or ''}"); return
+        note = f"Ошибка: {error or 'QR не получен.'}"
+    elif action == "open":
+        text, reply_markup = await client_card(server, client_name)
+        await query.message.reply_text(text, parse_mode=constants.ParseMode.HTML, reply_markup=reply_markup)
+        return
+    elif action == "del":
+        text, reply_markup = render_delete_confirm(server, client_name)
+        try: await query.edit_message_text(text=text, parse_mode=constants.ParseMode.HTML, reply_markup=reply_markup)
+        except TelegramError as e: logging.warning(f"Не удалось показать подтверждение удаления: {e!r}")
+        return
+    elif action != "card":
+        async with client_lock(server_key, client_name):
+            if action in ("on", "off"): _, note = await toggle_client(db_path, base_url, password, client_name, action == "on")
+            elif action == "delok": _, note = await remove_client(db_path, base_url, password, client_name)
+            else:
+                months = int(action[3:])
+                try: extended = await run_db(extend_client, db_path, client_name, months)
+                except Exception as db_err: logging.error(f"Ошибка БД продл. {client_name} в {db_path}: {db_err}"); extended = False
+                note = f"Срок продлён на {months} мес. ✅" if extended else f"Не удалось продлить '{client_name}'."
+
+    text, reply_markup = await client_card(server, client_name, note)
+    try: await query.edit_message_text(text=text, parse_mode=constants.ParseMode.HTML, reply_markup=reply_markup)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower(): logging.warning(f"Не удалось обновить карточку {client_name}: {e!r}")
+    except TelegramError as e: logging.warning(f"Не удалось обновить карточку {client_name}: {e!r}")
+
+@instrument_handler
+async def inline_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Подсказки клиентов выбранного сервера по части имени (@бот запрос)."""
+    query = update.inline_query
+    if not is_authorized(query.from_user.id): await query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True); return
+    server = get_user_server(context)
+    if not server:
+        await query.answer([], cache_time=0, is_personal=True, button=InlineQueryResultsButton(text="Сначала выберите сервер", start_parameter="select"))
+        return
+    db_path = await prepare_server(server)
+    rows = await run_db(search_clients, db_path, query.query)
+    await query.answer(build_inline_results(rows, server["name"]), cache_time=INLINE_CACHE_TIME, is_personal=True)
+
+@instrument_handler
+@with_deadline()
+async def show_client_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщение "👤 <имя>", отправленное через inline-поиск: карточка клиента с действиями."""
+    if not is_authorized(update.effective_user.id): return
+    client_name = parse_card_message(update.message.text)
+    if client_name is None: return
+    server = get_user_server(context)
+    if not server: await update.message.reply_text("Сервер не выбран. /start"); return
+    text, reply_markup = await client_card(server, client_name)
+    await update.message.reply_text(text, parse_mode=constants.ParseMode.HTML, reply_markup=reply_markup)
+
+# === ОБРАБОТЧИКИ ===
+
+def server_button_label(server: dict) -> str:
+    """Имя сервера с отметкой здоровья API (🟢/🟡/🔴), если к нему уже обращались."""
+    state = server_state(server["url"])
+    return f"{STATE_EMOJI[state]} {server['name']}" if state else server["name"]
+
+@instrument_handler
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not is_authorized(user.id): logging.warning(f"Неавторизованный доступ: {user.id} ({user.username})"); await update.message.reply_text("⛔️ Нет доступа."); return
+    context.user_data.clear()
+    buttons = [[InlineKeyboardButton(server_button_label(s), callback_data=f"select_server:{k}")] for k, s in get_servers().items()]
+    if not buttons: await update.message.reply_text("Ошибка: Серверы не настроены."); return
+    if len(buttons) > 1: buttons.append([InlineKeyboardButton("🌍 Все серверы", callback_data="all_servers")])
+    reply_markup = InlineKeyboardMarkup(buttons)
+    await update.message.reply_text(f"Привет, {user.first_name}! Выберите сервер:", reply_markup=reply_markup)
+    await update.message.reply_text("...", reply_markup=ReplyKeyboardRemove())
+
+@instrument_handler
+@with_deadline()
+async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_authorized(user_id): await update.message.reply_text("⛔️ Нет доступа."); return
+
+    text = update.message.text
+    logging.info(f"User {user_id} кнопка: {text}")
+
+    action_text = text.split(" ", 1)[-1] if text.startswith(("📄", "🇶", "➕", "🗑️", "⏳", "👥", "📦", "🌍", "🌐")) else text
+
+    if action_text == "Выбрать другой сервер": await start(update, context); return
+    if action_text == "Все серверы": await show_all_servers(update.message, context); return
+
+    db_path = get_db_path_for_user(context)
+    server_name = context.user_data.get('server_name', 'Неизвестный')
+    base_url, _ = get_api_credentials(context)
+
+    if not db_path or not base_url: await update.message.reply_text("Сервер не выбран. /start"); return
+
+    context.user_data.pop("action", None); context.user_data.pop("duration", None); context.user_data.pop("extend_duration", None); context.user_data.pop("custom_expiry_date", None); context.user_data.pop("bulk_months", None)
+    await update.message.reply_text(f"📍 Сервер: {server_name} (БД: {os.path.basename(db_path)})")
+
+    if action_text == "Скачать конфиг": context.user_data["action"] = "get_config"; await update.message.reply_text("Имя клиента для конфига:", reply_markup=get_back_keyboard())
+    elif action_text == "Запросить QR": context.user_data["action"] = "get_qr"; await update.message.reply_text("Имя клиента для QR:", reply_markup=get_back_keyboard())
+    elif action_text == "Удалить клиента": context.user_data["action"] = "delete_client"; await update.message.reply_text("Имя клиента для удаления:", reply_markup=get_back_keyboard())
+    elif action_text == "Создать клиента": context.user_data["action"] = "select_creation_method"; await update.message.reply_text("Выберите срок действия или укажите дату:", reply_markup=get_creation_options_keyboard())
+    elif action_text == "Массовое создание": context.user_data["action"] = "bulk_select_duration"; await update.message.reply_text("Срок по умолчанию (для строк без срока):", reply_markup=get_bulk_duration_keyboard())
+    elif action_text == "Продлить срок действия":
+        context.user_data["action"] = "extend_select_duration"
+        extend_duration_keyboard = ReplyKeyboardMarkup([ [KeyboardButton("1"), KeyboardButton("6"), KeyboardButton("12")], [KeyboardButton("⬅️ Назад")] ], resize_keyboard=True, one_time_keyboard=True)
+        await update.message.reply_text("Продлить на (мес.):", reply_markup=extend_duration_keyboard)
+
+    elif action_text == "Список клиентов":
+        await update.message.reply_text("Загрузка списка...", reply_markup=get_main_keyboard())
+        text, reply_markup = await render_client_list(context, 0, "n", "all")
+        await update.message.reply_text(text, parse_mode=constants.ParseMode.HTML, reply_markup=reply_markup)
+
+
+@instrument_handler
+@with_deadline()
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not is_authorized(user_id): return
+
+    text = update.message.text.strip();
+    if not text: return
+
+    if text == "⬅️ Назад":
+        current_action = context.user_data.get('action'); logging.info(f"User {user_id} Назад. Отмена: {current_action}")
+        context.user_data.pop("action", None); context.user_data.pop("duration", None); context.user_data.pop("extend_duration", None); context.user_data.pop("custom_expiry_date", None); context.user_data.pop("bulk_months", None)
+        await update.message.reply_text("Отменено.", reply_markup=get_main_keyboard()); return
+
+    if context.user_data.get("action") == "search_all":
+        await show_all_servers(update.message, context, query=text); return
+
+    db_path = get_db_path_for_user(context)
+    base_url, password = get_api_credentials(context)
+    server_name = context.user_data.get('server_name', 'Неизвестный')
+    action = context.user_data.get("action")
+
+    if not db_path or not base_url: await update.message.reply_text("Сервер не выбран. /start"); return
+    if not action: logging.debug(f"Нет action для '{text}' от {user_id}"); return
+
+    logging.info(f"User {user_id} Action: {action}, Input: '{text}', Server: {server_name}, DB: {os.path.basename(db_path)}")
+    default_reply_markup = get_main_keyboard()
+
+    try:
+        if action == "select_creation_method":
+            if text in ["1 мес", "6 мес", "12 мес"]:
+                try: duration = int(text.split(" ")[0]); context.user_data["duration"] = duration; context.user_data["action"] = "create_client_duration"; await update.message.reply_text("Введите имя нового клиента:", reply_markup=get_back_keyboard())
+                except ValueError: await update.message.reply_text("Ошибка. Выберите срок кнопкой.", reply_markup=get_creation_options_keyboard())
+            elif text == "🗓️ Указать дату": context.user_data["action"] = "enter_custom_date"; await update.message.reply_text("Введите дату окончания ДД.ММ.ГГГГ:", reply_markup=get_back_keyboard())
+            else: await update.message.reply_text("Выберите опцию с клавиатуры.", reply_markup=get_creation_options_keyboard())
+            return
+
+        elif action == "enter_custom_date":
+            try:
+                input_date = datetime.strptime(text, "%d.%m.%Y")
+                if input_date.date() < datetime.now().date(): await update.message.reply_text("Дата не м.б. в прошлом. Введите ДД.ММ.ГГГГ:", reply_markup=get_back_keyboard()); return
+                expiry_datetime = input_date.replace(hour=23, minute=59, second=59, microsecond=999999)
+                expiry_date_str = expiry_datetime.isoformat(timespec='microseconds')
+                context.user_data["custom_expiry_date"] = expiry_date_str; context.user_data["action"] = "create_client_custom_date"; await update.message.reply_text(f"Дата {text} принята. Имя нового клиента:", reply_markup=get_back_keyboard())
+            except ValueError: await update.message.reply_text("Неверный формат. Введите ДД.ММ.ГГГГ:", reply_markup=get_back_keyboard())
+            return
+
+        elif action == "bulk_select_duration":
+            if text in ["1 мес", "6 мес", "12 мес"]: context.user_data["bulk_months"] = int(text.split(" ")[0]); context.user_data["action"] = "bulk_create"; await update.message.reply_text(BULK_PROMPT, reply_markup=get_back_keyboard())
+            else: await update.message.reply_text("Выберите срок кнопкой.", reply_markup=get_bulk_duration_keyboard())
+            return
+
+        elif action == "bulk_create":
+            await run_bulk_create(update, context, text)
+            return
+
+        elif action == "extend_select_duration" and text in ["1", "6", "12"]: context.user_data["extend_duration"] = int(text); context.user_data["action"] = "extend_client"; await update.message.reply_text("Имя клиента для продления:", reply_markup=get_back_keyboard())
+
+        elif action in ["create_client_duration", "create_client_custom_date", "extend_client", "get_config", "get_qr", "delete_client"]:
+            client_name = text
+            final_expiry_date_str = None
+
+            # Изменения одного клиента сериализуются, конфиг и QR читаются без блокировки
+            lock = client_lock(context.user_data.get('server_key'), client_name) if action in CLIENT_MUTATIONS else nullcontext()
+            async with lock:
+                if action == "create_client_duration" or action == "create_client_custom_date":
+                    await update.message.reply_text(f"Создание '{client_name}'...", reply_markup=default_reply_markup)
+                    if action == "create_client_duration":
+                        duration = context.user_data.get("duration")
+                        if duration is None: raise ValueError("Срок (duration) не найден.")
+                        try: expiry_dt = datetime.now() + relativedelta(months=duration); final_expiry_date_str = expiry_dt.replace(hour=23, minute=59, second=59, microsecond=999999).isoformat(timespec='microseconds'); logging.info(f"Рассчитана дата до {final_expiry_date_str}")
+                        except Exception as e: logging.error(f"Ошибка расчета даты: {e}"); await update.message.reply_text("Ошибка расчета даты."); context.user_data.pop("action", None); context.user_data.pop("duration", None); return
+                    else:
+                        final_expiry_date_str = context.user_data.get("custom_expiry_date")
+                        if final_expiry_date_str is None: raise ValueError("Кастомная дата не найдена.")
+                        logging.info(f"Используется кастомная дата: {final_expiry_date_str}")
+
+                    config, qr_png, error_api = await create_client_api(client_name, base_url, password)
+                    await invalidate_client_artifacts(db_path, client_name)
+                    if error_api: await update.message.reply_text(f"Ошибка API: {error_api}")
+                    if not isinstance(error_api, ClientExistsError):  # чужую запись в БД не перезаписываем
+                        try:
+                            saved_to_db = await run_db(save_client, db_path, client_name, final_expiry_date_str)
+                            if saved_to_db:
+                                 if not error_api: await update.message.reply_text(f"Клиент '{client_name}' создан ✅ (до {final_expiry_date_str[:10]})", reply_markup=default_reply_markup)
+                                 else: await update.message.reply_text(f"Клиент '{client_name}' сохранен в БД (до {final_expiry_date_str[:10]}), но была проблема с API.", reply_markup=default_reply_markup)
+                                 if config: await update.message.reply_document(InputFile(BytesIO(config.encode('utf-8')), filename=f"{client_name}.conf"), caption=f"Конфиг {client_name}")
+                                 else: await update.message.reply_text("⚠️ Конфиг с API не получен.")
+                                 if qr_png: await update.message.reply_photo(BytesIO(qr_png), caption=f"QR-код {client_name}")
+                                 else: await update.message.reply_text("⚠️ QR-код с API не получен.")
+                            else: await update.message.reply_text(f"Не удалось сохранить '{client_name}' в БД.", reply_markup=default_reply_markup)
+                        except Exception as db_err: logging.error(f"Ошибка БД сохр. {client_name} в {db_path}: {db_err}"); await update.message.reply_text(f"Ошибка сохранения '{client_name}' в БД!", reply_markup=default_reply_markup)
+                    context.user_data.pop("duration", None); context.user_data.pop("custom_expiry_date", None)
+
+                elif action == "extend_client":
+                    duration = context.user_data.get("extend_duration")
+                    if duration is None: raise ValueError("Срок продления не выбран.")
+                    try:
+                        extended = await run_db(extend_client, db_path, client_name, duration)
+                        if extended: updated_client_info = await run_db(get_client_by_name, db_path, client_name); new_expiry_date = updated_client_info[1] if updated_client_info and len(updated_client_info) > 1 and updated_client_info[1] else "не уст."; await update.message.reply_text(f"Срок '{client_name}' в БД продлён на {duration} мес. ✅\nДо: <code>{new_expiry_date}</code>", reply_markup=default_reply_markup, parse_mode=constants.ParseMode.HTML)
+                        else: await update.message.reply_text(f"Клиент '{client_name}' не найден/не продлен в БД.", reply_markup=default_reply_markup)
+                    except Exception as db_err: logging.error(f"Ошибка БД продл. {client_name} в {db_path}: {db_err}"); await update.message.reply_text(f"Ошибка БД продл. '{client_name}'.")
+                    context.user_data.pop("extend_duration", None)
+
+                elif action == "get_config":
+                    await update.message.reply_text(f"Запрос конфига '{client_name}'...", reply_markup=default_reply_markup)
+                    artifact, error = await get_client_artifact(db_path, client_name, base_url, password, with_qr=False)
+                    if not artifact: await update.message.reply_text(f"Ошибка: {error}")
+                    else: await send_config(update.message, db_path, artifact, f"Конфиг {client_name}\n\n{error or ''}")
+                    await update.message.reply_text("Выберите действие:", reply_markup=default_reply_markup)
+
+                elif action == "get_qr":
+                    await update.message.reply_text(f"Запрос QR '{client_name}'...", reply_markup=default_reply_markup)
+                    artifact, error = await get_client_artifact(db_path, client_name, base_url, password)
+                    if not artifact or not (artifact["qr_png"] or artifact["qr_file_id"]): await update.message.reply_text(f"Ошибка: {error or 'QR не получен.'}")
+                    else: await send_qr(update.message, db_path, artifact, f"QR-код {client_name}\n\n{error or ''}")
+                    await update.message.reply_text("Выберите действие:", reply_markup=default_reply_markup)
+
+                elif action == "delete_client":
+                    await update.message.reply_text(f"Удаление '{client_name}'...", reply_markup=default_reply_markup)
+                    api_success, result_message = await remove_client(db_path, base_url, password, client_name)
+                    await update.message.reply_text(result_message, reply_markup=default_reply_markup if api_success else None)
+
+            context.user_data.pop("action", None)
+
+        else:
+             if action == "select_creation_method": await update.message.reply_text("Пожалуйста, выберите опцию с клавиатуры.", reply_markup=get_creation_options_keyboard())
+             elif action == "enter_custom_date": await update.message.reply_text("Неверный формат. Введите дату как ДД.ММ.ГГГГ:", reply_markup=get_back_keyboard())
+             elif action == "extend_select_duration": await update.message.reply_text("Некорр. ввод. Выберите срок или '⬅️ Назад'.", reply_markup=ReplyKeyboardMarkup([[KeyboardButton("1"), KeyboardButton("6"), KeyboardButton("12")], [KeyboardButton("⬅️ Назад")]], resize_keyboard=True, one_time_keyboard=True))
+             else: logging.warning(f"Необработанный action '{action}' для '{text}'"); await update.message.reply_text("Неизв. действие.", reply_markup=default_reply_markup); context.user_data.pop("action", None)
+
+    except Exception as e:
+        logging.exception(f"Ошибка в handle_message: {e}")
+        await update.message.reply_text("Внутр. ошибка.", reply_markup=default_reply_markup)
+        context.user_data.pop("action", None); context.user_data.pop("duration", None); context.user_data.pop("extend_duration", None); context.user_data.pop("custom_expiry_date", None); context.user_data.pop("bulk_months", None)
+
+
+@instrument_handler
+@with_deadline()
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query; user_id = query.from_user.id
+    await query.answer()
+
+    if not is_authorized(user_id):
+        try: await query.edit_message_text("⛔️ Нет доступа.")
+        except Exception: pass
+        return
+
+    if not query.data: return
+    logging.info(f"User {user_id} inline: {query.data}")
+
+    if query.data == "all_servers":
+        try: await query.edit_message_reply_markup(reply_markup=None)
+        except TelegramError: pass
+        await show_all_servers(query.message, context); return
+
+    if query.data.startswith("select_server:"):
+        server_key = query.data.split(":", 1)[1]
+        selected_server = get_server(server_key)
+        if selected_server:
+            try:
+                # БД сервера открывается при первом выборе, а не при запуске бота
+                await prepare_server(selected_server)
+                logging.info(f"БД для {server_key} готова.")
+            except Exception as e:
+                 # --- ИСПРАВЛЕНО ЗДЕСЬ ---
+                 logging.error(f"Не удалось инициализ. БД {selected_server['db_path']} при выборе сервера: {e}")
+                 try:
+                     await query.edit_message_text("⚠️ Ошибка инициализации БД сервера!", reply_markup=None)
+                 except Exception:
+                     pass
+                 return
+                 # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
+            context.user_data['server_key'] = server_key; context.user_data['server_name'] = selected_server['name']
+            try:
+                await query.edit_message_text(f"Выбран: {selected_server['name']}", reply_markup=None)
+            except Exception:
+                pass
+            await context.bot.send_message(chat_id=query.message.chat_id, text=f"Действие:\n🔎 Поиск клиента: @{context.bot.username} часть_имени", reply_markup=get_main_keyboard())
+        else:
+             try:
+                 await query.edit_message_text("Ошибка: Неизв. сервер.", reply_markup=None)
+             except Exception:
+                 pass
+        return
+
+    # Карточка клиента несет ключ своего сервера и не зависит от выбранного
+    if query.data.startswith("cl:"):
+        parsed = parse_card_callback(query.data)
+        if not parsed: logging.error(f"Некорр. callback карточки: {query.data}"); return
+        await handle_card_callback(query, *parsed); return
+
+    db_path = get_db_path_for_user(context)
+    base_url, password = get_api_credentials(context)
+    server_name = context.user_data.get('server_name', 'N/A')
+
+    # --- ИСПРАВЛЕНО ЗДЕСЬ ---
+    if not db_path or not base_url:
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text="Сервер не выбран. Пожалуйста, используйте /start.",
+            reply_markup=get_main_keyboard()
+        )
+        try:
+            if query.message:
+                await query.edit_message_reply_markup(reply_markup=None)
+        except Exception:
+            pass
+        return
+    # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
+
+    if query.data.startswith(("list:", "ltog:")):
+        parsed = parse_list_callback(query.data)
+        if not parsed: logging.error(f"Некорр. callback списка: {query.data}"); return
+        page, sort, flt, enable, client_name = parsed
+        result_message = None
+        if client_name is not None:
+            async with client_lock(context.user_data.get('server_key'), client_name):
+                _, result_message = await toggle_client(db_path, base_url, password, client_name, enable)
+        text, reply_markup = await render_client_list(context, page, sort, flt)
+        if result_message: text += f"\n\n<i>{html.escape(result_message)}</i>"
+        try: await query.edit_message_text(text=text, parse_mode=constants.ParseMode.HTML, reply_markup=reply_markup)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower(): logging.warning(f"Не удалось обновить список клиентов: {e!r}")
+        except TelegramError as e: logging.warning(f"Не удалось обновить список клиентов: {e!r}")
+        return
+
+    if query.data.startswith("enable:") or query.data.startswith("disable:"):
+        try: action_cb, client_name = query.data.split(":", 1)
+        except ValueError: logging.error(f"Некорр. callback вкл/выкл: {query.data}"); return
+
+        enable = (action_cb == "enable")
+        async with client_lock(context.user_data.get('server_key'), client_name):
+            _, result_message = await toggle_client(db_path, base_url, password, client_name, enable)
+
+        current_status_text, emoji, is_enabled_now = "<pre>API N/A</pre>", "⚠️", None
+        directory = await get_client_directory(base_url, password)
+        api_client = directory.by_name.get(client_name) if directory is not None else None
+
+        if api_client: is_enabled_now = api_client.get('enabled', False); emoji = "🟢" if is_enabled_now else "🔴"; current_status_text = "<b>enabled</b>" if is_enabled_now else "<b>disabled</b>"
+        elif directory is not None: emoji = "❓"; current_status_text = f"<pre>нет на API</pre>"
+
+        try: client_db_info = await run_db(get_client_by_name, db_path, client_name); expiry_str = f"<code>{client_db_info[1][:10] if client_db_info and len(client_db_info)>1 and client_db_info[1] else '-'}</code>"
+        except Exception: expiry_str = "<i>ошибка БД</i>"
+
+        new_message_text = f"{emoji} <b>{client_name}</b>\n📌 Статус: {current_status_text}\n⏳ До: {expiry_str}\n\n<i>{result_message}</i>"
+        new_keyboard = None
+        if api_client: new_keyboard = InlineKeyboardMarkup([ [InlineKeyboardButton("▶️ Вкл" if not is_enabled_now else "▶️", callback_data=f"enable:{client_name}"), InlineKeyboardButton("⏹️ Выкл" if is_enabled_now else "⏹️", callback_data=f"disable:{client_name}")] ])
+
+        try:
+            if query.message and (query.message.text != new_message_text or query.message.reply_markup != new_keyboard):
+                 logging.debug(f"Попытка редактирования сообщения для {client_name}")
+                 await query.edit_message_text(text=new_message_text, parse_mode=constants.ParseMode.HTML, reply_markup=new_keyboard)
+                 logging.debug(f"Сообщение для {client_name} отредактировано.")
+            elif query.message: logging.info(f"Сообщение для {client_name} не изменилось, редактирование пропущено.")
+            else: logging.warning("Не удалось получить query.message для редактирования.")
+        except TelegramError as e:
+             logging.warning(f"Не удалось отредактировать сообщение для {client_name}. Ошибка Telegram: {e!r}")
+             # НЕ отправляем новое сообщение
+        except Exception as e:
+             logging.error(f"Неизвестная ошибка при попытке редактирования сообщения {client_name}: {e!r}")
+
+
+# === ГЛОБАЛЬНЫЙ ОБРАБОТЧИК ОШИБОК ===
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logging.error(f"Исключение при обработке апдейта {update}:", exc_info=context.error)
+    if isinstance(context.error, TimedOut):
+        logging.warning("Таймаут Telegram API.")
+        if isinstance(update, Update) and update.effective_chat:
+             try:
+                 if update.effective_message and update.effective_message.text: await context.bot.send_message(chat_id=update.effective_chat.id, text="⏳ Сервер Telegram не ответил. Попробуйте еще раз.")
+             except Exception as e_inner: logging.error(f"Ошибка отпр. сообщ. о таймауте: {e_inner}")
+        return
+    if isinstance(context.error, TelegramError): logging.warning(f"Ошибка Telegram: {context.error}")
+    if isinstance(update, Update) and update.effective_chat:
+        try: await context.bot.send_message(chat_id=update.effective_chat.id, text="⚠️ Внутренняя ошибка бота.")
+        except Exception as e: logging.error(f"Ошибка отпр. сообщ. об ошибке: {e}")
+
+# === ПЕРИОДИЧЕСКИЕ ЗАДАЧИ ===
+async def notify_admins(bot, text: str, what: str):
+    """Фоновая рассылка всем администраторам: отправки идут параллельно, темп держит очередь (BULK)."""
+    async def _send(admin_id: int):
+        try: await bot.send_message(chat_id=admin_id, text=text, parse_mode=constants.ParseMode.HTML, rate_limit_args=BULK)
+        except TelegramError as e: logging.warning(f"Не удалось отправить {what} {admin_id}: {e}")
+    await asyncio.gather(*(_send(admin_id) for admin_id in ALLOWED_USERS))
+
+async def expiry_job(context: ContextTypes.DEFAULT_TYPE):
+    summary = await enforce_expiry(get_servers())
+    text = format_expiry_summary(summary)
+    if text: await notify_admins(context.bot, text, "сводку по срокам")
+
+async def reconcile_job(context: ContextTypes.DEFAULT_TYPE):
+    summary = await reconcile_all(get_servers())
+    text = format_reconcile_summary(summary)
+    if text: await notify_admins(context.bot, text, "сводку сверки")
+
+async def telemetry_job(context: ContextTypes.DEFAULT_TYPE):
+    await collect_telemetry(get_servers())
+
+@instrument_handler
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_authorized(update.effective_user.id): await update.message.reply_text("⛔️ Нет доступа."); return
+    summary = await reconcile_all(get_servers())
+    await update.message.reply_text(await format_reconcile_report(summary), parse_mode=constants.ParseMode.HTML)
+
+@instrument_handler
+async def traffic_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/traffic [7 | 7d | 6h] - топ клиентов по трафику за окно и неактивные клиенты выбранного сервера."""
+    if not is_authorized(update.effective_user.id): await update.message.reply_text("⛔️ Нет доступа."); return
+    server = get_user_server(context)
+    if not server: await update.message.reply_text("Сервер не выбран. /start"); return
+    window = parse_window(context.args[0] if context.args else None)
+    if window is None: await update.message.reply_text("Формат: /traffic 7 (дней) или /traffic 6h (часов)"); return
+    await update.message.reply_text(await format_traffic_report(server, window), parse_mode=constants.ParseMode.HTML)
+
+@instrument_handler
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [all] [qr] - ZIP с конфигами (и QR) клиентов выбранного или всех серверов и clients.csv."""
+    if not is_authorized(update.effective_user.id): await update.message.reply_text("⛔️ Нет доступа."); return
+    args = {arg.lower() for arg in context.args or ()}
+    if "all" in args: servers, label = list(get_servers().values()), "all"
+    else:
+        server = get_user_server(context)
+        if not server: await update.message.reply_text("Сервер не выбран. /start (или /export all)"); return
+        servers, label = [server], server["key"]
+    with_qr = "qr" in args
+    await update.message.reply_text(f"📦 Экспорт ({'все серверы' if label == 'all' else servers[0]['name']}{', с QR' if with_qr else ''})...")
+    with deadline(None):  # экспорт большого сервера не укладывается в дедлайн одного действия
+        path, stats = await build_export(servers, with_qr)
+    try:
+        size = os.path.getsize(path)
+        if size > EXPORT_MAX_SIZE:
+            await update.message.reply_text(f"⚠️ Архив {size // (1024 * 1024)} МБ - больше лимита Telegram (50 МБ). Попробуйте без QR или по одному серверу.")
+            return
+        with open(path, "rb") as archive:
+            await update.message.reply_document(InputFile(archive, filename=f"export_{label}_{datetime.now():%Y%m%d_%H%M}.zip"),
+                                                caption=format_export_caption(stats, with_qr), write_timeout=120)
+    finally:
+        os.remove(path)
+
+# === ЗАПУСК ===
+async def on_startup(app: Application) -> None:
+    await start_metrics_server()
+    # Миграции БД серверов - фоном, прием апдейтов их не ждет
+    warm_up_servers()
+    await profile_initialized()
+
+async def on_shutdown(app: Application) -> None:
+    await stop_metrics_server()
+    await close_api_clients()
+    close_all_connections()
+    shutdown_qr_pool()
+
+def build_application(request: BaseRequest | None = None, get_updates_request: BaseRequest | None = None) -> Application:
+    """
+    Application со всеми настройками и обработчиками бота (main и бенчмарк
+    собирают его одинаково). request / get_updates_request - транспорт Bot API
+    (по умолчанию HTTPX с замерами / стандартный).
+    """
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        # Запросы к Bot API (кроме getUpdates) замеряются для метрик
+        .request(request or InstrumentedHTTPXRequest(connect_timeout=15.0, read_timeout=30.0, write_timeout=10.0))  # pool_timeout=30.0 - можно добавить
+        # Медленное действие одного админа не задерживает апдейты остальных (изменения клиента - под client_lock)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        # Все отправки - через очередь с лимитами Telegram (интерактивные ответы - вперед рассылок)
+        .rate_limiter(SendScheduler())
+        .persistence(SQLitePersistence(STATE_DB))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if get_updates_request is not None: builder = builder.get_updates_request(get_updates_request)
+    app = builder.build()
+
+    main_menu_options = [ "📄 Скачать конфиг", "🇶 Запросить QR", "➕ Создать клиента", "🗑️ Удалить клиента", "⏳ Продлить срок действия", "👥 Список клиентов", "📦 Массовое создание", "🌍 Все серверы", "🌐 Выбрать другой сервер" ]
+    app.add_handler(MessageHandler(filters.Regex(f"^({'|'.join(map(re.escape, main_menu_options))})$") & filters.ChatType.PRIVATE, handle_buttons))
+
+    app.add_handler(CommandHandler("start", start, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler("reconcile", reconcile_command, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler("traffic", traffic_command, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CommandHandler("export", export_command, filters=filters.ChatType.PRIVATE))
+    app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_handler(InlineQueryHandler(inline_search))
+    # Выбранный inline-результат ("👤 <имя>") - до handle_message, чтобы не попасть в ввод имени
+    app.add_handler(MessageHandler(filters.VIA_BOT & filters.TEXT & filters.ChatType.PRIVATE, show_client_card))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, handle_message))
+    app.add_handler(MessageHandler(filters.Document.ALL & filters.ChatType.PRIVATE, handle_document))
+    app.add_error_handler(error_handler)
+    app.add_handler(TypeHandler(Update, profile_first_update), group=-1)
+
+    if app.job_queue:
+        app.job_queue.run_repeating(expiry_job, interval=EXPIRY_CHECK_INTERVAL, first=60)
+        app.job_queue.run_repeating(reconcile_job, interval=RECONCILE_INTERVAL, first=120)
+        if TELEMETRY_INTERVAL > 0: app.job_queue.run_repeating(telemetry_job, interval=TELEMETRY_INTERVAL, first=30)
+    else: logging.warning("JobQueue недоступна (pip install \"python-telegram-bot[job-queue]\"), автоотключение истекших клиентов, сверка с API и телеметрия выключены.")
+
+    return app
+
+def main():
+    if not TELEGRAM_TOKEN: print("CRITICAL: Нет TELEGRAM_TOKEN"); logging.critical("Нет TOKEN"); return
+    if not ALLOWED_USERS: print("CRITICAL: Нет ALLOWED_USERS"); logging.critical("Нет ALLOWED_USERS"); return
+    if not get_servers(): print("CRITICAL: Список серверов пуст"); logging.critical("Список серверов пуст (servers.json / SERVER<N>_*)"); return
+
+    try:
+        # Сами БД серверов открываются лениво (servers.prepare_server)
+        if not os.path.exists(DB_DIR): os.makedirs(DB_DIR); print(f"Создана директория БД: {DB_DIR}"); logging.info(f"Создана директория БД: {DB_DIR}")
+    except Exception as e: print(f"CRITICAL: Ошибка создания директории БД: {e}"); logging.critical(f"Ошибка создания директории БД: {e}"); return
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram.vendor.ptb_urllib3.urllib3").setLevel(logging.WARNING)
+
+    app = build_application()
+    mark_startup("сборка Application")
+
+    logging.info("Бот запускается...")
+    print("Бот запускается...")
+    # webhook (BOT_MODE=webhook) или long polling, только нужные обработчикам типы апдейтов
+    run_updates(app)
@@ -0,0 +1,117 @@
+import os
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+
+from database import get_artifact, save_artifact, delete_artifacts_by_name, run_db
+from metrics import cache_result
+from wg_api import find_client, get_api_client_configuration, get_client_qr_png, invalidate_client_directory
+
+# === КЭШ КОНФИГОВ И QR-КОДОВ ===
+# Конфиг клиента почти никогда не меняется, поэтому конфиг, PNG с QR и file_id
+# Telegram после первой отправки хранятся в таблице artifacts БД сервера и в
+# LRU в памяти. Ключ - (БД сервера, id клиента на wg-easy), содержимое
+# адресуется sha256 конфига: QR и file_id действительны, пока хэш не изменился.
+#
+# Запись считается свежей, пока совпадает updatedAt клиента на API и не прошло
+# ARTIFACT_TTL секунд. После этого конфиг перечитывается (это дешево), и если
+# хэш тот же - QR и file_id переиспользуются без перегенерации и повторной загрузки.
+
+ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", "86400"))
+ARTIFACT_CACHE_SIZE = int(os.getenv("ARTIFACT_CACHE_SIZE", "256"))
+
+_memory: OrderedDict = OrderedDict()  # (db_path, client_id) -> artifact
+
+
+def config_hash(config: str) -> str:
+    return hashlib.sha256(config.encode("utf-8")).hexdigest()
+
+
+def _remember(db_path: str, artifact: dict) -> None:
+    key = (db_path, artifact["client_id"])
+    _memory[key] = artifact
+    _memory.move_to_end(key)
+    while len(_memory) > ARTIFACT_CACHE_SIZE:
+        _memory.popitem(last=False)
+
+
+async def _lookup(db_path: str, client_id: str) -> dict | None:
+    artifact = _memory.get((db_path, client_id))
+    if artifact is not None:
+        _memory.move_to_end((db_path, client_id))
+        cache_result("artifact_memory", "hit")
+        return artifact
+    cache_result("artifact_memory", "miss")
+    artifact = await run_db(get_artifact, db_path, client_id)
+    cache_result("artifact_db", "hit" if artifact is not None else "miss")
+    if artifact is not None:
+        _remember(db_path, artifact)
+    return artifact
+
+
+async def get_client_artifact(db_path: str, client_name: str, base_url: str, password: str, with_qr: bool = True):
+    """
+    Возвращает (artifact, сообщение). artifact - dict с config, qr_png и file_id
+    (None, если получить не удалось - тогда сообщение содержит ошибку).
+    Сообщение при artifact != None - предупреждение (например, конфиг из кэша).
+    """
+    client_data, directory = await find_client(client_name, base_url, password)
+    if directory is None: return None, "Не удалось получить список клиентов."
+    if not client_data: return None, f"Клиент '{client_name}' не найден на сервере."
+    client_id = client_data["id"]
+    api_updated_at = client_data.get("updatedAt")
+    warning = None
+
+    artifact = await _lookup(db_path, client_id)
+    is_fresh = (artifact is not None and artifact["api_updated_at"] == api_updated_at
+                and time.time() - artifact["fetched_at"] < ARTIFACT_TTL)
+    if artifact is not None: cache_result("artifact_config", "hit" if is_fresh else "stale")
+    if not is_fresh:
+        config = await get_api_client_configuration(client_id, base_url, password)
+        if config is None:
+            if artifact is None:
+                invalidate_client_directory(base_url)  # id мог устареть
+                return None, "Не удалось получить конфиг."
+            warning = "API недоступен, отдан конфиг из кэша."
+        else:
+            digest = config_hash(config)
+            if artifact is None or artifact["config_hash"] != digest:
+                artifact = {"client_id": client_id, "client_name": client_name, "config_hash": digest, "config": config,
+                            "qr_png": None, "config_file_id": None, "qr_file_id": None}
+            artifact = dict(artifact, client_name=client_name, api_updated_at=api_updated_at, fetched_at=time.time())
+            _remember(db_path, artifact)
+            await run_db(save_artifact, db_path, artifact)
+
+    if with_qr and artifact["qr_png"] is None and artifact["qr_file_id"] is None:
+        qr_png, qr_error = await get_client_qr_png(client_id, artifact["config"], base_url, password)
+        if qr_png is None:
+            return artifact, f"Конфиг получен, но {qr_error}"
+        artifact["qr_png"] = qr_png
+        await run_db(save_artifact, db_path, artifact)
+    return artifact, warning
+
+
+async def remember_file_id(db_path: str, artifact: dict, kind: str, file_id: str | None) -> None:
+    """Запоминает file_id отправленного документа (kind='config') или фото (kind='qr')."""
+    column = f"{kind}_file_id"
+    if not file_id or artifact.get(column) == file_id:
+        return
+    artifact[column] = file_id
+    _remember(db_path, artifact)
+    await run_db(save_artifact, db_path, artifact)
+
+
+async def forget_file_id(db_path: str, artifact: dict, kind: str) -> None:
+    """Сбрасывает file_id, который Telegram перестал принимать."""
+    artifact[f"{kind}_file_id"] = None
+    _remember(db_path, artifact)
+    await run_db(save_artifact, db_path, artifact)
+
+
+async def invalidate_client_artifacts(db_path: str, client_name: str) -> None:
+    """Сбрасывает кэш конфигов/QR клиента (удаление или пересоздание)."""
+    for key in [k for k, a in _memory.items() if k[0] == db_path and a["client_name"] == client_name]:
+        _memory.pop(key, None)
+    removed = await run_db(delete_artifacts_by_name, db_path, client_name)
+    if removed: logging.info(f"Кэш конфигов '{client_name}' в '{db_path}' сброшен ({removed} зап.).")
@@ -0,0 +1,283 @@
+"""
+Бенчмарк обработчиков бота без Telegram и без реальных серверов wg-easy.
+
+Поднимает заглушку wg-easy (fake_wg_easy.py) с заданным числом клиентов,
+заполняет БД сервера теми же клиентами и пропускает синтетические Update
+через Application.process_update. Application собирает app.build_application,
+как и main(): те же обработчики, очередь отправки SendScheduler с лимитами
+Telegram, SQLitePersistence и concurrent_updates. Ответы бота уходят в
+заглушку Bot API (FakeTelegramRequest), которая сразу отвечает "ok" и
+запоминает отправленные тексты. Задержка включает ожидание в очереди отправки;
+чтобы замерить только обработчики, задайте большие SEND_CHAT_RATE и
+SEND_CHAT_BURST в окружении.
+
+Сценарии (каждый - отдельная фаза, --users пользователей параллельно):
+  list   - кнопка "Список клиентов" (первая страница);
+  page   - перелистывание списка (callback list:...);
+  create - "Создать клиента" -> "1 мес" -> имя;
+  toggle - вкл/выкл клиента из списка (callback ltog:...);
+  config - "Скачать конфиг" -> имя;
+  qr     - "Запросить QR" -> имя.
+Для каждого размера (--peers, по умолчанию 10, 1000, 10000) печатается p50/p99,
+максимум и пропускная способность.
+
+Запуск из корня репозитория:
+  python benchmarks/bench_bot.py
+  python benchmarks/bench_bot.py --peers 10 1000 --ops 200 --users 8 --latency 5 --json bench_output.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+from fake_wg_easy import FakeWgEasy, PASSWORD, peer_name  # noqa: E402
+
+FLOWS = ("list", "page", "create", "toggle", "config", "qr")
+BASE_USER_ID = 100000
+ERROR_MARKERS = ("⚠️", "Ошибка", "ошибка", "Не удалось")
+
+
+def _setup_environment(work_dir: str, users: int) -> None:
+    """Окружение для app.py - до его импорта (настройки читаются при импорте)."""
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:BENCH",
+        "ALLOWED_USERS": ",".join(str(BASE_USER_ID + i) for i in range(users)),
+        "DB_DIR": os.path.join(work_dir, "db"),
+        "SERVERS_FILE": os.path.join(work_dir, "servers.json"),
+        "SERVERS_RELOAD_CHECK": "0",
+        "SESSION_PASSWORD": PASSWORD,
+        "METRICS_PORT": "0",
+    })
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Заглушка транспорта Bot API: отвечает "ok" и запоминает тексты по chat_id."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent: dict[int, list] = {}
+        self.calls = 0
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        self.calls += 1
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                      "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+        elif api_method == "answerCallbackQuery":
+            result = True
+        else:
+            chat_id = int(params.get("chat_id", 0) or 0)
+            self._message_id += 1
+            result = {"message_id": self._message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text") or params.get("caption") or ""}
+            file_id = f"file{self._message_id}"
+            if api_method == "sendDocument":
+                result["document"] = {"file_id": file_id, "file_unique_id": file_id}
+            elif api_method == "sendPhoto":
+                result["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 256, "height": 256}]
+            self.sent.setdefault(chat_id, []).append(result["text"])
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class Driver:
+    """Собирает синтетические Update и передает их в Application бота."""
+
+    def __init__(self, application, request):
+        self.app = application
+        self.request = request
+        self._update_id = 0
+        self._message_id = 10 ** 6
+
+    def _next_ids(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}
+
+    def _message(self, user_id: int, text: str) -> dict:
+        _, message_id = self._next_ids()
+        return {"message_id": message_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+                "from": self._user(user_id), "text": text}
+
+    async def _dispatch(self, payload: dict) -> None:
+        await self.app.process_update(Update.de_json(payload, self.app.bot))
+
+    async def text(self, user_id: int, text: str) -> None:
+        update_id, _ = self._next_ids()
+        await self._dispatch({"update_id": update_id, "message": self._message(user_id, text)})
+
+    async def callback(self, user_id: int, data: str) -> None:
+        update_id, _ = self._next_ids()
+        payload = {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": {**self._message(user_id, "list"), "from": {"id": 1, "is_bot": True, "first_name": "Bench"}},
+        }}
+        await self._dispatch(payload)
+
+    def take_replies(self, user_id: int) -> list:
+        return self.request.sent.pop(user_id, [])
+
+
+async def _run_flow(driver: Driver, flow: str, user_id: int, op: int, peers: int, state: dict) -> None:
+    name = peer_name(random.randrange(peers))
+    if flow == "list":
+        await driver.text(user_id, "👥 Список клиентов")
+    elif flow == "page":
+        await driver.callback(user_id, f"list:{random.randrange(max(1, peers // 10))}:n:all")
+    elif flow == "create":
+        await driver.text(user_id, "➕ Создать клиента")
+        await driver.text(user_id, "1 мес")
+        await driver.text(user_id, f"bench-{user_id}-{op}-{state['run']}")
+    elif flow == "toggle":
+        enable = state.setdefault("enabled", {}).get(name, True)
+        await driver.callback(user_id, f"ltog:0:n:all:{'d' if enable else 'e'}:{name}")
+        state["enabled"][name] = not enable
+    elif flow == "config":
+        await driver.text(user_id, "📄 Скачать конфиг")
+        await driver.text(user_id, name)
+    elif flow == "qr":
+        await driver.text(user_id, "🇶 Запросить QR")
+        await driver.text(user_id, name)
+
+
+def _percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def _run_phase(driver: Driver, flow: str, users: list, ops: int, peers: int, state: dict) -> dict:
+    latencies, errors = [], 0
+    queue = iter(range(ops))
+
+    async def worker(user_id: int):
+        nonlocal errors
+        for op in queue:
+            driver.take_replies(user_id)
+            start = time.perf_counter()
+            try:
+                await _run_flow(driver, flow, user_id, op, peers, state)
+            except Exception as e:
+                errors += 1
+                logging.warning(f"{flow}: исключение {e!r}")
+                continue
+            latencies.append(time.perf_counter() - start)
+            failed = [text for text in driver.take_replies(user_id) if any(marker in text for marker in ERROR_MARKERS)]
+            if failed:
+                errors += 1
+                logging.info(f"{flow}: ошибка в ответе: {failed[0][:200]!r}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(user_id) for user_id in users))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "flow": flow, "ops": len(latencies), "errors": errors,
+        "p50_ms": _percentile(latencies, 0.50) * 1000, "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0) * 1000, "ops_per_s": len(latencies) / elapsed if elapsed else 0,
+    }
+
+
+async def _bench_size(app, request, work_dir: str, peers: int, args) -> list:
+    import database
+    from servers import get_server
+    fake = await FakeWgEasy(peers, args.latency / 1000, args.jitter / 1000).start()
+    key = f"bench{peers}"
+    with open(os.environ["SERVERS_FILE"], "w", encoding="utf-8") as f:
+        json.dump([{"key": key, "name": f"Bench {peers}", "url": fake.url}], f)
+    os.utime(os.environ["SERVERS_FILE"], (time.time() + peers, time.time() + peers))  # mtime меняется и при быстрой перезаписи
+
+    server = get_server(key)
+    expiry = (datetime.now() + timedelta(days=365)).isoformat(timespec="microseconds")
+    database.init_db(server["db_path"])
+    database.save_clients(server["db_path"], [(peer_name(i), expiry) for i in range(peers)])
+
+    driver = Driver(app, request)
+    users = [BASE_USER_ID + i for i in range(args.users)]
+    for user_id in users:
+        await driver.callback(user_id, f"select_server:{key}")
+    state = {"run": peers}
+    results = []
+    for flow in args.flows:
+        ops = args.ops if flow != "create" else min(args.ops, args.create_ops)
+        result = await _run_phase(driver, flow, users, ops, peers, state)
+        result["peers"] = peers
+        results.append(result)
+        print(f"{peers:>6} {flow:<7} {result['ops']:>5} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} "
+              f"{result['max_ms']:>9.1f} {result['ops_per_s']:>8.1f} {result['errors']:>6}", flush=True)
+    await fake.stop()
+    return results
+
+
+async def main(args) -> list:
+    work_dir = tempfile.mkdtemp(prefix="wg-bench-")
+    _setup_environment(work_dir, args.users)
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(message)s")
+    if args.verbose: logging.getLogger().setLevel(logging.INFO)
+
+    import app as bot_module
+
+    request = FakeTelegramRequest()
+    os.makedirs(os.environ["DB_DIR"], exist_ok=True)
+    app = bot_module.build_application(request, FakeTelegramRequest())
+    await app.initialize()
+    await app.post_init(app)
+    print(f"Рабочая папка: {work_dir}; пользователей {args.users}, задержка API {args.latency} мс")
+    print(f"{'peers':>6} {'flow':<7} {'ops':>5} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9} {'ops/s':>8} {'errors':>6}")
+    results = []
+    try:
+        for peers in args.peers:
+            results += await _bench_size(app, request, work_dir, peers, args)
+    finally:
+        await app.shutdown()
+        await app.post_shutdown(app)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков бота на заглушке wg-easy")
+    parser.add_argument("--peers", type=int, nargs="+", default=[10, 1000, 10000], help="число клиентов на сервере")
+    parser.add_argument("--flows", nargs="+", default=list(FLOWS), choices=FLOWS)
+    parser.add_argument("--ops", type=int, default=100, help="операций на сценарий")
+    parser.add_argument("--create-ops", type=int, default=50, help="операций создания (они растят список)")
+    parser.add_argument("--users", type=int, default=4, help="параллельных пользователей")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа заглушки wg-easy, мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результаты в JSON")
+    parser.add_argument("-v", "--verbose", action="store_true", help="печатать тексты ошибок из ответов бота")
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+    asyncio.run(main(arguments))
@@ -0,0 +1,166 @@
+"""
+Локальная заглушка API wg-easy для бенчмарков.
+
+Реализует эндпоинты, которые использует бот:
+  POST   /api/session
+  GET    /api/wireguard/client
+  POST   /api/wireguard/client
+  DELETE /api/wireguard/client/<id>
+  POST   /api/wireguard/client/<id>/enable | disable
+  GET    /api/wireguard/client/<id>/configuration
+  GET    /api/wireguard/client/<id>/qrcode.svg
+
+Клиенты живут в памяти, задержка каждого ответа задается --latency.
+Запуск отдельно:  python benchmarks/fake_wg_easy.py --peers 1000 --port 51821
+"""
+import json
+import uuid
+import random
+import asyncio
+import argparse
+from datetime import datetime, timezone
+
+PASSWORD = "bench"
+COOKIE = "connect.sid=bench-session"
+
+_SVG = (b'<svg xmlns="http://www.w3.org/2000/svg" width="64" height="64">'
+        b'<rect width="64" height="64" fill="#fff"/><rect x="8" y="8" width="16" height="16"/></svg>')
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def peer_name(i: int) -> str:
+    return f"peer{i:05d}"
+
+
+class FakeWgEasy:
+    """HTTP/1.1 сервер с keep-alive поверх asyncio.start_server."""
+
+    def __init__(self, peers: int = 10, latency: float = 0.0, jitter: float = 0.0, password: str = PASSWORD):
+        self.latency = latency
+        self.jitter = jitter
+        self.password = password
+        self.clients: dict[str, dict] = {}
+        self.requests = 0
+        self._server: asyncio.AbstractServer | None = None
+        self.port = None
+        for i in range(peers):
+            self._add(peer_name(i))
+
+    def _add(self, name: str) -> dict:
+        client_id = str(uuid.uuid4())
+        now = _now()
+        client = {
+            "id": client_id, "name": name, "enabled": True,
+            "address": f"10.8.{len(self.clients) // 250}.{len(self.clients) % 250 + 2}",
+            "publicKey": uuid.uuid4().hex, "createdAt": now, "updatedAt": now,
+            "persistentKeepalive": "off", "latestHandshakeAt": None, "transferRx": 0, "transferTx": 0,
+        }
+        self.clients[client_id] = client
+        return client
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> "FakeWgEasy":
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                if self.latency or self.jitter:
+                    await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+                self.requests += 1
+                status, content_type, payload, extra = self._route(method, target.split("?")[0], headers, body)
+                head = [f"HTTP/1.1 {status}", f"Content-Type: {content_type}", f"Content-Length: {len(payload)}"]
+                head += extra
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, method: str, path: str, headers: dict, body: bytes):
+        if path == "/api/session" and method == "POST":
+            try: password = json.loads(body or b"{}").get("password")
+            except ValueError: password = None
+            if password != self.password:
+                return self._json("401 Unauthorized", {"error": "Incorrect Password"})
+            return "204 No Content", "text/plain", b"", [f"Set-Cookie: {COOKIE}; Path=/; HttpOnly"]
+        if COOKIE not in headers.get("cookie", ""):
+            return self._json("401 Unauthorized", {"error": "Not Logged In"})
+
+        parts = path.strip("/").split("/")  # api, wireguard, client, <id>, <action>
+        if parts[:3] != ["api", "wireguard", "client"]:
+            return self._json("404 Not Found", {"error": "Not Found"})
+        if len(parts) == 3:
+            if method == "GET":
+                return self._json("200 OK", list(self.clients.values()))
+            if method == "POST":
+                name = json.loads(body or b"{}").get("name")
+                if not name:
+                    return self._json("400 Bad Request", {"error": "Missing: Name"})
+                self._add(name)
+                return self._json("200 OK", {"success": True})
+        client = self.clients.get(parts[3]) if len(parts) > 3 else None
+        if client is None:
+            return self._json("404 Not Found", {"error": "Client Not Found"})
+        if len(parts) == 4 and method == "DELETE":
+            del self.clients[client["id"]]
+            return self._json("200 OK", {"success": True})
+        action = parts[4] if len(parts) > 4 else None
+        if method == "POST" and action in ("enable", "disable"):
+            client["enabled"] = action == "enable"
+            client["updatedAt"] = _now()
+            return self._json("200 OK", {"success": True})
+        if method == "GET" and action == "configuration":
+            config = (f"[Interface]\nPrivateKey = {uuid.uuid4().hex}\nAddress = {client['address']}/24\nDNS = 1.1.1.1\n\n"
+                      f"[Peer]\nPublicKey = {client['publicKey']}\nAllowedIPs = 0.0.0.0/0, ::/0\nEndpoint = 127.0.0.1:51820\n")
+            return "200 OK", "text/plain", config.encode(), [f'Content-Disposition: attachment; filename="{client["name"]}.conf"']
+        if method == "GET" and action == "qrcode.svg":
+            return "200 OK", "image/svg+xml", _SVG, []
+        return self._json("404 Not Found", {"error": "Not Found"})
+
+    @staticmethod
+    def _json(status: str, data):
+        return status, "application/json", json.dumps(data).encode(), []
+
+
+async def _main(args) -> None:
+    server = await FakeWgEasy(args.peers, args.latency / 1000, args.jitter / 1000, args.password).start(args.host, args.port)
+    print(f"Заглушка wg-easy: {server.url} ({args.peers} клиентов, задержка {args.latency} мс), пароль '{args.password}'")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка API wg-easy для бенчмарков")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=51821)
+    parser.add_argument("--peers", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, мс")
+    parser.add_argument("--password", default=PASSWORD)
+    try: asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt: pass
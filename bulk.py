@@ -0,0 +1,152 @@
+import io
+import os
+import re
+import csv
+import asyncio
+import zipfile
+import logging
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+
+from database import save_clients, run_db
+from wg_api import ClientExistsError, create_clients_api, get_client_directory, get_config_and_qr_by_id
+from artifacts import invalidate_client_artifacts
+
+# === МАССОВОЕ СОЗДАНИЕ КЛИЕНТОВ ===
+# Вход - список имен (по одному в строке) или CSV: name[,months|date].
+# Срок - число месяцев или дата ДД.ММ.ГГГГ / ГГГГ-ММ-ДД; без срока берется
+# выбранный по умолчанию. На сервере клиенты создаются параллельно (не более
+# BULK_CONCURRENCY запросов), затем один раз читается список клиентов, конфиги и
+# QR получаются параллельно, а в БД все строки пишутся одним executemany.
+# Результат - ZIP с .conf, QR PNG и report.csv.
+
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "5"))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "500"))
+BULK_MAX_FILE_SIZE = 1024 * 1024
+
+_HEADER_NAMES = {"name", "имя", "client", "клиент"}
+
+
+def _end_of_day(dt: datetime) -> str:
+    return dt.replace(hour=23, minute=59, second=59, microsecond=999999).isoformat(timespec='microseconds')
+
+
+def _parse_term(term: str, default_months: int) -> str:
+    """Срок строки -> ISO-дата окончания. ValueError при неверном формате."""
+    term = term.strip()
+    if not term:
+        return _end_of_day(datetime.now() + relativedelta(months=default_months))
+    if term.isdigit():
+        months = int(term)
+        if months <= 0: raise ValueError("срок должен быть больше 0")
+        return _end_of_day(datetime.now() + relativedelta(months=months))
+    for fmt in ("%d.%m.%Y", "%Y-%m-%d"):
+        try: date = datetime.strptime(term, fmt)
+        except ValueError: continue
+        if date.date() < datetime.now().date(): raise ValueError("дата в прошлом")
+        return _end_of_day(date)
+    raise ValueError(f"не понял срок '{term}'")
+
+
+def parse_bulk_rows(content: str, default_months: int):
+    """
+    Разбирает вставленный список или CSV.
+    Возвращает (rows, errors): rows - список (name, expiry_date_str), errors - список (строка, ошибка).
+    """
+    lines = [line for line in content.splitlines() if line.strip()]
+    # Разделитель - первый встретившийся из ; TAB , (в столбце из одних имен его может не быть вовсе)
+    delimiter = next((d for d in (";", "\t", ",") if any(d in line for line in lines)), ",")
+    rows, errors, seen = [], [], set()
+    for number, record in enumerate(csv.reader(lines, delimiter=delimiter), start=1):
+        if not record or not record[0].strip(): continue
+        name = record[0].strip()
+        if number == 1 and name.lower() in _HEADER_NAMES: continue
+        if name in seen: errors.append((name, "повтор в списке")); continue
+        seen.add(name)
+        try: expiry = _parse_term(record[1] if len(record) > 1 else "", default_months)
+        except ValueError as e: errors.append((name, str(e))); continue
+        rows.append((name, expiry))
+    if len(rows) > BULK_MAX_ROWS:
+        errors.extend((name, f"превышен лимит {BULK_MAX_ROWS} строк") for name, _ in rows[BULK_MAX_ROWS:])
+        rows = rows[:BULK_MAX_ROWS]
+    return rows, errors
+
+
+def safe_filename(name: str) -> str:
+    return re.sub(r"[^\w.@-]+", "_", name) or "client"
+
+
+def unique_filenames(names) -> dict:
+    """{имя клиента: имя файла без расширения}; разные имена ("a b", "a/b", "a_b") не дают один файл."""
+    result, used = {}, set()
+    for name in names:
+        base = candidate = safe_filename(name)
+        n = 1
+        while candidate.lower() in used:
+            n += 1
+            candidate = f"{base}_{n}"
+        used.add(candidate.lower())
+        result[name] = candidate
+    return result
+
+
+async def provision_clients(rows: list, db_path: str, base_url: str, password: str, rejected: list = ()):
+    """
+    Создает клиентов из rows на сервере и в БД. rejected - строки, отброшенные
+    при разборе, (name, ошибка); они попадают в отчет.
+    Возвращает (zip_bytes, report): report - список (name, expiry, результат).
+    В report.csv архива у созданных клиентов указан еще файл конфига.
+    """
+    results = {name: None for name, _ in rows}
+    directory = await get_client_directory(base_url, password, fresh=True)
+    if directory is None or directory.stale:
+        return None, [(name, expiry, "Не удалось получить список клиентов.") for name, expiry in rows] + [(name, "", error) for name, error in rejected]
+    to_create = [(name, expiry) for name, expiry in rows if name not in directory.by_name]
+    for name, _ in rows:
+        if name in directory.by_name: results[name] = ClientExistsError(f"Клиент '{name}' уже есть на сервере.")
+
+    created = await create_clients_api([name for name, _ in to_create], base_url, password, concurrency=BULK_CONCURRENCY)
+    results.update({name: error for name, error in created.items() if error})
+    created_rows = [(name, expiry) for name, expiry in to_create if created.get(name) is None]
+
+    # В БД - только созданные на API, одной транзакцией
+    if created_rows and not await run_db(save_clients, db_path, created_rows):
+        for name, _ in created_rows: results[name] = "Создан на API, но не сохранен в БД."
+    for name, _ in created_rows:
+        await invalidate_client_artifacts(db_path, name)
+
+    directory = await get_client_directory(base_url, password)
+    semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+
+    async def _fetch(name: str):
+        client_data = directory.by_name.get(name) if directory is not None else None
+        if client_data is None: return name, None, None
+        async with semaphore:
+            config, qr_png, _ = await get_config_and_qr_by_id(client_data["id"], base_url, password)
+        return name, config, qr_png
+
+    fetched = await asyncio.gather(*(_fetch(name) for name, _ in created_rows))
+
+    buffer = io.BytesIO()
+    report = []
+    expiries = dict(rows)
+    filenames = unique_filenames(name for name, _, _ in fetched)
+    config_files = {}
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, config, qr_png in fetched:
+            filename = filenames[name]
+            if config:
+                archive.writestr(f"{filename}.conf", config)
+                config_files[name] = f"{filename}.conf"
+            if qr_png: archive.writestr(f"{filename}.png", qr_png)
+            if results[name] is None and not config: results[name] = "Создан, но конфиг не получен."
+        for name, _ in rows:
+            report.append((name, expiries[name], results[name] or "OK"))
+        report.extend((name, "", error) for name, error in rejected)
+        report_csv = io.StringIO()
+        writer = csv.writer(report_csv)
+        writer.writerow(["name", "expiry_date", "result", "config"])
+        writer.writerows((name, expiry, result, config_files.get(name, "")) for name, expiry, result in report)
+        archive.writestr("report.csv", report_csv.getvalue())
+    logging.info(f"Массовое создание на {base_url}: {len(created_rows)} из {len(rows)} создано.")
+    return buffer.getvalue(), report
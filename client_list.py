@@ -0,0 +1,136 @@
+import html
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+
+# === ПОСТРАНИЧНЫЙ СПИСОК КЛИЕНТОВ ===
+# Весь список - одно сообщение: PAGE_SIZE клиентов на странице, кнопки
+# листания, фильтры и сортировка. Навигация редактирует это же сообщение.
+# Состояние вида (страница, сортировка, фильтр) живет в callback_data:
+#   list:<страница>:<сортировка>:<фильтр>
+#   ltog:<страница>:<сортировка>:<фильтр>:<e|d>:<имя>  - вкл/выкл клиента из списка
+# Кнопка с именем клиента открывает его карточку (client_search) отдельным
+# сообщением - конфиг, QR, продление и удаление; список остается на месте:
+#   cl:open:<ключ сервера>:<имя>
+# На первой странице нет кнопки "назад", на последней - "вперед": нажатие
+# вернуло бы ту же страницу, а Telegram отклоняет такое редактирование.
+# Данные для страницы берутся из кэша списка клиентов API и локальной БД,
+# поэтому перелистывание стоит один edit_message_text. Фильтр ⏳ (срок истекает
+# в ближайшие EXPIRING_DAYS дней) - готовый набор имен из
+# database.get_expiring_clients (диапазон по индексу expiry_ts).
+
+PAGE_SIZE = 10
+EXPIRING_DAYS = 7
+CALLBACK_DATA_LIMIT = 64  # байт, ограничение Telegram
+
+SORTS = {"n": "имя", "e": "срок"}
+FILTERS = {
+    "all": "Все",
+    "on": "🟢",
+    "off": "🔴",
+    "exp": "⏳",
+    "miss": "❓",
+}
+
+
+def build_rows(db_clients: list, directory) -> list:
+    """Объединяет клиентов БД со статусами API. directory - ClientDirectory или None."""
+    rows = []
+    for name, expiry_date, db_status in db_clients:
+        api_client = directory.by_name.get(name) if directory is not None else None
+        rows.append({
+            "name": name,
+            "expiry_date": expiry_date,
+            "db_status": db_status,
+            "on_api": api_client is not None,
+            "enabled": api_client.get("enabled", True) if api_client else False,
+        })
+    return rows
+
+
+def _matches(row: dict, flt: str, api_available: bool, expiring: set) -> bool:
+    if flt == "on": return row["on_api"] and row["enabled"]
+    if flt == "off": return row["on_api"] and not row["enabled"]
+    if flt == "exp": return row["name"] in expiring
+    if flt == "miss": return api_available and not row["on_api"]
+    return True
+
+
+def filter_and_sort(rows: list, sort: str, flt: str, api_available: bool, expiring=()) -> list:
+    """expiring - имена клиентов с истекающим сроком (нужны только фильтру exp)."""
+    expiring = set(expiring)
+    selected = [r for r in rows if _matches(r, flt, api_available, expiring)]
+    if sort == "e":
+        # Без даты - в конец
+        selected.sort(key=lambda r: (r["expiry_date"] is None, r["expiry_date"] or "", r["name"]))
+    else:
+        selected.sort(key=lambda r: r["name"].lower())
+    return selected
+
+
+def _callback(data: str) -> str | None:
+    """callback_data или None, если строка не влезает в лимит Telegram."""
+    return data if len(data.encode("utf-8")) <= CALLBACK_DATA_LIMIT else None
+
+
+def render_page(rows: list, page: int, sort: str, flt: str, server_name: str, api_available: bool, stale: bool = False,
+                server_key: str = "", expiring=()):
+    """Возвращает (текст HTML, клавиатура) для страницы списка. expiring - см. filter_and_sort."""
+    sort = sort if sort in SORTS else "n"
+    flt = flt if flt in FILTERS else "all"
+    selected = filter_and_sort(rows, sort, flt, api_available, expiring)
+    pages = max(1, (len(selected) + PAGE_SIZE - 1) // PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    chunk = selected[page * PAGE_SIZE:(page + 1) * PAGE_SIZE]
+
+    on = sum(1 for r in rows if r["on_api"] and r["enabled"])
+    off = sum(1 for r in rows if r["on_api"] and not r["enabled"])
+    missing = sum(1 for r in rows if not r["on_api"]) if api_available else 0
+    lines = [
+        f"👥 <b>{html.escape(server_name)}</b>: {len(rows)} шт. (🟢 {on} · 🔴 {off} · ❓ {missing})",
+        f"Фильтр: {FILTERS[flt]} · Сортировка: {SORTS[sort]} · Стр. {page + 1}/{pages}",
+    ]
+    if not api_available: lines.append("⚠️ Ошибка API статусов.")
+    elif stale: lines.append("⚠️ API недоступен, статусы показаны из кэша.")
+    lines.append("")
+
+    keyboard = []
+    state = f"{page}:{sort}:{flt}"
+    for row in chunk:
+        if row["on_api"]: emoji = "🟢" if row["enabled"] else "🔴"
+        elif api_available: emoji = "❓"
+        else: emoji = "⚠️"
+        expiry_str = row["expiry_date"][:10] if row["expiry_date"] else "-"
+        lines.append(f"{emoji} <b>{html.escape(row['name'])}</b> — до <code>{expiry_str}</code>")
+        buttons = []
+        data = _callback(f"cl:open:{server_key}:{row['name']}")
+        if data: buttons.append(InlineKeyboardButton(f"👤 {row['name']}", callback_data=data))
+        if row["on_api"] and api_available and not stale:
+            enabled = row["enabled"]
+            data = _callback(f"ltog:{state}:{'d' if enabled else 'e'}:{row['name']}")
+            if data: buttons.append(InlineKeyboardButton("⏹️ Выкл" if enabled else "▶️ Вкл", callback_data=data))
+        if buttons: keyboard.append(buttons)
+    if not chunk: lines.append("<i>Нет клиентов под фильтр.</i>")
+
+    navigation = [InlineKeyboardButton(f"🔄 {page + 1}/{pages}", callback_data=f"list:{page}:{sort}:{flt}")]
+    if page > 0: navigation.insert(0, InlineKeyboardButton("⬅️", callback_data=f"list:{page - 1}:{sort}:{flt}"))
+    if page < pages - 1: navigation.append(InlineKeyboardButton("➡️", callback_data=f"list:{page + 1}:{sort}:{flt}"))
+    keyboard.append(navigation)
+    keyboard.append([
+        InlineKeyboardButton(f"• {label}" if key == flt else label, callback_data=f"list:0:{sort}:{key}")
+        for key, label in FILTERS.items()
+    ])
+    other_sort = "e" if sort == "n" else "n"
+    keyboard.append([InlineKeyboardButton(f"↕️ Сортировать: {SORTS[other_sort]}", callback_data=f"list:0:{other_sort}:{flt}")])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+
+def parse_list_callback(data: str):
+    """Разбирает list:/ltog: callback. Возвращает (page, sort, flt, toggle, name) или None."""
+    parts = data.split(":", 5)
+    try:
+        page = int(parts[1]); sort = parts[2]; flt = parts[3]
+    except (IndexError, ValueError):
+        return None
+    if parts[0] == "ltog":
+        if len(parts) != 6 or parts[4] not in ("e", "d"): return None
+        return page, sort, flt, parts[4] == "e", parts[5]
+    return page, sort, flt, None, None
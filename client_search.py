@@ -0,0 +1,101 @@
+import html
+
+from telegram import (
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
+
+from client_list import CALLBACK_DATA_LIMIT
+
+# === ПОИСК КЛИЕНТА (INLINE-РЕЖИМ) ===
+# "@бот часть_имени" в чате с ботом подсказывает клиентов выбранного сервера
+# (database.search_clients, индекс clients_fts) - без запросов к API, только
+# статус и срок из БД. Выбранный результат отправляется в чат сообщением
+# "👤 <имя>", на которое бот отвечает карточкой клиента с кнопками действий:
+#   cl:<действие>:<ключ сервера>:<имя>
+# Ключ сервера в callback_data: кнопки старой карточки действуют на свой
+# сервер, даже если пользователь уже выбрал другой. Действие open (кнопка
+# клиента в списке) присылает карточку новым сообщением, остальные
+# редактируют саму карточку.
+
+INLINE_CACHE_TIME = 5  # с, результаты зависят от сервера пользователя и меняются
+CARD_PREFIX = "👤 "
+EXTEND_MONTHS = (1, 6, 12)
+CARD_ACTIONS = {"open", "card", "cfg", "qr", "on", "off", "del", "delok"} | {f"ext{m}" for m in EXTEND_MONTHS}
+
+
+def _status_emoji(status: str | None) -> str:
+    return "🔴" if status == "disabled" else "🟢"
+
+
+def build_inline_results(rows: list, server_name: str) -> list:
+    """Результаты inline-запроса из строк БД (name, expiry_date, status)."""
+    results = []
+    for i, (name, expiry_date, status) in enumerate(rows):
+        expiry_str = expiry_date[:10] if expiry_date else "-"
+        results.append(InlineQueryResultArticle(
+            id=str(i),
+            title=name,
+            description=f"{_status_emoji(status)} {status or 'enabled'} · до {expiry_str} · {server_name}",
+            input_message_content=InputTextMessageContent(f"{CARD_PREFIX}{name}"),
+        ))
+    return results
+
+
+def parse_card_message(text: str | None) -> str | None:
+    """Имя клиента из сообщения, отправленного через inline-поиск, или None."""
+    if not text or not text.startswith(CARD_PREFIX):
+        return None
+    return text[len(CARD_PREFIX):].strip() or None
+
+
+def _button(label: str, action: str, server_key: str, name: str) -> InlineKeyboardButton | None:
+    data = f"cl:{action}:{server_key}:{name}"
+    return InlineKeyboardButton(label, callback_data=data) if len(data.encode("utf-8")) <= CALLBACK_DATA_LIMIT else None
+
+
+def _keyboard(rows: list) -> InlineKeyboardMarkup:
+    """Клавиатура без кнопок, чьи callback_data не влезли в лимит."""
+    keyboard = [[b for b in row if b] for row in rows]
+    return InlineKeyboardMarkup([row for row in keyboard if row])
+
+
+def render_card(server: dict, name: str, db_row, api_client, api_available: bool, note: str | None = None):
+    """
+    Карточка клиента: (текст HTML, клавиатура). db_row - (name, expiry_date, status)
+    или None, api_client - клиент из списка API или None.
+    """
+    key = server["key"]
+    if api_client: emoji, status = ("🟢", "enabled") if api_client.get("enabled", True) else ("🔴", "disabled")
+    elif api_available: emoji, status = "❓", "нет на API"
+    else: emoji, status = "⚠️", "API N/A"
+    expiry_str = db_row[1][:10] if db_row and db_row[1] else "-"
+    lines = [
+        f"{emoji} <b>{html.escape(name)}</b> · {html.escape(server['name'])}",
+        f"📌 Статус: <b>{status}</b>",
+        f"⏳ До: <code>{expiry_str}</code>" if db_row else "⏳ <i>нет в БД</i>",
+    ]
+    if note: lines += ["", f"<i>{html.escape(note)}</i>"]
+    rows = [
+        [_button("📄 Конфиг", "cfg", key, name), _button("🇶 QR", "qr", key, name)],
+        [_button(f"⏳ +{m} мес", f"ext{m}", key, name) for m in EXTEND_MONTHS] if db_row else [],
+        [_button("⏹️ Выкл", "off", key, name) if api_client.get("enabled", True) else _button("▶️ Вкл", "on", key, name)] if api_client else [],
+        [_button("🗑️ Удалить", "del", key, name), _button("🔄", "card", key, name)],
+    ]
+    return "\n".join(lines), _keyboard(rows)
+
+
+def render_delete_confirm(server: dict, name: str):
+    """Подтверждение удаления из карточки."""
+    text = f"🗑️ Удалить <b>{html.escape(name)}</b> с {html.escape(server['name'])} (API и БД)?"
+    return text, _keyboard([[_button("✅ Да, удалить", "delok", server["key"], name), _button("↩️ Отмена", "card", server["key"], name)]])
+
+
+def parse_card_callback(data: str):
+    """Разбирает cl: callback. Возвращает (действие, ключ сервера, имя) или None."""
+    parts = data.split(":", 3)
+    if len(parts) != 4 or parts[0] != "cl" or parts[1] not in CARD_ACTIONS or not parts[3]:
+        return None
+    return parts[1], parts[2], parts[3]
@@ -0,0 +1,60 @@
+"""
+Перенос БД серверов из отдельных файлов (DB_DIR/<key>.db) в одну общую БД.
+
+Для каждого сервера из реестра (SERVERS_FILE или SERVER<N>_*) данные его
+файла копируются в общий файл со своим server_key; повторный запуск заменяет
+строки сервера, а не дублирует их. Исходные файлы не удаляются (они только
+доводятся до последней схемы). После переноса укажите DB_FILE в .env и
+перезапустите бота.
+
+Запуск (бот лучше остановить):
+  python consolidate_db.py                      # в DB_FILE или DB_DIR/wg.db
+  python consolidate_db.py --db-file db/all.db --keys germany usa
+"""
+import os
+import sys
+import logging
+import argparse
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from database import import_server_db, scoped_db_path, close_all_connections  # noqa: E402
+from servers import configure, server_db_file  # noqa: E402
+
+
+def main(arguments) -> int:
+    db_dir = os.getenv("DB_DIR", "db")
+    db_file = arguments.db_file or os.getenv("DB_FILE") or os.path.join(db_dir, "wg.db")
+    servers = configure(db_dir)
+    keys = arguments.keys or list(servers)
+    unknown = [key for key in keys if key not in servers]
+    if unknown:
+        print(f"Нет в реестре серверов: {', '.join(unknown)}")
+        return 1
+    imported = 0
+    try:
+        for key in keys:
+            source = server_db_file(db_dir, key)
+            if not os.path.exists(source):
+                print(f"{key}: файла {source} нет, пропущен")
+                continue
+            if os.path.abspath(source) == os.path.abspath(db_file):
+                print(f"{key}: {source} и есть общая БД, пропущен")
+                continue
+            counts = import_server_db(scoped_db_path(db_file, key), source)
+            print(f"{key}: {source} -> {db_file}: " + ", ".join(f"{table} {count}" for table, count in counts.items()))
+            imported += 1
+    finally:
+        close_all_connections()
+    print(f"Перенесено серверов: {imported}. Для работы с общей БД задайте DB_FILE={db_file}")
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Перенос БД серверов в одну общую БД (DB_FILE)")
+    parser.add_argument("--db-file", help="общая БД (по умолчанию DB_FILE или DB_DIR/wg.db)")
+    parser.add_argument("--keys", nargs="+", help="ключи серверов (по умолчанию все из реестра)")
+    sys.exit(main(parser.parse_args()))
@@ -1,47 +1,450 @@
+import os
+import re
+import json
+import time
 import sqlite3
+import asyncio
 import logging
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import calendar
+from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
 
-# Убираем глобальный DB_FILE
+from metrics import observe, timer
 
 # Настройка логгирования (лучше делать в основном файле, но можно и здесь для модуля)
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+# === ПУЛ СОЕДИНЕНИЙ ===
+# На каждый db_path держим одно долгоживущее соединение в режиме WAL.
+# Все функции модуля синхронные; из async-обработчиков их вызывают через
+# run_db(), который выполняет их в отдельном потоке БД и не блокирует event loop.
+# sqlite3 кэширует скомпилированные запросы на соединении (cached_statements),
+# поэтому SQL держим в константах - один и тот же текст переиспользует prepared statement.
+#
+# === ОДНА БД НА ВСЕ СЕРВЕРЫ ===
+# Во всех таблицах есть server_key, и каждый запрос ограничен им. Обычно у
+# сервера свой файл (DB_DIR/<key>.db), и server_key там пустой. В режиме
+# общей БД (DB_FILE) db_path сервера имеет вид "<файл>#<key>": соединение одно
+# на файл, а функции модуля работают с тем же API, но только со строками
+# своего сервера. Индексы начинаются с server_key - (server_key, name),
+# (server_key, expiry_ts) и т.д., - так что запросы одного сервера не
+# просматривают чужие строки, а общие запросы (get_clients_for_servers)
+# выполняются одним SELECT на файл. Перенос старых файлов - import_server_db
+# (скрипт consolidate_db.py).
+
+STATEMENT_CACHE_SIZE = 256
+SCOPE_SEPARATOR = "#"
+SERVER_KEY_PATTERN = re.compile(r"[\w.-]+")  # ключ сервера без SCOPE_SEPARATOR и пробелов
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",     # в WAL безопасно и заметно быстрее FULL
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",       # ~8 МБ кэша страниц
+    "PRAGMA foreign_keys=ON",
+    # INSERT OR REPLACE удаляет старую строку с DELETE-триггерами - иначе индекс
+    # поиска clients_fts остался бы с записью удаленной строки
+    "PRAGMA recursive_triggers=ON",
+)
+
+_connections: dict[str, sqlite3.Connection] = {}
+_connection_locks: dict[str, threading.RLock] = {}
+_registry_lock = threading.Lock()
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+SQL_UPSERT_CLIENT = "INSERT OR REPLACE INTO clients (server_key, name, expiry_date, status) VALUES (?, ?, ?, ?)"
+SQL_SELECT_ALL = "SELECT name, expiry_date, status FROM clients WHERE server_key = ? ORDER BY name"
+SQL_SELECT_ALL_FOR_KEYS = ("SELECT server_key, name, expiry_date, status FROM clients "
+                           "WHERE server_key IN (SELECT value FROM json_each(?)) ORDER BY server_key, name")
+SQL_SELECT_BY_NAME = "SELECT name, expiry_date, status FROM clients WHERE server_key = ? AND name = ?"
+SQL_DELETE_BY_NAME = "DELETE FROM clients WHERE server_key = ? AND name = ?"
+SQL_UPDATE_STATUS = "UPDATE clients SET status = ? WHERE server_key = ? AND name = ?"
+SQL_SELECT_EXPIRY = "SELECT expiry_date FROM clients WHERE server_key = ? AND name = ?"
+SQL_UPDATE_EXPIRY = "UPDATE clients SET expiry_date = ? WHERE server_key = ? AND name = ?"
+SQL_SELECT_EXPIRED = "SELECT name FROM clients WHERE server_key = ? AND expiry_ts <= ?"
+SQL_SELECT_EXPIRED_BY_STATUS = "SELECT name FROM clients WHERE server_key = ? AND status = ? AND expiry_ts <= ? ORDER BY expiry_ts"
+SQL_SELECT_EXPIRING = ("SELECT name, expiry_date, status FROM clients WHERE server_key = ? AND expiry_ts > ? AND expiry_ts <= ? "
+                       "ORDER BY expiry_ts")
+SQL_SELECT_EXPIRING_BY_STATUS = ("SELECT name, expiry_date, status FROM clients "
+                                 "WHERE server_key = ? AND status = ? AND expiry_ts > ? AND expiry_ts <= ? ORDER BY expiry_ts")
+
+ARTIFACT_COLUMNS = ("client_id", "client_name", "config_hash", "config", "qr_png",
+                    "config_file_id", "qr_file_id", "api_updated_at", "fetched_at")
+SQL_SELECT_ARTIFACT = f"SELECT {', '.join(ARTIFACT_COLUMNS)} FROM artifacts WHERE server_key = ? AND client_id = ?"
+SQL_UPSERT_ARTIFACT = (f"INSERT OR REPLACE INTO artifacts (server_key, {', '.join(ARTIFACT_COLUMNS)}) "
+                       f"VALUES ({', '.join('?' * (len(ARTIFACT_COLUMNS) + 1))})")
+SQL_DELETE_ARTIFACTS_BY_NAME = "DELETE FROM artifacts WHERE server_key = ? AND client_name = ?"
+# Одним запросом для любого количества имен: список передается JSON-массивом
+SQL_UPDATE_STATUS_MANY = ("UPDATE clients SET status = ? WHERE server_key = ? AND status != ? "
+                          "AND name IN (SELECT value FROM json_each(?))")
+SQL_SELECT_BY_NAMES = "SELECT name, expiry_date, status FROM clients WHERE server_key = ? AND name IN (SELECT value FROM json_each(?))"
+SQL_DELETE_BY_NAMES = "DELETE FROM clients WHERE server_key = ? AND name IN (SELECT value FROM json_each(?))"
+
+# Поиск по имени: от 3 символов - подстрока через триграммный FTS5-индекс,
+# короче - префикс по первичному ключу (диапазон name >= ? AND name < ?).
+# Подстрочный запрос не сортирует: FTS5 отдает совпадения в порядке rowid, и
+# SQLite останавливается на LIMIT, не читая остальные совпадения широкого
+# запроса ("peer" на 50k клиентов). Порядок (сначала имена, начинающиеся с
+# запроса) наводит search_clients: префиксный запрос идет первым. CROSS JOIN
+# держит FTS во внешнем цикле - иначе планировщик перебирает клиентов сервера
+# по индексу server_key и для каждого ищет в FTS. В общей БД (DB_FILE) индекс
+# общий, и до LIMIT могут пройти совпадения других серверов.
+SEARCH_LIMIT = 20
+SQL_SEARCH_SUBSTRING = ("SELECT c.name, c.expiry_date, c.status FROM clients_fts f CROSS JOIN clients c ON c.rowid = f.rowid "
+                        "WHERE clients_fts MATCH ? AND c.server_key = ? LIMIT ?")
+SQL_SEARCH_PREFIX = ("SELECT name, expiry_date, status FROM clients WHERE server_key = ? AND name >= ? AND name < ? "
+                     "ORDER BY name LIMIT ?")
+
+SQL_SELECT_SNAPSHOT = "SELECT client_id, name, enabled, updated_at FROM api_snapshot WHERE server_key = ?"
+SQL_UPSERT_SNAPSHOT = ("INSERT OR REPLACE INTO api_snapshot (server_key, client_id, name, enabled, updated_at) "
+                       "VALUES (?, ?, ?, ?, ?)")
+SQL_DELETE_SNAPSHOT = "DELETE FROM api_snapshot WHERE server_key = ? AND client_id = ?"
+SQL_SELECT_CHANGES = "SELECT seq, name FROM client_changes WHERE server_key = ? ORDER BY seq"
+SQL_DELETE_CHANGES = "DELETE FROM client_changes WHERE server_key = ? AND seq <= ?"
+SQL_SELECT_STATE = "SELECT value FROM reconcile_state WHERE server_key = ? AND key = ?"
+SQL_UPSERT_STATE = "INSERT OR REPLACE INTO reconcile_state (server_key, key, value) VALUES (?, ?, ?)"
+SQL_SELECT_ISSUES = "SELECT name, kind, detail, detected_at FROM reconcile_issues WHERE server_key = ? ORDER BY kind, name"
+SQL_SELECT_ISSUES_BY_NAMES = ("SELECT name, kind FROM reconcile_issues "
+                              "WHERE server_key = ? AND name IN (SELECT value FROM json_each(?))")
+SQL_DELETE_ISSUES_BY_NAMES = "DELETE FROM reconcile_issues WHERE server_key = ? AND name IN (SELECT value FROM json_each(?))"
+SQL_UPSERT_ISSUE = ("INSERT INTO reconcile_issues (server_key, name, kind, detail) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(server_key, name) DO UPDATE SET detail = excluded.detail, "
+                    "detected_at = CASE WHEN kind = excluded.kind THEN detected_at ELSE CURRENT_TIMESTAMP END, kind = excluded.kind")
+
+# Телеметрия трафика (telemetry.py). Время - секунды Unix (UTC), корзины -
+# начало часа/суток; счетчики добавляются UPSERT-ом без чтения строки.
+SQL_SELECT_TRAFFIC_LAST = "SELECT client_id, rx, tx FROM traffic_last WHERE server_key = ?"
+SQL_UPSERT_TRAFFIC_LAST = ("INSERT INTO traffic_last (server_key, client_id, name, rx, tx, handshake_at, active_at) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                           "ON CONFLICT(server_key, client_id) DO UPDATE SET name = excluded.name, rx = excluded.rx, tx = excluded.tx, "
+                           "handshake_at = excluded.handshake_at, active_at = COALESCE(excluded.handshake_at, active_at)")
+SQL_DELETE_TRAFFIC_LAST_MISSING = ("DELETE FROM traffic_last WHERE server_key = ? "
+                                   "AND client_id NOT IN (SELECT value FROM json_each(?))")
+TRAFFIC_TABLES = ("traffic_raw", "traffic_hourly", "traffic_daily")
+SQL_ADD_TRAFFIC = {table: (f"INSERT INTO {table} (server_key, bucket, name, rx, tx) VALUES (?, ?, ?, ?, ?) "
+                           f"ON CONFLICT(server_key, bucket, name) DO UPDATE SET rx = rx + excluded.rx, tx = tx + excluded.tx")
+                   for table in TRAFFIC_TABLES}
+SQL_PRUNE_TRAFFIC = {table: f"DELETE FROM {table} WHERE server_key = ? AND bucket < ?" for table in TRAFFIC_TABLES}
+SQL_TOP_TALKERS = {table: (f"SELECT name, SUM(rx), SUM(tx) FROM {table} WHERE server_key = ? AND bucket >= ? "
+                           f"GROUP BY name ORDER BY SUM(rx) + SUM(tx) DESC LIMIT ?")
+                   for table in TRAFFIC_TABLES}
+SQL_SELECT_INACTIVE = ("SELECT name, handshake_at, active_at FROM traffic_last WHERE server_key = ? AND active_at < ? "
+                       "ORDER BY active_at LIMIT ?")
+SQL_COUNT_INACTIVE = "SELECT COUNT(*) FROM traffic_last WHERE server_key = ? AND active_at < ?"
+
+# Состояние диалогов администраторов (persistence.py) - отдельный файл, не БД сервера
+SQL_CREATE_USER_STATE = ("CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, "
+                         "updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+SQL_SELECT_USER_STATE = "SELECT data FROM user_state WHERE user_id = ?"
+SQL_UPSERT_USER_STATE = ("INSERT INTO user_state (user_id, data) VALUES (?, ?) "
+                         "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP")
+SQL_DELETE_USER_STATE = "DELETE FROM user_state WHERE user_id = ?"
+
+
+def scoped_db_path(db_file: str, server_key: str) -> str:
+    """db_path сервера server_key в общей БД db_file."""
+    if not SERVER_KEY_PATTERN.fullmatch(server_key):
+        raise ValueError(f"Некорректный ключ сервера: {server_key!r}")
+    return f"{db_file}{SCOPE_SEPARATOR}{server_key}"
+
+
+def _scope(db_path: str) -> tuple[str, str]:
+    """(файл БД, server_key) для db_path; у отдельного файла сервера server_key пустой."""
+    db_file, sep, server_key = db_path.rpartition(SCOPE_SEPARATOR)
+    if sep and db_file and SERVER_KEY_PATTERN.fullmatch(server_key):
+        return db_file, server_key
+    return db_path, ""
+
+
+def _key(db_path: str) -> str:
+    return _scope(db_path)[1]
+
+
+def _open_connection(db_path: str) -> sqlite3.Connection:
+    # isolation_level=None - автокоммит для одиночных запросов, транзакции открываем явно
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None,
+                           cached_statements=STATEMENT_CACHE_SIZE)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+@contextmanager
+def _connection(db_path: str):
+    """Выдает долгоживущее соединение для db_path с эксклюзивным доступом на время блока."""
+    db_path = _scope(db_path)[0]  # серверы общей БД делят одно соединение
+    with _registry_lock:
+        lock = _connection_locks.setdefault(db_path, threading.RLock())
+    with lock:
+        conn = _connections.get(db_path)
+        if conn is None:
+            conn = _open_connection(db_path)
+            _connections[db_path] = conn
+        yield conn
+
+
+@contextmanager
+def transaction(db_path: str):
+    """Явная транзакция: все запросы внутри блока коммитятся одним COMMIT (или откатываются)."""
+    with _connection(db_path) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+def close_all_connections() -> None:
+    """Закрывает все соединения (при остановке бота)."""
+    with _registry_lock:
+        paths = list(_connections)
+    for db_path in paths:
+        with _connection(db_path) as conn:
+            conn.close()
+            _connections.pop(db_path, None)
+
+
+async def run_db(func, *args, **kwargs):
+    """Выполняет функцию модуля в потоке БД, не блокируя event loop."""
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+
+    def _call():
+        # Отдельно ожидание потока БД и само выполнение: видно, SQLite медленный или очередь
+        observe("db_queue_wait_seconds", time.perf_counter() - submitted)
+        with timer("db_call_duration_seconds", errors="db_call_errors_total", function=func.__name__):
+            return func(*args, **kwargs)
+
+    return await loop.run_in_executor(_db_executor, _call)
+
+
+# === МИГРАЦИИ СХЕМЫ ===
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция - список SQL,
+# выполняемый в одной транзакции вместе с обновлением версии; init_db при старте
+# доводит любой существующий файл до последней версии.
+#
+# expiry_date остается ISO-строкой (ее показывает бот), а для запросов по срокам
+# есть вычисляемая колонка expiry_ts - секунды "настенного" времени, как если бы
+# локальное время было UTC (см. _to_wall_clock_ts). Дробная часть секунд
+# отбрасывается, чтобы .999999 не округлялось до следующей секунды.
+def _add_server_key(table: str, columns: list, primary_key: str, keep_rowid: bool = False, suffix: str = "") -> list:
+    """
+    SQL пересоздания таблицы с колонкой server_key в начале первичного ключа
+    (SQLite не меняет первичный ключ через ALTER TABLE). Данные копируются с
+    server_key = '', keep_rowid сохраняет rowid (на него ссылается clients_fts).
+    """
+    copied = ", ".join(c.split()[0] for c in columns if "GENERATED" not in c)
+    rowid = "rowid, " if keep_rowid else ""
+    return [
+        f"CREATE TABLE {table}_new (server_key TEXT NOT NULL DEFAULT '', {', '.join(columns)}, "
+        f"PRIMARY KEY (server_key, {primary_key})){suffix}",
+        f"INSERT INTO {table}_new ({rowid}{copied}) SELECT {rowid}{copied} FROM {table}",
+        f"DROP TABLE {table}",
+        f"ALTER TABLE {table}_new RENAME TO {table}",
+    ]
+
+
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS clients (
+            name TEXT PRIMARY KEY,
+            expiry_date TEXT,
+            status TEXT CHECK(status IN ('enabled', 'disabled')) DEFAULT 'enabled',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (2, [
+        "ALTER TABLE clients ADD COLUMN expiry_ts INTEGER GENERATED ALWAYS AS "
+        "(CAST(strftime('%s', substr(expiry_date, 1, 19)) AS INTEGER)) VIRTUAL",
+        "DROP INDEX IF EXISTS idx_clients_status_expiry",
+        "CREATE INDEX IF NOT EXISTS idx_clients_expiry_ts ON clients (expiry_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_status_expiry_ts ON clients (status, expiry_ts)",
+    ]),
+    (3, [
+        # Кэш конфигов/QR: ключ - id клиента на wg-easy, config_hash - sha256 конфига.
+        # file_id Telegram привязаны к хэшу: сменился конфиг - старые file_id сбрасываются.
+        """
+        CREATE TABLE IF NOT EXISTS artifacts (
+            client_id TEXT PRIMARY KEY,
+            client_name TEXT NOT NULL,
+            config_hash TEXT NOT NULL,
+            config TEXT NOT NULL,
+            qr_png BLOB,
+            config_file_id TEXT,
+            qr_file_id TEXT,
+            api_updated_at TEXT,
+            fetched_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_artifacts_client_name ON artifacts (client_name)",
+    ]),
+    (4, [
+        # Сверка БД с API (reconcile.py): последний виденный список клиентов wg-easy,
+        # журнал изменений таблицы clients (пишется триггерами) и открытые расхождения.
+        """
+        CREATE TABLE IF NOT EXISTS api_snapshot (
+            client_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            enabled INTEGER NOT NULL,
+            updated_at TEXT
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS client_changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL)",
+        # INSERT OR REPLACE (recursive_triggers) пишет имя дважды - через DELETE и INSERT, сверке это не мешает
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_insert AFTER INSERT ON clients "
+        "BEGIN INSERT INTO client_changes (name) VALUES (NEW.name); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_update AFTER UPDATE OF name, status ON clients "
+        "BEGIN INSERT INTO client_changes (name) VALUES (OLD.name); "
+        "INSERT INTO client_changes (name) SELECT NEW.name WHERE NEW.name != OLD.name; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_delete AFTER DELETE ON clients "
+        "BEGIN INSERT INTO client_changes (name) VALUES (OLD.name); END",
+        """
+        CREATE TABLE IF NOT EXISTS reconcile_issues (
+            name TEXT PRIMARY KEY,
+            kind TEXT NOT NULL CHECK(kind IN ('missing_on_api', 'missing_in_db', 'status_mismatch')),
+            detail TEXT,
+            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS reconcile_state (key TEXT PRIMARY KEY, value TEXT)",
+    ]),
+    (5, [
+        # Поиск клиентов по части имени (inline-режим): триграммный FTS5-индекс
+        # поверх clients (external content - имена не дублируются), обновляется триггерами
+        "CREATE VIRTUAL TABLE IF NOT EXISTS clients_fts USING fts5(name, content='clients', content_rowid='rowid', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_fts_insert AFTER INSERT ON clients "
+        "BEGIN INSERT INTO clients_fts (rowid, name) VALUES (NEW.rowid, NEW.name); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_fts_delete AFTER DELETE ON clients "
+        "BEGIN INSERT INTO clients_fts (clients_fts, rowid, name) VALUES ('delete', OLD.rowid, OLD.name); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_fts_update AFTER UPDATE OF name ON clients "
+        "BEGIN INSERT INTO clients_fts (clients_fts, rowid, name) VALUES ('delete', OLD.rowid, OLD.name); "
+        "INSERT INTO clients_fts (rowid, name) VALUES (NEW.rowid, NEW.name); END",
+        "INSERT INTO clients_fts (clients_fts) VALUES ('rebuild')",
+    ]),
+    (6, [
+        # Телеметрия: последние счетчики пиров с API (для дельт и "неактивных") и
+        # дельты трафика по корзинам: сырые (интервал сбора), часовые и суточные.
+        # active_at - последнее рукопожатие, а если его не было - первое появление на API.
+        """
+        CREATE TABLE IF NOT EXISTS traffic_last (
+            client_id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            rx INTEGER NOT NULL,
+            tx INTEGER NOT NULL,
+            handshake_at INTEGER,
+            active_at INTEGER NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_traffic_last_active_at ON traffic_last (active_at)",
+        *(f"CREATE TABLE IF NOT EXISTS {table} (bucket INTEGER NOT NULL, name TEXT NOT NULL, rx INTEGER NOT NULL, "
+          f"tx INTEGER NOT NULL, PRIMARY KEY (bucket, name)) WITHOUT ROWID"
+          for table in ("traffic_raw", "traffic_hourly", "traffic_daily")),
+    ]),
+    (7, [
+        # server_key во всех таблицах (см. "ОДНА БД НА ВСЕ СЕРВЕРЫ"). DROP TABLE
+        # удаляет и индексы с триггерами clients - они создаются заново с server_key.
+        *_add_server_key("clients", [
+            "name TEXT NOT NULL",
+            "expiry_date TEXT",
+            "status TEXT CHECK(status IN ('enabled', 'disabled')) DEFAULT 'enabled'",
+            "created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+            "expiry_ts INTEGER GENERATED ALWAYS AS (CAST(strftime('%s', substr(expiry_date, 1, 19)) AS INTEGER)) VIRTUAL",
+        ], "name", keep_rowid=True),
+        "CREATE INDEX IF NOT EXISTS idx_clients_expiry_ts ON clients (server_key, expiry_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_clients_status_expiry_ts ON clients (server_key, status, expiry_ts)",
+        "ALTER TABLE client_changes ADD COLUMN server_key TEXT NOT NULL DEFAULT ''",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_insert AFTER INSERT ON clients "
+        "BEGIN INSERT INTO client_changes (server_key, name) VALUES (NEW.server_key, NEW.name); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_update AFTER UPDATE OF name, status ON clients "
+        "BEGIN INSERT INTO client_changes (server_key, name) VALUES (OLD.server_key, OLD.name); "
+        "INSERT INTO client_changes (server_key, name) SELECT NEW.server_key, NEW.name WHERE NEW.name != OLD.name; END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_delete AFTER DELETE ON clients "
+        "BEGIN INSERT INTO client_changes (server_key, name) VALUES (OLD.server_key, OLD.name); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_fts_insert AFTER INSERT ON clients "
+        "BEGIN INSERT INTO clients_fts (rowid, name) VALUES (NEW.rowid, NEW.name); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_fts_delete AFTER DELETE ON clients "
+        "BEGIN INSERT INTO clients_fts (clients_fts, rowid, name) VALUES ('delete', OLD.rowid, OLD.name); END",
+        "CREATE TRIGGER IF NOT EXISTS trg_clients_fts_update AFTER UPDATE OF name ON clients "
+        "BEGIN INSERT INTO clients_fts (clients_fts, rowid, name) VALUES ('delete', OLD.rowid, OLD.name); "
+        "INSERT INTO clients_fts (rowid, name) VALUES (NEW.rowid, NEW.name); END",
+        "INSERT INTO clients_fts (clients_fts) VALUES ('rebuild')",
+        *_add_server_key("artifacts", [
+            "client_id TEXT NOT NULL",
+            "client_name TEXT NOT NULL",
+            "config_hash TEXT NOT NULL",
+            "config TEXT NOT NULL",
+            "qr_png BLOB",
+            "config_file_id TEXT",
+            "qr_file_id TEXT",
+            "api_updated_at TEXT",
+            "fetched_at REAL NOT NULL",
+        ], "client_id"),
+        "CREATE INDEX IF NOT EXISTS idx_artifacts_client_name ON artifacts (server_key, client_name)",
+        *_add_server_key("api_snapshot", ["client_id TEXT NOT NULL", "name TEXT NOT NULL", "enabled INTEGER NOT NULL",
+                                          "updated_at TEXT"], "client_id"),
+        *_add_server_key("reconcile_issues", [
+            "name TEXT NOT NULL",
+            "kind TEXT NOT NULL CHECK(kind IN ('missing_on_api', 'missing_in_db', 'status_mismatch'))",
+            "detail TEXT",
+            "detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+        ], "name"),
+        *_add_server_key("reconcile_state", ["key TEXT NOT NULL", "value TEXT"], "key"),
+        *_add_server_key("traffic_last", ["client_id TEXT NOT NULL", "name TEXT NOT NULL", "rx INTEGER NOT NULL",
+                                          "tx INTEGER NOT NULL", "handshake_at INTEGER", "active_at INTEGER NOT NULL"], "client_id"),
+        "CREATE INDEX IF NOT EXISTS idx_traffic_last_active_at ON traffic_last (server_key, active_at)",
+        *(statement for table in ("traffic_raw", "traffic_hourly", "traffic_daily")
+          for statement in _add_server_key(table, ["bucket INTEGER NOT NULL", "name TEXT NOT NULL", "rx INTEGER NOT NULL",
+                                                   "tx INTEGER NOT NULL"], "bucket, name", suffix=" WITHOUT ROWID")),
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def _to_wall_clock_ts(dt: datetime) -> int:
+    """Переводит наивное локальное время в секунды в той же шкале, что и expiry_ts."""
+    return calendar.timegm(dt.timetuple())
+
+
+def _migrate(db_path: str) -> int:
+    """Применяет недостающие миграции. Возвращает итоговую версию схемы."""
+    with _connection(db_path) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in MIGRATIONS:
+            if target <= version:
+                continue
+            with transaction(db_path) as tx:
+                for sql in statements:
+                    tx.execute(sql)
+                tx.execute(f"PRAGMA user_version = {target}")
+            logging.info(f"БД '{db_path}': схема обновлена с версии {version} до {target}.")
+            version = target
+        return version
+
+
 def init_db(db_path: str):
-    """Инициализирует БД по указанному пути, создает таблицу, если её нет."""
+    """Инициализирует БД по указанному пути: создает таблицы и применяет миграции."""
     try:
         # Убедимся, что директория существует (если db_path включает директорию)
-        import os
-        db_dir = os.path.dirname(db_path)
+        db_dir = os.path.dirname(_scope(db_path)[0])
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir)
             logging.info(f"Создана директория для БД: {db_dir}")
 
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        # Схема: name - уникальный ключ, expiry_date - текст (ISO), status - текст
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS clients (
-                name TEXT PRIMARY KEY,
-                expiry_date TEXT,
-                status TEXT CHECK(status IN ('enabled', 'disabled')) DEFAULT 'enabled',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Можно добавить индексы для ускорения поиска, если клиентов много
-        # cursor.execute("CREATE INDEX IF NOT EXISTS idx_clients_name ON clients (name);")
-        conn.commit()
-        logging.info(f"База данных '{db_path}' успешно инициализирована/проверена.")
+        version = _migrate(db_path)
+        logging.info(f"База данных '{db_path}' успешно инициализирована/проверена (схема v{version}).")
     except sqlite3.Error as e:
         logging.error(f"Ошибка SQLite при инициализации '{db_path}': {e}")
         raise  # Пробрасываем ошибку выше
     except OSError as e:
         logging.error(f"Ошибка ОС при создании директории/файла БД '{db_path}': {e}")
         raise
-    finally:
-        if conn:
-            conn.close()
 
 def save_client(db_path: str, name: str, expiry_date_str: str | None) -> bool:
     """
@@ -49,106 +452,117 @@ def save_client(db_path: str, name: str, expiry_date_str: str | None) -> bool:
     Использует переданную строку expiry_date_str (может быть None).
     Устанавливает статус 'enabled'. Возвращает True при успехе.
     """
-    # Расчет даты убран отсюда, она передается готовой строкой
     status = "enabled" # Всегда enabled при создании/замене
-
-    conn = None
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        # INSERT OR REPLACE заменит строку, если name уже существует
-        cursor.execute("INSERT OR REPLACE INTO clients (name, expiry_date, status) VALUES (?, ?, ?)",
-                       (name, expiry_date_str, status)) # Передаем expiry_date_str
-        conn.commit()
+        with transaction(db_path) as conn:
+            # INSERT OR REPLACE заменит строку, если name уже существует
+            conn.execute(SQL_UPSERT_CLIENT, (_key(db_path), name, expiry_date_str, status))
         logging.info(f"Клиент '{name}' сохранен/заменен в '{db_path}'. Срок: {expiry_date_str or 'не указан'}, Статус: {status}")
         return True
     except sqlite3.Error as e:
         logging.error(f"Ошибка SQLite при сохранении '{name}' в '{db_path}': {e}")
-        if conn: conn.rollback()
         return False
-    finally:
-        if conn: conn.close()
 
 
+def save_clients(db_path: str, clients: list) -> bool:
+    """
+    Сохраняет (заменяет) сразу много клиентов одним executemany в одной транзакции.
+    clients - список пар (name, expiry_date_str). Статус - 'enabled'.
+    """
+    if not clients:
+        return True
+    try:
+        with transaction(db_path) as conn:
+            key = _key(db_path)
+            conn.executemany(SQL_UPSERT_CLIENT, [(key, name, expiry, "enabled") for name, expiry in clients])
+        logging.info(f"Сохранено {len(clients)} клиентов в '{db_path}'.")
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при массовом сохранении в '{db_path}': {e}")
+        return False
+
 
 def get_all_clients(db_path: str) -> list:
     """Возвращает список кортежей (name, expiry_date, status) всех клиентов."""
-    clients = []
-    conn = None
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        # Выбираем только нужные столбцы
-        cursor.execute("SELECT name, expiry_date, status FROM clients ORDER BY name")
-        clients = cursor.fetchall()
+        with _connection(db_path) as conn:
+            return conn.execute(SQL_SELECT_ALL, (_key(db_path),)).fetchall()
     except sqlite3.Error as e:
         logging.error(f"Ошибка SQLite при получении всех клиентов из '{db_path}': {e}")
-        # Возвращаем пустой список или можно пробросить ошибку
-    finally:
-        if conn: conn.close()
-    return clients
+        return []
+
+def get_clients_for_servers(db_paths) -> dict:
+    """
+    Клиенты нескольких серверов: {db_path: [(name, expiry_date, status), ...]}.
+    Серверы общей БД читаются одним запросом, отдельные файлы - по одному.
+    """
+    by_file: dict[str, dict] = {}
+    for db_path in db_paths:
+        db_file, key = _scope(db_path)
+        by_file.setdefault(db_file, {})[key] = db_path
+    result = {db_path: [] for db_path in db_paths}
+    for db_file, paths in by_file.items():
+        try:
+            with _connection(db_file) as conn:
+                for key, name, expiry_date, status in conn.execute(SQL_SELECT_ALL_FOR_KEYS, (json.dumps(list(paths)),)):
+                    result[paths[key]].append((name, expiry_date, status))
+        except sqlite3.Error as e:
+            logging.error(f"Ошибка SQLite при получении клиентов из '{db_file}': {e}")
+    return result
 
 def get_client_by_name(db_path: str, name: str) -> tuple | None:
     """Возвращает кортеж (name, expiry_date, status) для клиента по имени или None."""
-    row = None
-    conn = None
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        # Исправлена опечатка 'c lients' -> 'clients'
-        cursor.execute("SELECT name, expiry_date, status FROM clients WHERE name = ?", (name,))
-        row = cursor.fetchone()
+        with _connection(db_path) as conn:
+            return conn.execute(SQL_SELECT_BY_NAME, (_key(db_path), name)).fetchone()
     except sqlite3.Error as e:
         logging.error(f"Ошибка SQLite при получении '{name}' из '{db_path}': {e}")
-    finally:
-        if conn: conn.close()
-    return row
+        return None
 
 def delete_client_from_db(db_path: str, name: str) -> bool:
     """Удаляет клиента по имени. Возвращает True, если строка была удалена."""
-    deleted = False
-    conn = None
-    try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM clients WHERE name = ?", (name,))
-        conn.commit()
-        # cursor.rowcount показывает количество измененных/удаленных строк
+    try:
+        with transaction(db_path) as conn:
+            cursor = conn.execute(SQL_DELETE_BY_NAME, (_key(db_path), name))
         if cursor.rowcount > 0:
             logging.info(f"Клиент '{name}' удален из '{db_path}'.")
-            deleted = True
-        else:
-             logging.info(f"Клиент '{name}' не найден в '{db_path}' для удаления.")
+            return True
+        logging.info(f"Клиент '{name}' не найден в '{db_path}' для удаления.")
     except sqlite3.Error as e:
         logging.error(f"Ошибка SQLite при удалении '{name}' из '{db_path}': {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn: conn.close()
-    return deleted
+    return False
 
 def update_client_status(db_path: str, name: str, status: str) -> bool:
     """Обновляет статус клиента. Возвращает True, если строка была обновлена."""
     if status not in ['enabled', 'disabled']:
         logging.error(f"Попытка установить неверный статус '{status}' для '{name}' в '{db_path}'")
         return False
-    updated = False
-    conn = None
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("UPDATE clients SET status = ? WHERE name = ?", (status, name))
-        conn.commit()
+        with transaction(db_path) as conn:
+            cursor = conn.execute(SQL_UPDATE_STATUS, (status, _key(db_path), name))
         if cursor.rowcount > 0:
             logging.info(f"Статус клиента '{name}' обновлен на '{status}' в '{db_path}'.")
-            updated = True
-        else:
-             logging.info(f"Клиент '{name}' не найден в '{db_path}' для обновления статуса.")
+            return True
+        logging.info(f"Клиент '{name}' не найден в '{db_path}' для обновления статуса.")
     except sqlite3.Error as e:
         logging.error(f"Ошибка SQLite при обновлении статуса '{name}' в '{db_path}': {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn: conn.close()
-    return updated
+    return False
+
+def set_clients_status(db_path: str, names: list, status: str) -> int:
+    """Меняет статус сразу у списка клиентов одним UPDATE. Возвращает число измененных строк."""
+    if status not in ['enabled', 'disabled']:
+        logging.error(f"Попытка установить неверный статус '{status}' в '{db_path}'")
+        return 0
+    if not names:
+        return 0
+    try:
+        with transaction(db_path) as conn:
+            cursor = conn.execute(SQL_UPDATE_STATUS_MANY, (status, _key(db_path), status, json.dumps(list(names))))
+        logging.info(f"Статус '{status}' установлен для {cursor.rowcount} клиентов в '{db_path}'.")
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при массовом обновлении статуса в '{db_path}': {e}")
+        return 0
 
 def extend_client(db_path: str, name: str, months: int) -> bool:
     """Продлевает срок действия клиента. Возвращает True при успехе."""
@@ -156,59 +570,292 @@ def extend_client(db_path: str, name: str, months: int) -> bool:
         logging.error(f"Некорректный срок продления '{months}' для {name} в {db_path}")
         return False
 
-    conn = None
-    success = False
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT expiry_date FROM clients WHERE name = ?", (name,))
-        row = cursor.fetchone()
-        if row and row[0]: # Проверяем, что клиент найден и дата существует
+        # Чтение и запись в одной транзакции - между ними никто не изменит срок
+        with transaction(db_path) as conn:
+            row = conn.execute(SQL_SELECT_EXPIRY, (_key(db_path), name)).fetchone()
+            if not row:
+                logging.warning(f"Клиент '{name}' не найден в '{db_path}' для продления.")
+                return False
+            if not row[0]:
+                logging.warning(f"У клиента '{name}' в '{db_path}' пустая дата (expiry_date is NULL). Продление невозможно.")
+                return False
             try:
-                # Пытаемся распарсить дату из БД
-                current_expiry = datetime.fromisoformat(row[0])
-                # Добавляем месяцы
-                new_expiry = current_expiry + relativedelta(months=months)
-                new_expiry_str = new_expiry.isoformat(timespec='microseconds')
-                # Обновляем в БД
-                cursor.execute("UPDATE clients SET expiry_date = ? WHERE name = ?", (new_expiry_str, name))
-                conn.commit()
-                if cursor.rowcount > 0:
-                    logging.info(f"Срок клиента '{name}' в '{db_path}' продлен до '{new_expiry_str}'.")
-                    success = True
-                else:
-                    # Это не должно произойти, если select прошел успешно, но на всякий случай
-                    logging.warning(f"Не удалось обновить срок для '{name}' в '{db_path}' после SELECT.")
+                new_expiry = datetime.fromisoformat(row[0]) + relativedelta(months=months)
             except ValueError as date_err:
                 logging.error(f"Не удалось распарсить дату '{row[0]}' для '{name}' в '{db_path}': {date_err}")
-            except Exception as calc_err:
-                 logging.error(f"Не удалось рассчитать новую дату для '{name}' в '{db_path}': {calc_err}")
-        elif row:
-             logging.warning(f"У клиента '{name}' в '{db_path}' пустая дата (expiry_date is NULL). Продление невозможно.")
-        else:
-            logging.warning(f"Клиент '{name}' не найден в '{db_path}' для продления.")
+                return False
+            new_expiry_str = new_expiry.isoformat(timespec='microseconds')
+            conn.execute(SQL_UPDATE_EXPIRY, (new_expiry_str, _key(db_path), name))
+        logging.info(f"Срок клиента '{name}' в '{db_path}' продлен до '{new_expiry_str}'.")
+        return True
     except sqlite3.Error as e:
         logging.error(f"Ошибка SQLite при продлении '{name}' в '{db_path}': {e}")
-        if conn: conn.rollback()
-    finally:
-        if conn: conn.close()
-    return success
-
-# Функция get_expired_clients() также должна принимать db_path, если она используется
-def get_expired_clients(db_path: str) -> list:
-    """Возвращает список имен клиентов с истекшим сроком."""
-    expired = []
-    conn = None
-    try:
-        now = datetime.now().isoformat(timespec='microseconds')
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        # Сравниваем строки ISO формата
-        cursor.execute("SELECT name FROM clients WHERE expiry_date IS NOT NULL AND expiry_date <= ?", (now,))
-        rows = cursor.fetchall()
-        expired = [row[0] for row in rows]
+        return False
+
+def get_expired_clients(db_path: str, status: str | None = None) -> list:
+    """Возвращает список имен клиентов с истекшим сроком (опционально только с указанным статусом)."""
+    try:
+        now = _to_wall_clock_ts(datetime.now())
+        with _connection(db_path) as conn:
+            # Диапазон по индексу expiry_ts (или (status, expiry_ts))
+            if status:
+                rows = conn.execute(SQL_SELECT_EXPIRED_BY_STATUS, (_key(db_path), status, now)).fetchall()
+            else:
+                rows = conn.execute(SQL_SELECT_EXPIRED, (_key(db_path), now)).fetchall()
+        return [row[0] for row in rows]
     except sqlite3.Error as e:
         logging.error(f"Ошибка SQLite при поиске истекших клиентов в '{db_path}': {e}")
-    finally:
-        if conn: conn.close()
-    return expired
+        return []
+
+def get_expiring_clients(db_path: str, days: int, status: str | None = None) -> list:
+    """
+    Возвращает кортежи (name, expiry_date, status) клиентов, у которых срок
+    истекает в ближайшие days дней (уже истекшие не входят), по возрастанию срока.
+    """
+    try:
+        now = datetime.now()
+        start, end = _to_wall_clock_ts(now), _to_wall_clock_ts(now + timedelta(days=days))
+        with _connection(db_path) as conn:
+            if status:
+                return conn.execute(SQL_SELECT_EXPIRING_BY_STATUS, (_key(db_path), status, start, end)).fetchall()
+            return conn.execute(SQL_SELECT_EXPIRING, (_key(db_path), start, end)).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при поиске истекающих клиентов в '{db_path}': {e}")
+        return []
+
+# === КЭШ КОНФИГОВ И QR (таблица artifacts) ===
+def get_artifact(db_path: str, client_id: str) -> dict | None:
+    """Возвращает сохраненный конфиг/QR клиента по id на wg-easy или None."""
+    try:
+        with _connection(db_path) as conn:
+            row = conn.execute(SQL_SELECT_ARTIFACT, (_key(db_path), client_id)).fetchone()
+        return dict(zip(ARTIFACT_COLUMNS, row)) if row else None
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при чтении кэша конфига {client_id} из '{db_path}': {e}")
+        return None
+
+def save_artifact(db_path: str, artifact: dict) -> bool:
+    """Сохраняет (заменяет) запись кэша конфига/QR."""
+    try:
+        with transaction(db_path) as conn:
+            conn.execute(SQL_UPSERT_ARTIFACT, (_key(db_path), *(artifact.get(col) for col in ARTIFACT_COLUMNS)))
+        return True
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при сохранении кэша конфига {artifact.get('client_id')} в '{db_path}': {e}")
+        return False
+
+def delete_artifacts_by_name(db_path: str, name: str) -> int:
+    """Удаляет кэш конфигов/QR клиента по имени. Возвращает число удаленных записей."""
+    try:
+        with transaction(db_path) as conn:
+            cursor = conn.execute(SQL_DELETE_ARTIFACTS_BY_NAME, (_key(db_path), name))
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при удалении кэша конфига '{name}' из '{db_path}': {e}")
+        return 0
+
+def get_clients_by_names(db_path: str, names) -> dict:
+    """Возвращает {name: (name, expiry_date, status)} для существующих в БД имен из списка."""
+    if not names:
+        return {}
+    try:
+        with _connection(db_path) as conn:
+            rows = conn.execute(SQL_SELECT_BY_NAMES, (_key(db_path), json.dumps(list(names)))).fetchall()
+        return {row[0]: row for row in rows}
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при получении клиентов из '{db_path}': {e}")
+        return {}
+
+def delete_clients(db_path: str, names) -> int:
+    """Удаляет клиентов по списку имен одним DELETE. Возвращает число удаленных строк."""
+    if not names:
+        return 0
+    try:
+        with transaction(db_path) as conn:
+            cursor = conn.execute(SQL_DELETE_BY_NAMES, (_key(db_path), json.dumps(list(names))))
+        logging.info(f"Удалено {cursor.rowcount} клиентов из '{db_path}'.")
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при массовом удалении из '{db_path}': {e}")
+        return 0
+
+def search_clients(db_path: str, query: str, limit: int = SEARCH_LIMIT) -> list:
+    """
+    Ищет клиентов по имени: кортежи (name, expiry_date, status), не больше limit.
+    От 3 символов - по подстроке без учета регистра: сначала берутся имена,
+    начинающиеся с запроса, остальное добирается по индексу; результат
+    упорядочен по позиции совпадения. Короче - по началу имени; пустой запрос -
+    первые по алфавиту.
+    """
+    query = query.strip()
+    key = _key(db_path)
+    try:
+        with _connection(db_path) as conn:
+            prefix = conn.execute(SQL_SEARCH_PREFIX, (key, query, query + "\U0010ffff", limit)).fetchall()
+            if len(query) < 3:
+                return prefix
+            found = {row[0]: row for row in prefix}
+            if len(found) < limit:
+                phrase = '"' + query.replace('"', '""') + '"'
+                # + len(found): совпадения префиксного запроса найдутся и здесь
+                for row in conn.execute(SQL_SEARCH_SUBSTRING, (phrase, key, limit + len(found))):
+                    found.setdefault(row[0], row)
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при поиске '{query}' в '{db_path}': {e}")
+        return []
+    needle = query.lower()
+    return sorted(found.values(), key=lambda row: (row[0].lower().find(needle), row[0]))[:limit]
+
+# === ТЕЛЕМЕТРИЯ ТРАФИКА (таблицы traffic_*) ===
+def record_traffic_sample(db_path: str, ts: int, samples: list, buckets: dict, retention: dict) -> int:
+    """
+    Записывает один замер сервера одной транзакцией. samples - кортежи
+    (client_id, name, rx, tx, handshake_at) с API; buckets - {таблица: размер корзины, с};
+    retention - {таблица: хранить, с}. Дельта считается от прошлого замера клиента,
+    сброс счетчика (перезапуск WireGuard) - дельта от нуля. Возвращает число клиентов с трафиком.
+    """
+    key = _key(db_path)
+    with transaction(db_path) as conn:
+        previous = {client_id: (rx, tx) for client_id, rx, tx in conn.execute(SQL_SELECT_TRAFFIC_LAST, (key,))}
+        deltas = []
+        for client_id, name, rx, tx, _ in samples:
+            prev = previous.get(client_id)
+            if prev is None:
+                continue  # первый замер - только точка отсчета
+            d_rx = rx - prev[0] if rx >= prev[0] else rx
+            d_tx = tx - prev[1] if tx >= prev[1] else tx
+            if d_rx or d_tx:
+                deltas.append((name, d_rx, d_tx))
+        conn.executemany(SQL_UPSERT_TRAFFIC_LAST, [(key, client_id, name, rx, tx, handshake_at, handshake_at or ts)
+                                                   for client_id, name, rx, tx, handshake_at in samples])
+        conn.execute(SQL_DELETE_TRAFFIC_LAST_MISSING, (key, json.dumps([sample[0] for sample in samples]),))
+        for table in TRAFFIC_TABLES:
+            bucket = ts - ts % buckets[table]
+            conn.executemany(SQL_ADD_TRAFFIC[table], [(key, bucket, name, d_rx, d_tx) for name, d_rx, d_tx in deltas])
+            conn.execute(SQL_PRUNE_TRAFFIC[table], (key, ts - retention[table]))
+    return len(deltas)
+
+def get_top_talkers(db_path: str, table: str, since_ts: int, limit: int) -> list:
+    """Клиенты с наибольшим трафиком с since_ts: кортежи (name, rx, tx). table - одна из TRAFFIC_TABLES."""
+    try:
+        with _connection(db_path) as conn:
+            return conn.execute(SQL_TOP_TALKERS[table], (_key(db_path), since_ts, limit)).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при выборке трафика из {table} в '{db_path}': {e}")
+        return []
+
+def get_inactive_clients(db_path: str, before_ts: int, limit: int):
+    """Клиенты без рукопожатий с before_ts: (всего, [(name, handshake_at или None, active_at), ...])."""
+    try:
+        with _connection(db_path) as conn:
+            total = conn.execute(SQL_COUNT_INACTIVE, (_key(db_path), before_ts)).fetchone()[0]
+            return total, conn.execute(SQL_SELECT_INACTIVE, (_key(db_path), before_ts, limit)).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при выборке неактивных клиентов в '{db_path}': {e}")
+        return 0, []
+
+# === СОСТОЯНИЕ ДИАЛОГОВ (таблица user_state) ===
+def init_state_db(db_path: str) -> None:
+    """Создает таблицу состояний пользователей (и каталог файла, если его нет)."""
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+    with _connection(db_path) as conn:
+        conn.execute(SQL_CREATE_USER_STATE)
+
+def load_user_state(db_path: str, user_id: int) -> str | None:
+    """JSON состояния пользователя или None."""
+    with _connection(db_path) as conn:
+        row = conn.execute(SQL_SELECT_USER_STATE, (user_id,)).fetchone()
+    return row[0] if row else None
+
+def save_user_states(db_path: str, states: dict) -> None:
+    """Записывает пачку состояний одной транзакцией: {user_id: JSON или None - удалить}."""
+    with transaction(db_path) as conn:
+        conn.executemany(SQL_UPSERT_USER_STATE, [(uid, data) for uid, data in states.items() if data is not None])
+        conn.executemany(SQL_DELETE_USER_STATE, [(uid,) for uid, data in states.items() if data is None])
+
+# === СВЕРКА С API (таблицы api_snapshot, client_changes, reconcile_*) ===
+def load_api_snapshot(db_path: str) -> dict:
+    """Возвращает последний сохраненный список клиентов API: {client_id: (name, enabled, updated_at)}."""
+    with _connection(db_path) as conn:
+        return {row[0]: (row[1], bool(row[2]), row[3]) for row in conn.execute(SQL_SELECT_SNAPSHOT, (_key(db_path),))}
+
+def get_client_changes(db_path: str):
+    """Возвращает (имена, последний seq) из журнала изменений clients. seq = 0, если журнал пуст."""
+    with _connection(db_path) as conn:
+        rows = conn.execute(SQL_SELECT_CHANGES, (_key(db_path),)).fetchall()
+    return {name for _, name in rows}, (rows[-1][0] if rows else 0)
+
+def get_reconcile_state(db_path: str, key: str) -> str | None:
+    with _connection(db_path) as conn:
+        row = conn.execute(SQL_SELECT_STATE, (_key(db_path), key)).fetchone()
+    return row[0] if row else None
+
+def commit_reconciliation(db_path: str, upserts: dict, removed_ids, evaluated_names, issues: dict, last_seq: int) -> list:
+    """
+    Фиксирует проход сверки одной транзакцией: изменения снимка API
+    (upserts - {client_id: (name, enabled, updated_at)}, removed_ids), расхождения
+    по проверенным именам (issues - {name: (kind, detail)}) и обработанную часть
+    журнала изменений. Возвращает имена с новыми (или сменившими вид) расхождениями.
+    """
+    names_json, key = json.dumps(list(evaluated_names)), _key(db_path)
+    with transaction(db_path) as conn:
+        conn.executemany(SQL_UPSERT_SNAPSHOT, [(key, cid, name, int(enabled), updated_at) for cid, (name, enabled, updated_at) in upserts.items()])
+        conn.executemany(SQL_DELETE_SNAPSHOT, [(key, cid) for cid in removed_ids])
+        known = dict(conn.execute(SQL_SELECT_ISSUES_BY_NAMES, (key, names_json)).fetchall())
+        conn.execute(SQL_DELETE_ISSUES_BY_NAMES, (key, json.dumps([n for n in evaluated_names if n not in issues]),))
+        conn.executemany(SQL_UPSERT_ISSUE, [(key, name, kind, detail) for name, (kind, detail) in issues.items()])
+        if last_seq: conn.execute(SQL_DELETE_CHANGES, (key, last_seq))
+        conn.execute(SQL_UPSERT_STATE, (key, "initialized", "1"))
+    return [name for name, (kind, _) in issues.items() if known.get(name) != kind]
+
+def get_reconcile_issues(db_path: str) -> list:
+    """Возвращает открытые расхождения: кортежи (name, kind, detail, detected_at)."""
+    try:
+        with _connection(db_path) as conn:
+            return conn.execute(SQL_SELECT_ISSUES, (_key(db_path),)).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Ошибка SQLite при чтении расхождений из '{db_path}': {e}")
+        return []
+
+# === ПЕРЕНОС В ОБЩУЮ БД ===
+# Таблицы файла сервера и их колонки (кроме server_key), которые переносятся в
+# общую БД. client_changes не переносится: вставка в clients сама пишет журнал,
+# и следующая сверка проверит все имена сервера.
+IMPORT_TABLES = {
+    "clients": ("name", "expiry_date", "status", "created_at"),
+    "artifacts": ARTIFACT_COLUMNS,
+    "api_snapshot": ("client_id", "name", "enabled", "updated_at"),
+    "reconcile_issues": ("name", "kind", "detail", "detected_at"),
+    "reconcile_state": ("key", "value"),
+    "traffic_last": ("client_id", "name", "rx", "tx", "handshake_at", "active_at"),
+    **{table: ("bucket", "name", "rx", "tx") for table in TRAFFIC_TABLES},
+}
+
+
+def import_server_db(db_path: str, source_path: str) -> dict:
+    """
+    Переносит данные из отдельного файла сервера source_path в db_path (обычно
+    scoped_db_path(общий файл, key)). Прежние строки этого сервера в db_path
+    заменяются, так что повторный запуск безопасен. Обе БД доводятся до
+    последней схемы. Возвращает {таблица: перенесено строк}.
+    """
+    init_db(source_path)
+    init_db(db_path)
+    key = _key(db_path)
+    counts = {}
+    with _connection(db_path) as conn:
+        conn.execute("ATTACH DATABASE ? AS source", (source_path,))
+        try:
+            with transaction(db_path) as tx:
+                for table, columns in IMPORT_TABLES.items():
+                    names = ", ".join(columns)
+                    tx.execute(f"DELETE FROM main.{table} WHERE server_key = ?", (key,))
+                    cursor = tx.execute(f"INSERT INTO main.{table} (server_key, {names}) SELECT ?, {names} FROM source.{table}", (key,))
+                    counts[table] = cursor.rowcount
+        finally:
+            conn.execute("DETACH DATABASE source")
+    logging.info(f"БД '{source_path}' перенесена в '{db_path}': {counts}")
+    return counts
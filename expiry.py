@@ -0,0 +1,74 @@
+import os
+import html
+import asyncio
+import logging
+
+from database import get_expired_clients, set_clients_status, run_db
+from wg_api import set_clients_enabled
+from servers import prepare_server
+from locks import client_locks
+
+# === ОТКЛЮЧЕНИЕ КЛИЕНТОВ С ИСТЕКШИМ СРОКОМ ===
+# Периодическая задача: по всем серверам сразу находит включенных клиентов
+# с истекшим сроком (диапазон по индексу (status, expiry_ts)), выключает их
+# на wg-easy параллельно (не более EXPIRY_CONCURRENCY запросов на сервер) и
+# одним UPDATE помечает в БД как 'disabled'. Выключение идет под блокировками
+# этих клиентов: продление или удаление, начатое раньше, успевает завершиться,
+# и после ожидания список истекших перечитывается.
+
+EXPIRY_CHECK_INTERVAL = int(os.getenv("EXPIRY_CHECK_INTERVAL", "3600"))
+EXPIRY_CONCURRENCY = int(os.getenv("EXPIRY_CONCURRENCY", "5"))
+
+
+async def _sweep_server(server_key: str, server: dict) -> dict:
+    db_path = await prepare_server(server)
+    result = {"server_name": server["name"], "disabled": [], "failed": {}}
+    expired = await run_db(get_expired_clients, db_path, "enabled")
+    if not expired:
+        return result
+    async with client_locks(server_key, expired):
+        # Пока ждали блокировок, клиента могли продлить, выключить или удалить
+        expired = sorted(set(expired) & set(await run_db(get_expired_clients, db_path, "enabled")))
+        if not expired:
+            return result
+        logging.info(f"Истек срок у {len(expired)} включенных клиентов на {server_key}.")
+        api_results = await set_clients_enabled(expired, False, server["url"], server["password"], concurrency=EXPIRY_CONCURRENCY)
+        result["disabled"] = [name for name, error in api_results.items() if error is None]
+        result["failed"] = {name: error for name, error in api_results.items() if error is not None}
+        # В БД выключаем только тех, кого удалось выключить на API (или кого там нет)
+        await run_db(set_clients_status, db_path, result["disabled"], "disabled")
+    return result
+
+
+async def enforce_expiry(servers: dict) -> list:
+    """Обходит все серверы параллельно. Возвращает список результатов по серверам."""
+    keys = list(servers)
+    results = await asyncio.gather(
+        *(_sweep_server(key, servers[key]) for key in keys), return_exceptions=True
+    )
+    summary = []
+    for key, result in zip(keys, results):
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка проверки сроков на {key}: {result!r}")
+            result = {"server_name": servers[key]["name"], "disabled": [], "failed": {}, "error": str(result)}
+        summary.append(result)
+    return summary
+
+
+def format_expiry_summary(summary: list) -> str | None:
+    """Текст сводки для администраторов или None, если ничего не произошло."""
+    lines = []
+    for result in summary:
+        if not result["disabled"] and not result["failed"] and not result.get("error"):
+            continue
+        lines.append(f"<b>{html.escape(result['server_name'])}</b>")
+        if result["disabled"]:
+            lines.append(f"🔴 Выключено: {len(result['disabled'])} — {html.escape(', '.join(result['disabled'][:50]))}")
+            if len(result["disabled"]) > 50: lines.append(f"... и еще {len(result['disabled']) - 50}")
+        if result["failed"]:
+            lines.append(f"⚠️ Не удалось выключить: {len(result['failed'])} — {html.escape(', '.join(list(result['failed'])[:20]))}")
+        if result.get("error"):
+            lines.append(f"⚠️ Ошибка: {html.escape(result['error'])}")
+    if not lines:
+        return None
+    return "⏰ Проверка сроков действия\n\n" + "\n".join(lines)
@@ -0,0 +1,106 @@
+import io
+import os
+import csv
+import shutil
+import asyncio
+import logging
+import zipfile
+import tempfile
+
+from database import get_all_clients, run_db
+from wg_api import get_client_directory, get_api_client_configuration, get_config_and_qr_by_id
+from servers import prepare_server
+from bulk import safe_filename, unique_filenames
+
+# === ЭКСПОРТ КЛИЕНТОВ В ZIP ===
+# /export собирает конфиги (и по желанию QR) всех клиентов выбранного или всех
+# серверов в один ZIP: <ключ сервера>/<имя>.conf и .png, плюс clients.csv со
+# строками таблицы clients, состоянием на API и именем файла конфига.
+# Серверы обходятся по очереди, конфиги сервера скачивают EXPORT_CONCURRENCY
+# воркеров. Каждый файл сразу дописывается в ZIP во временном файле на диске,
+# строки CSV - во временный файл, так что память не растет с числом клиентов.
+# Вызывающий отправляет архив одним документом и удаляет файл.
+
+EXPORT_CONCURRENCY = int(os.getenv("EXPORT_CONCURRENCY", "5"))
+EXPORT_MAX_SIZE = 50 * 1024 * 1024  # лимит Bot API на отправку файла
+CSV_COLUMNS = ("server", "name", "expiry_date", "status", "api", "config")
+
+
+async def _export_server(archive: zipfile.ZipFile, writer, server: dict, with_qr: bool, stats: dict) -> None:
+    db_path = await prepare_server(server)
+    db_rows, directory = await asyncio.gather(run_db(get_all_clients, db_path),
+                                              get_client_directory(server["url"], server["password"], fresh=True))
+    api_by_name = directory.by_name if directory is not None and not directory.stale else None
+    if api_by_name is None:
+        stats["unavailable"].append(server["name"])
+    db_by_name = {row[0]: row for row in db_rows}
+    names = sorted(db_by_name.keys() | (api_by_name or {}).keys())
+    filenames = unique_filenames(names)
+    folder = safe_filename(server["key"])
+    exported = set()
+    pending = iter([name for name in names if api_by_name and name in api_by_name])
+
+    async def _worker():
+        # Воркеры берут имена из общего итератора: в работе не больше EXPORT_CONCURRENCY клиентов
+        for name in pending:
+            client_id = api_by_name[name]["id"]
+            if with_qr:
+                config, qr_png, _ = await get_config_and_qr_by_id(client_id, server["url"], server["password"])
+            else:
+                config, qr_png = await get_api_client_configuration(client_id, server["url"], server["password"]), None
+            if not config:
+                stats["errors"] += 1
+                continue
+            archive.writestr(f"{folder}/{filenames[name]}.conf", config)
+            exported.add(name)
+            stats["configs"] += 1
+            if qr_png:
+                archive.writestr(f"{folder}/{filenames[name]}.png", qr_png, compress_type=zipfile.ZIP_STORED)
+                stats["qr"] += 1
+
+    await asyncio.gather(*(_worker() for _ in range(max(1, EXPORT_CONCURRENCY))))
+
+    for name in names:
+        _, expiry_date, status = db_by_name.get(name, (name, "", ""))
+        if api_by_name is None: api_state = "N/A"
+        elif name not in api_by_name: api_state = "missing"
+        else: api_state = "enabled" if api_by_name[name].get("enabled", True) else "disabled"
+        config_file = f"{folder}/{filenames[name]}.conf" if name in exported else ""
+        writer.writerow((server["key"], name, expiry_date or "", status or "", api_state, config_file))
+    stats["clients"] += len(names)
+    logging.info(f"Экспорт {server['key']}: {len(exported)} конфигов из {len(names)} клиентов.")
+
+
+async def build_export(servers: list, with_qr: bool = False):
+    """
+    Собирает ZIP с конфигами клиентов servers во временный файл.
+    Возвращает (путь к файлу, статистика); файл удаляет вызывающий.
+    """
+    stats = {"clients": 0, "configs": 0, "qr": 0, "errors": 0, "unavailable": []}
+    fd, path = tempfile.mkstemp(prefix="wg-export-", suffix=".zip")
+    try:
+        with os.fdopen(fd, "w+b") as raw, zipfile.ZipFile(raw, "w", zipfile.ZIP_DEFLATED) as archive, \
+                tempfile.TemporaryFile() as csv_raw:
+            # utf-8-sig: Excel открывает кириллицу без ручного выбора кодировки
+            csv_text = io.TextIOWrapper(csv_raw, encoding="utf-8-sig", newline="")
+            writer = csv.writer(csv_text)
+            writer.writerow(CSV_COLUMNS)
+            for server in servers:
+                await _export_server(archive, writer, server, with_qr, stats)
+            csv_text.flush()
+            csv_raw.seek(0)
+            with archive.open("clients.csv", "w") as entry:
+                shutil.copyfileobj(csv_raw, entry)
+            csv_text.detach()
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, stats
+
+
+def format_export_caption(stats: dict, with_qr: bool) -> str:
+    text = f"📦 Клиентов: {stats['clients']} · конфигов: {stats['configs']}"
+    if with_qr: text += f" · QR: {stats['qr']}"
+    if stats["errors"]: text += f"\n⚠️ Не удалось получить конфигов: {stats['errors']}"
+    if stats["unavailable"]: text += f"\n⚠️ API недоступен (только clients.csv): {', '.join(stats['unavailable'])}"
+    return text
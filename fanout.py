@@ -0,0 +1,121 @@
+import os
+import html
+import asyncio
+import logging
+from datetime import datetime
+
+from database import get_clients_for_servers, run_db
+from wg_api import get_client_directory
+from servers import prepare_server
+
+# === РЕЖИМ "ВСЕ СЕРВЕРЫ" ===
+# API и БД всех серверов опрашиваются параллельно, у каждого сервера свой
+# таймаут FANOUT_TIMEOUT: мертвый узел попадает в отчет как недоступный и не
+# задерживает ответ. Счетчики (вкл/выкл/истекшие/сироты) считаются за тот же
+# проход, что и поиск по имени. Клиенты из БД всех серверов читаются одним
+# вызовом в потоке БД (с общей БД DB_FILE - одним запросом).
+
+FANOUT_TIMEOUT = float(os.getenv("FANOUT_TIMEOUT", "5"))
+SEARCH_RESULTS_LIMIT = 50
+
+
+async def _load_databases(servers: dict, keys: list) -> dict:
+    """{key: список клиентов из БД или исключение, если БД сервера не открылась}."""
+    prepared = await asyncio.gather(*(prepare_server(servers[key]) for key in keys), return_exceptions=True)
+    rows = await run_db(get_clients_for_servers, [db_path for db_path in prepared if isinstance(db_path, str)])
+    return {key: rows[db_path] if isinstance(db_path, str) else db_path for key, db_path in zip(keys, prepared)}
+
+
+async def _load_server_with_timeout(server_key: str, server: dict) -> dict:
+    try:
+        return {"directory": await asyncio.wait_for(get_client_directory(server["url"], server["password"]), FANOUT_TIMEOUT)}
+    except asyncio.TimeoutError:
+        logging.warning(f"Сервер {server_key} не ответил за {FANOUT_TIMEOUT} с.")
+        return {"directory": None, "api_error": f"таймаут {FANOUT_TIMEOUT:g} с"}
+    except Exception as e:
+        logging.error(f"Ошибка опроса сервера {server_key}: {e!r}")
+        return {"directory": None, "api_error": "ошибка"}
+
+
+def _summarize(server: dict, data: dict, query: str | None, now_iso: str) -> dict:
+    """
+    Один проход по клиентам сервера: счетчики + совпадения с поиском. Если API
+    не ответил, счетчики и поиск считаются по БД (api_available=False).
+    """
+    result = {"name": server["name"], "error": data.get("error"), "api_error": data.get("api_error"), "enabled": 0, "disabled": 0, "expired": 0,
+              "missing_on_api": 0, "missing_in_db": 0, "total": 0, "api_available": False, "stale": False, "matches": []}
+    if result["error"]:
+        return result
+    directory = data["directory"]
+    api_by_name = directory.by_name if directory is not None else {}
+    result["api_available"] = directory is not None
+    result["stale"] = bool(directory and directory.stale)
+    needle = query.lower() if query else None
+    db_names = set()
+    for name, expiry_date, db_status in data["db_clients"]:
+        db_names.add(name)
+        result["total"] += 1
+        api_client = api_by_name.get(name)
+        if api_client is not None:
+            enabled = api_client.get("enabled", True)
+            result["enabled" if enabled else "disabled"] += 1
+        elif directory is not None:
+            result["missing_on_api"] += 1
+        if expiry_date and expiry_date <= now_iso:
+            result["expired"] += 1
+        if needle and needle in name.lower():
+            result["matches"].append((name, expiry_date, api_client.get("enabled", True) if api_client else None))
+    for name, api_client in api_by_name.items():
+        if name in db_names: continue
+        result["missing_in_db"] += 1
+        if needle and needle in name.lower():
+            result["matches"].append((name, None, api_client.get("enabled", True)))
+    return result
+
+
+async def collect_all_servers(servers: dict, query: str | None = None) -> list:
+    """Параллельно опрашивает все серверы. Возвращает список сводок по серверам."""
+    keys = list(servers)
+    db_clients, loaded = await asyncio.gather(
+        _load_databases(servers, keys),
+        asyncio.gather(*(_load_server_with_timeout(k, servers[k]) for k in keys)),
+    )
+    for key, data in zip(keys, loaded):
+        if isinstance(db_clients[key], Exception):
+            logging.error(f"Ошибка БД сервера {key}: {db_clients[key]!r}")
+            data.setdefault("error", "ошибка БД")
+        else:
+            data["db_clients"] = db_clients[key]
+    now_iso = datetime.now().isoformat(timespec='microseconds')
+    return [_summarize(servers[k], data, query, now_iso) for k, data in zip(keys, loaded)]
+
+
+def format_overview(results: list, query: str | None = None) -> str:
+    """HTML-текст сводки по всем серверам (и результатов поиска, если был запрос)."""
+    totals = {key: sum(r[key] for r in results) for key in ("total", "enabled", "disabled", "expired", "missing_on_api", "missing_in_db")}
+    lines = [
+        "🌍 <b>Все серверы</b>",
+        f"Всего в БД: {totals['total']} · 🟢 {totals['enabled']} · 🔴 {totals['disabled']} · ⌛ истекло {totals['expired']}",
+        f"Сироты: ❓ нет на API {totals['missing_on_api']} · 👻 нет в БД {totals['missing_in_db']}",
+        "",
+    ]
+    for r in results:
+        name = html.escape(r["name"])
+        if r["error"]:
+            lines.append(f"⚠️ <b>{name}</b>: недоступен ({html.escape(r['error'])})")
+            continue
+        api_note = "" if r["api_available"] else " · API N/A"
+        if r["api_error"]: api_note += f" ({html.escape(r['api_error'])})"
+        if r["stale"]: api_note = " · API из кэша"
+        lines.append(f"<b>{name}</b>: {r['total']} · 🟢 {r['enabled']} · 🔴 {r['disabled']} · ⌛ {r['expired']} · ❓ {r['missing_on_api']} · 👻 {r['missing_in_db']}{api_note}")
+
+    if query is not None:
+        matches = [(r["name"], m) for r in results for m in r["matches"]]
+        lines += ["", f"🔎 Поиск «{html.escape(query)}»: найдено {len(matches)}"]
+        for server_name, (client_name, expiry_date, enabled) in matches[:SEARCH_RESULTS_LIMIT]:
+            emoji = "❓" if enabled is None else ("🟢" if enabled else "🔴")
+            expiry_str = expiry_date[:10] if expiry_date else "-"
+            lines.append(f"{emoji} <b>{html.escape(client_name)}</b> — {html.escape(server_name)} — до <code>{expiry_str}</code>")
+        if len(matches) > SEARCH_RESULTS_LIMIT:
+            lines.append(f"... и еще {len(matches) - SEARCH_RESULTS_LIMIT}, уточните запрос.")
+    return "\n".join(lines)
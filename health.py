@@ -0,0 +1,170 @@
+import os
+import time
+import random
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+
+import httpx
+
+# === ЗДОРОВЬЕ СЕРВЕРОВ, ПОВТОРЫ И ДЕДЛАЙНЫ ===
+# Circuit breaker на каждый сервер: после BREAKER_FAILURES ошибок подряд
+# (сетевые ошибки, таймауты, 5xx) сервер считается упавшим, и запросы к нему
+# BREAKER_COOLDOWN секунд сразу завершаются CircuitOpenError без ожидания
+# таймаута. Затем пропускается один пробный запрос: успех закрывает breaker,
+# ошибка снова открывает.
+#
+# Повторы - только для идемпотентных GET, с экспоненциальной задержкой и
+# случайным джиттером. Число повторов ограничено бюджетом: каждый запрос
+# добавляет RETRY_BUDGET_RATIO токена (не больше RETRY_BUDGET_MAX), повтор
+# тратит один - при массовых сбоях повторы не умножают нагрузку на сервер.
+#
+# Дедлайн действия пользователя хранится в contextvar: обработчик задает его
+# один раз (with_deadline), а каждый следующий запрос к API получает таймаут
+# не больше оставшегося времени. Задачи asyncio наследуют контекст, поэтому
+# дедлайн действует и на параллельные подзапросы.
+
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "3"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+GET_RETRIES = int(os.getenv("API_GET_RETRIES", "2"))
+RETRY_BACKOFF = 0.3  # с, база экспоненциальной задержки
+RETRY_BUDGET_RATIO = 0.2
+RETRY_BUDGET_MAX = 10.0
+ACTION_DEADLINE = float(os.getenv("ACTION_DEADLINE", "20"))
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+STATE_EMOJI = {CLOSED: "🟢", OPEN: "🔴", HALF_OPEN: "🟡"}
+
+
+class CircuitOpenError(httpx.HTTPError):
+    """Сервер помечен недоступным, запрос не отправлялся."""
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """Время на действие пользователя истекло."""
+
+    def __init__(self, message: str = "Истекло время на действие"):
+        super().__init__(message)
+
+
+class CircuitBreaker:
+    """Состояние здоровья одного сервера."""
+    __slots__ = ("base_url", "state", "failures", "opened_at", "probe_in_flight", "retry_tokens")
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.retry_tokens = RETRY_BUDGET_MAX
+
+    def current_state(self) -> str:
+        if self.state == OPEN and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            return HALF_OPEN
+        return self.state
+
+    def before_request(self) -> None:
+        """Пропускает запрос или бросает CircuitOpenError."""
+        state = self.current_state()
+        if state == OPEN or (state == HALF_OPEN and self.probe_in_flight):
+            raise CircuitOpenError(f"Сервер {self.base_url} временно недоступен")
+        if state == HALF_OPEN:
+            self.state = HALF_OPEN
+            self.probe_in_flight = True
+        self.retry_tokens = min(RETRY_BUDGET_MAX, self.retry_tokens + RETRY_BUDGET_RATIO)
+
+    def record_success(self) -> None:
+        if self.state != CLOSED:
+            logging.info(f"Сервер {self.base_url} снова доступен.")
+        self.state, self.failures, self.probe_in_flight = CLOSED, 0, False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.probe_in_flight = False
+        if self.state == HALF_OPEN or self.failures >= BREAKER_FAILURES:
+            if self.state != OPEN:
+                logging.warning(f"Сервер {self.base_url} помечен недоступным на {BREAKER_COOLDOWN:g} с ({self.failures} ошибок подряд).")
+            self.state, self.opened_at = OPEN, time.monotonic()
+
+    def release_probe(self) -> None:
+        """Пробный запрос завершился без вердикта (например, истек дедлайн действия)."""
+        self.probe_in_flight = False
+
+    def take_retry(self) -> bool:
+        if self.retry_tokens < 1:
+            return False
+        self.retry_tokens -= 1
+        return True
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(base_url: str) -> CircuitBreaker:
+    breaker = _breakers.get(base_url)
+    if breaker is None:
+        breaker = _breakers[base_url] = CircuitBreaker(base_url)
+    return breaker
+
+
+def server_state(base_url: str) -> str | None:
+    """Состояние breaker сервера или None, если к нему еще не обращались."""
+    breaker = _breakers.get(base_url)
+    return breaker.current_state() if breaker else None
+
+
+def retry_delay(attempt: int) -> float:
+    """Задержка перед повтором attempt (с 1): full jitter от экспоненты."""
+    return random.uniform(0, RETRY_BACKOFF * (2 ** (attempt - 1)))
+
+
+# === ДЕДЛАЙНЫ ===
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("wg_api_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: float | None):
+    """
+    Ограничивает время всех запросов к API внутри блока. Вложенный дедлайн не
+    может продлить внешний; seconds=None снимает ограничение (длинные массовые операции).
+    """
+    if seconds is None:
+        value = None
+    else:
+        value = time.monotonic() + seconds
+        outer = _deadline.get()
+        if outer is not None: value = min(value, outer)
+    token = _deadline.set(value)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    """Секунд до дедлайна (None - без дедлайна)."""
+    value = _deadline.get()
+    return None if value is None else value - time.monotonic()
+
+
+def request_timeout(default: float) -> float:
+    """Таймаут очередного запроса: не больше default и оставшегося времени. Бросает DeadlineExceeded."""
+    left = remaining()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded()
+    return min(default, left)
+
+
+def with_deadline(seconds: float | None = ACTION_DEADLINE):
+    """Декоратор обработчика: все запросы к API внутри укладываются в seconds."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with deadline(seconds):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
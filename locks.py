@@ -0,0 +1,61 @@
+import time
+import asyncio
+from contextlib import AsyncExitStack, asynccontextmanager
+
+from metrics import observe
+
+# === БЛОКИРОВКИ КЛИЕНТОВ ===
+# Апдейты обрабатываются параллельно (concurrent_updates), поэтому изменения
+# одного клиента сериализуются блокировкой по ключу (сервер, имя клиента):
+# создание, продление, удаление и вкл/выкл одного клиента не пересекаются,
+# а действия с разными клиентами идут параллельно. Чтение (списки, конфиги,
+# QR) выполняется без блокировок. Массовые операции (массовое создание,
+# отключение истекших, исправления сверки) берут блокировки всех своих имен
+# через client_locks - в порядке имен, чтобы две такие операции не ждали друг
+# друга по кругу.
+#
+# Блокировка живет, пока ее кто-то держит или ждет, - словарь не растет с
+# числом клиентов.
+
+
+class KeyedLock:
+    """Набор asyncio.Lock по ключу со счетчиком ссылок."""
+
+    def __init__(self):
+        self._locks: dict[tuple, list] = {}  # ключ -> [asyncio.Lock, число держащих и ждущих]
+
+    @asynccontextmanager
+    async def hold(self, *key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            start = time.perf_counter()
+            async with entry[0]:
+                observe("client_lock_wait_seconds", time.perf_counter() - start)
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+_client_locks = KeyedLock()
+
+
+def client_lock(server_key: str, client_name: str):
+    """Блокировка изменений клиента client_name на сервере server_key (async with)."""
+    return _client_locks.hold(server_key, client_name)
+
+
+@asynccontextmanager
+async def client_locks(server_key: str, client_names):
+    """Блокировки изменений сразу многих клиентов на сервере server_key (async with)."""
+    async with AsyncExitStack() as stack:
+        for name in sorted(set(client_names)):
+            await stack.enter_async_context(_client_locks.hold(server_key, name))
+        yield
@@ -0,0 +1,190 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+from telegram.request import HTTPXRequest
+
+# === МЕТРИКИ ===
+# Гистограммы задержек и счетчики ошибок в текстовом формате Prometheus:
+#   bot_handler_*      - обработчики апдейтов Telegram;
+#   wg_api_request_*   - запросы к wg-easy по серверу и эндпоинту;
+#   db_call_*          - функции database.py (выполнение и ожидание потока БД);
+#   telegram_request_* - запросы бота к Bot API (отправка сообщений, файлов);
+#   cache_requests_*   - попадания/промахи кэшей (сессии, список клиентов, конфиги, file_id).
+# Отдаются локальным HTTP-сервером на METRICS_HOST:METRICS_PORT (/metrics),
+# METRICS_PORT=0 выключает сервер. Внешних зависимостей нет: регистр - словари
+# под одной блокировкой (метрики пишутся и из потока БД).
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+    "bot_handler_duration_seconds": "Время обработки апдейта обработчиком",
+    "bot_handler_errors_total": "Исключения в обработчиках",
+    "wg_api_request_duration_seconds": "Время одного HTTP-запроса к wg-easy",
+    "wg_api_requests_total": "Запросы к wg-easy по результату",
+    "db_call_duration_seconds": "Время выполнения функции database.py в потоке БД",
+    "db_queue_wait_seconds": "Ожидание свободного потока БД",
+    "db_call_errors_total": "Исключения в функциях database.py",
+    "telegram_request_duration_seconds": "Время запроса к Telegram Bot API",
+    "telegram_requests_total": "Запросы к Telegram Bot API по HTTP-коду",
+    "telegram_request_errors_total": "Сетевые ошибки запросов к Telegram Bot API",
+    "cache_requests_total": "Обращения к кэшам по результату (hit, miss, stale, revalidate, reauth)",
+    "client_lock_wait_seconds": "Ожидание блокировки изменений клиента",
+    "telegram_send_wait_seconds": "Ожидание очереди отправки в Telegram (лимиты чата и бота)",
+    "telegram_flood_waits_total": "Ответы RetryAfter (flood control) от Telegram",
+}
+
+_lock = threading.Lock()
+_counters: dict[tuple, float] = {}      # (имя, метки) -> значение
+_histograms: dict[tuple, list] = {}     # (имя, метки) -> [счетчики по корзинам..., сумма, количество]
+
+
+def _key(name: str, labels: dict) -> tuple:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    key = _key(name, labels)
+    with _lock:
+        data = _histograms.get(key)
+        if data is None:
+            data = _histograms[key] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                data[i] += 1
+        data[-2] += seconds
+        data[-1] += 1
+
+
+def cache_result(cache: str, result: str) -> None:
+    """
+    Учет обращения к кэшу: result - hit, miss, stale, revalidate (отдан прошлый
+    снимок, обновляется в фоне) или reauth (сессия отвергнута сервером, повторный логин).
+    """
+    inc("cache_requests_total", cache=cache, result=result)
+
+
+@contextmanager
+def timer(name: str, errors: str | None = None, **labels):
+    """Замеряет блок в гистограмму name; исключение увеличивает счетчик errors."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        if errors and not isinstance(e, asyncio.CancelledError):
+            inc(errors, error=type(e).__name__, **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def instrument_handler(func):
+    """Декоратор обработчика апдейтов: задержка и ошибки с меткой handler=имя функции."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with timer("bot_handler_duration_seconds", errors="bot_handler_errors_total", handler=func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest, который замеряет каждый запрос к Bot API (метка method - sendMessage, sendPhoto...)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        with timer("telegram_request_duration_seconds", errors="telegram_request_errors_total", method=api_method):
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        inc("telegram_requests_total", method=api_method, code=code)
+        return code, payload
+
+
+# === ЭКСПОРТ ===
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus 0.0.4."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, list(v)) for k, v in _histograms.items())
+    lines, described = [], set()
+
+    def describe(name: str, kind: str) -> None:
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        describe(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+    for (name, labels), data in histograms:
+        describe(name, "histogram")
+        for bound, count in zip(BUCKETS, data):
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', f'{bound:g}'),))} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {data[-1]}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {data[-2]:.6f}")
+        lines.append(f"{name}_count{_format_labels(labels)} {data[-1]}")
+    return "\n".join(lines) + "\n"
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass  # заголовки не нужны
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/metrics", "/"):
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", render().encode("utf-8")
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+_server: asyncio.AbstractServer | None = None
+
+
+async def start_metrics_server(*_args) -> None:
+    """Запускает HTTP-сервер метрик (если METRICS_PORT != 0)."""
+    global _server
+    if not METRICS_PORT or _server is not None:
+        return
+    try:
+        _server = await asyncio.start_server(_serve, METRICS_HOST, METRICS_PORT)
+        logging.info(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        logging.error(f"Не удалось запустить сервер метрик на {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+
+async def stop_metrics_server(*_args) -> None:
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
@@ -0,0 +1,129 @@
+import os
+import json
+import asyncio
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from database import init_state_db, load_user_state, save_user_states, run_db
+
+# === СОХРАНЕНИЕ СОСТОЯНИЯ ДИАЛОГОВ ===
+# context.user_data (выбранный сервер, текущее действие, срок и т.п.) хранится
+# в SQLite (STATE_DB, по умолчанию DB_DIR/bot_state.db), поэтому после
+# перезапуска администратор продолжает с того же шага.
+#
+# Загрузка ленивая: при старте ничего не читается, состояние пользователя
+# подгружается при его первом апдейте (refresh_user_data), так что время
+# запуска не зависит от числа администраторов.
+#
+# Запись объединяется: Application раз в STATE_FLUSH_INTERVAL секунд отдает
+# состояния пользователей, у которых были апдейты. Неизмененные (тот же JSON,
+# что уже записан) пропускаются, остальные пишутся одной транзакцией.
+
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "10"))
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistence только для user_data; chat_data, bot_data и callback_data не хранятся."""
+
+    def __init__(self, db_path: str, update_interval: float = STATE_FLUSH_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.db_path = db_path
+        self._loads: dict[int, asyncio.Task] = {}   # user_id -> загрузка из БД (одна на пользователя)
+        self._written: dict[int, str] = {}          # user_id -> последний записанный JSON
+        self._pending: dict[int, str | None] = {}   # ждут записи; None - удалить
+        self._flush_task: asyncio.Task | None = None
+
+    # --- user_data ---
+    async def get_user_data(self) -> dict:
+        # Вызывается один раз при старте: только готовим таблицу, данные грузятся лениво
+        await run_db(init_state_db, self.db_path)
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        task = self._loads.get(user_id)
+        if task is None:
+            task = self._loads[user_id] = asyncio.ensure_future(run_db(load_user_state, self.db_path, user_id))
+        try:
+            data = await task
+        except Exception as e:
+            self._loads.pop(user_id, None)  # повторим при следующем апдейте
+            logging.error(f"Не удалось загрузить состояние пользователя {user_id}: {e}")
+            return
+        if data is not None and user_id not in self._written:
+            # Первый апдейт после запуска: восстанавливаем сохраненное состояние
+            self._written[user_id] = data
+            if not user_data:
+                user_data.update(json.loads(data))
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        payload = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+        if self._pending.get(user_id, self._written.get(user_id)) == payload:
+            return
+        self._pending[user_id] = payload
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending[user_id] = None
+        self._schedule_flush()
+
+    # --- запись ---
+    def _schedule_flush(self) -> None:
+        # Application вызывает update_user_data для всех пользователей разом (gather):
+        # задача записи стартует после них и забирает всю пачку
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        while self._pending:
+            batch, self._pending = self._pending, {}
+            try:
+                await run_db(save_user_states, self.db_path, batch)
+            except Exception as e:
+                logging.error(f"Не удалось сохранить состояние {len(batch)} пользователей: {e}")
+                # Вернем в очередь то, что не успели перезаписать более новым состоянием
+                for user_id, payload in batch.items(): self._pending.setdefault(user_id, payload)
+                return
+            for user_id, payload in batch.items():
+                if payload is None: self._written.pop(user_id, None)
+                else: self._written[user_id] = payload
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
+
+    # --- не используются (store_data их выключает) ---
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data: dict) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
@@ -0,0 +1,87 @@
+import os
+import asyncio
+import logging
+import importlib.util
+from io import BytesIO
+
+# === ГЕНЕРАЦИЯ QR-КОДОВ ===
+# QR строится локально из текста конфига (segno), без запроса qrcode.svg к API.
+# Рендер и конвертация SVG->PNG (запасной режим через API) - CPU-работа, поэтому
+# выполняются в пуле процессов: event loop не блокируется, а массовые операции
+# загружают все ядра. Тяжелые библиотеки импортируются только в процессах пула,
+# а сам пул (и multiprocessing) - при первом QR, а не при запуске бота.
+#
+# Процессы пула запускаются через spawn и заранее импортируют библиотеку рендера
+# (initializer). spawn импортирует в каждом процессе и главный модуль, поэтому
+# bot.py - только точка входа без побочных эффектов, а сам бот - в app.py.
+
+QR_RENDER_MODE = os.getenv("QR_RENDER_MODE", "local").lower()  # local | svg
+QR_SCALE = int(os.getenv("QR_SCALE", "8"))                       # пикселей на модуль
+QR_BORDER = int(os.getenv("QR_BORDER", "4"))                     # рамка в модулях
+QR_ERROR_LEVEL = os.getenv("QR_ERROR_LEVEL", "M").upper()        # L | M | Q | H
+QR_WORKERS = int(os.getenv("QR_WORKERS", "0")) or None           # 0 - по числу ядер
+
+_executor = None  # ProcessPoolExecutor, создается при первом использовании
+_local_available: bool | None = None
+
+
+def local_rendering_enabled() -> bool:
+    """True, если включен локальный режим и установлен segno."""
+    global _local_available
+    if QR_RENDER_MODE != "local":
+        return False
+    if _local_available is None:
+        _local_available = importlib.util.find_spec("segno") is not None
+        if not _local_available:
+            logging.warning("segno не установлен, QR будет запрашиваться у API (qrcode.svg).")
+    return _local_available
+
+
+def _render_png(text: str, scale: int, border: int, error: str) -> bytes:
+    import segno
+    buffer = BytesIO()
+    segno.make_qr(text, error=error, boost_error=False).save(buffer, kind="png", scale=scale, border=border)
+    return buffer.getvalue()
+
+
+def _svg_to_png(svg: bytes) -> bytes:
+    import cairosvg
+    return cairosvg.svg2png(bytestring=svg)
+
+
+def _init_worker() -> None:
+    """initializer процесса пула: заранее импортирует библиотеку рендера."""
+    if local_rendering_enabled():
+        import segno  # noqa: F401
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        # spawn: процессы пула не наследуют потоки и соединения основного процесса
+        _executor = ProcessPoolExecutor(max_workers=QR_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker)
+    return _executor
+
+
+async def _run(func, *args) -> bytes:
+    return await asyncio.wrap_future(_get_executor().submit(func, *args))
+
+
+async def render_qr_png(text: str, scale: int = QR_SCALE, error: str = QR_ERROR_LEVEL, border: int = QR_BORDER) -> bytes:
+    """Строит PNG с QR-кодом для текста (конфига) в пуле процессов."""
+    return await _run(_render_png, text, scale, border, error)
+
+
+async def svg_to_png(svg: bytes) -> bytes:
+    """Конвертирует SVG (qrcode.svg с API) в PNG в пуле процессов."""
+    return await _run(_svg_to_png, svg)
+
+
+def shutdown_qr_pool() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
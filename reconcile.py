@@ -0,0 +1,205 @@
+import os
+import html
+import asyncio
+import logging
+
+from database import (
+    load_api_snapshot, get_client_changes, get_reconcile_state, commit_reconciliation, get_reconcile_issues,
+    get_all_clients, get_clients_by_names, save_clients, set_clients_status, delete_clients, run_db,
+)
+from wg_api import get_client_directory
+from servers import prepare_server
+from locks import client_locks
+
+# === СВЕРКА БД С API ===
+# Периодическая задача сравнивает таблицу clients с клиентами wg-easy и находит
+# расхождения: клиент есть в БД, но нет на API (missing_on_api), есть на API, но
+# нет в БД (missing_in_db), или статус в БД не совпадает с enabled на API
+# (status_mismatch). Открытые расхождения хранятся в reconcile_issues.
+#
+# Проход инкрементальный. Список клиентов API сравнивается со снимком прошлого
+# прохода (api_snapshot, копия в памяти) по (name, enabled, updatedAt), а
+# изменения в БД берутся из журнала client_changes, который ведут триггеры.
+# Проверяются только имена, затронутые с прошлого раза; полный проход - только
+# первый. Весь проход по БД - один вызов run_db.
+#
+# RECONCILE_REPAIR - что исправлять автоматически (через запятую), по умолчанию
+# только отчет:
+#   status - статус в БД приводится к enabled на API;
+#   import - клиенты с API без записи в БД добавляются в БД без срока;
+#   prune  - записи БД без клиента на API удаляются.
+# Исправления - отдельный проход под блокировками клиентов (locks.client_locks)
+# со свежим списком API: создание или удаление того же имени, начатое
+# параллельно, успевает завершиться и не перезаписывается сверкой.
+
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "900"))
+RECONCILE_REPAIR = {item.strip() for item in os.getenv("RECONCILE_REPAIR", "").lower().split(",") if item.strip()}
+ISSUE_LABELS = {
+    "missing_on_api": "❓ нет на API",
+    "missing_in_db": "👻 нет в БД",
+    "status_mismatch": "↔️ статус",
+}
+REPAIR_BY_KIND = {"status_mismatch": "status", "missing_in_db": "import", "missing_on_api": "prune"}
+
+_snapshots: dict[str, dict] = {}  # db_path -> {client_id: (name, enabled, updated_at)}
+
+
+def _diff_issue(name: str, db_row: tuple | None, api_enabled: bool | None):
+    """(kind, detail) для имени или None, если БД и API согласованы."""
+    if db_row is not None and api_enabled is None:
+        return "missing_on_api", None
+    if db_row is None and api_enabled is not None:
+        return "missing_in_db", "вкл" if api_enabled else "выкл"
+    if db_row is not None and (db_row[2] == "enabled") != api_enabled:
+        return "status_mismatch", f"БД: {db_row[2]}, API: {'вкл' if api_enabled else 'выкл'}"
+    return None
+
+
+def _reconcile_db(db_path: str, current: dict, repair: set, locked: set = frozenset()) -> dict:
+    """
+    Синхронная часть прохода (в потоке БД). current - {client_id: (name, enabled, updated_at)}
+    по данным API. Исправляются только имена из locked (их блокировки держит
+    вызывающий). Возвращает результат прохода.
+    """
+    previous = _snapshots.get(db_path)
+    if previous is None:
+        previous = load_api_snapshot(db_path)
+    full = get_reconcile_state(db_path, "initialized") is None
+
+    upserts = {cid: state for cid, state in current.items() if previous.get(cid) != state}
+    removed_ids = [cid for cid in previous if cid not in current]
+    db_changed, last_seq = get_client_changes(db_path)
+
+    if full:
+        names = {row[0] for row in get_all_clients(db_path)} | {state[0] for state in current.values()}
+    else:
+        names = set(db_changed)
+        names.update(state[0] for state in upserts.values())
+        names.update(previous[cid][0] for cid in upserts if cid in previous)
+        names.update(previous[cid][0] for cid in removed_ids)
+        if repair:
+            # Открытые расхождения тоже перепроверяем - их можно исправить, если исправления включили позже
+            names.update(row[0] for row in get_reconcile_issues(db_path))
+
+    api_enabled = {}
+    for name, enabled, _ in current.values():
+        api_enabled[name] = api_enabled.get(name, False) or enabled
+    db_rows = get_clients_by_names(db_path, names)
+
+    issues = {}
+    for name in names:
+        issue = _diff_issue(name, db_rows.get(name), api_enabled.get(name))
+        if issue: issues[name] = issue
+
+    # Исправления меняют clients - триггеры запишут их в журнал, и следующий проход их перепроверит
+    repaired = {}
+    fixable = {name: issue for name, issue in issues.items() if name in locked}
+    if "status" in repair:
+        mismatched = [name for name, (kind, _) in fixable.items() if kind == "status_mismatch"]
+        for status in ("enabled", "disabled"):
+            batch = [name for name in mismatched if (status == "enabled") == api_enabled[name]]
+            if batch and set_clients_status(db_path, batch, status):
+                repaired.update((name, "status") for name in batch)
+    if "import" in repair:
+        orphans = [name for name, (kind, _) in fixable.items() if kind == "missing_in_db"]
+        if orphans and save_clients(db_path, [(name, None) for name in orphans]):
+            set_clients_status(db_path, [name for name in orphans if not api_enabled[name]], "disabled")
+            repaired.update((name, "import") for name in orphans)
+    if "prune" in repair:
+        orphans = [name for name, (kind, _) in fixable.items() if kind == "missing_on_api"]
+        if orphans and delete_clients(db_path, orphans):
+            repaired.update((name, "prune") for name in orphans)
+    for name in repaired:
+        issues.pop(name, None)
+
+    new_issues = commit_reconciliation(db_path, upserts, removed_ids, names, issues, last_seq)
+    _snapshots[db_path] = current
+    return {"checked": len(names), "full": full, "new_issues": sorted(new_issues), "repaired": repaired}
+
+
+async def _api_state(server: dict) -> dict | None:
+    """{client_id: (name, enabled, updated_at)} по свежему списку API или None."""
+    directory = await get_client_directory(server["url"], server["password"], fresh=True)
+    if directory is None or directory.stale:
+        return None
+    return {c["id"]: (c["name"], bool(c.get("enabled", True)), c.get("updatedAt")) for c in directory.clients}
+
+
+async def reconcile_server(server_key: str, server: dict, repair: set | None = None) -> dict:
+    """Один проход сверки сервера. Без свежего списка клиентов API сервер пропускается."""
+    db_path = await prepare_server(server)
+    result = {"server_name": server["name"], "db_path": db_path, "checked": 0, "new_issues": [], "repaired": {}}
+    repair = RECONCILE_REPAIR if repair is None else set(repair)
+    current = await _api_state(server)
+    if current is None:
+        result["error"] = "API недоступен"
+        return result
+    result.update(await run_db(_reconcile_db, db_path, current, set()))
+    targets = [name for name, kind, _, _ in await run_db(get_reconcile_issues, db_path) if REPAIR_BY_KIND.get(kind) in repair]
+    if targets:
+        async with client_locks(server_key, targets):
+            # Список API берем заново: за время ожидания блокировок клиентов могли создать или удалить
+            current = await _api_state(server)
+            if current is not None:
+                fixed = await run_db(_reconcile_db, db_path, current, repair, set(targets))
+                result["checked"] = max(result["checked"], fixed["checked"])
+                still_open = {row[0] for row in await run_db(get_reconcile_issues, db_path)}
+                result["new_issues"] = sorted((set(result["new_issues"]) | set(fixed["new_issues"])) & still_open)
+                result["repaired"] = fixed["repaired"]
+    if result["checked"]:
+        logging.info(f"Сверка {server_key}: проверено {result['checked']}, новых расхождений {len(result['new_issues'])}, "
+                     f"исправлено {len(result['repaired'])}{' (полный проход)' if result['full'] else ''}.")
+    return result
+
+
+async def reconcile_all(servers: dict) -> list:
+    """Сверяет все серверы параллельно. Возвращает список результатов по серверам."""
+    keys = list(servers)
+    results = await asyncio.gather(
+        *(reconcile_server(key, servers[key]) for key in keys), return_exceptions=True
+    )
+    summary = []
+    for key, result in zip(keys, results):
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка сверки {key}: {result!r}")
+            result = {"server_name": servers[key]["name"], "db_path": servers[key]["db_path"],
+                      "checked": 0, "new_issues": [], "repaired": {}, "error": str(result)}
+        summary.append(result)
+    return summary
+
+
+def format_reconcile_summary(summary: list) -> str | None:
+    """Текст для администраторов о новых расхождениях и исправлениях или None."""
+    lines = []
+    for result in summary:
+        if not result["new_issues"] and not result["repaired"]:
+            continue
+        lines.append(f"<b>{html.escape(result['server_name'])}</b>")
+        if result["new_issues"]:
+            names = result["new_issues"]
+            lines.append(f"⚠️ Новые расхождения: {len(names)} — {html.escape(', '.join(names[:50]))}")
+            if len(names) > 50: lines.append(f"... и еще {len(names) - 50}")
+        if result["repaired"]:
+            lines.append(f"🛠 Исправлено: {len(result['repaired'])} — {html.escape(', '.join(list(result['repaired'])[:50]))}")
+    if not lines:
+        return None
+    return "🔁 Сверка БД с API\n\n" + "\n".join(lines)
+
+
+async def format_reconcile_report(summary: list, limit: int = 30) -> str:
+    """Полный отчет об открытых расхождениях по серверам (для команды /reconcile)."""
+    lines = ["🔁 <b>Сверка БД с API</b>"]
+    for result in summary:
+        name = html.escape(result["server_name"])
+        if result.get("error"):
+            lines.append(f"\n⚠️ <b>{name}</b>: {html.escape(result['error'])}")
+            continue
+        issues = await run_db(get_reconcile_issues, result["db_path"])
+        repaired = f", исправлено {len(result['repaired'])}" if result["repaired"] else ""
+        lines.append(f"\n<b>{name}</b>: расхождений {len(issues)}{repaired}")
+        for client_name, kind, detail, _ in issues[:limit]:
+            suffix = f" ({html.escape(detail)})" if detail else ""
+            lines.append(f"{ISSUE_LABELS.get(kind, kind)}: <b>{html.escape(client_name)}</b>{suffix}")
+        if len(issues) > limit:
+            lines.append(f"... и еще {len(issues) - limit}")
+    return "\n".join(lines)
@@ -0,0 +1,183 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from metrics import inc, observe
+
+# === ОЧЕРЕДЬ ОТПРАВКИ В TELEGRAM ===
+# Все запросы бота к Bot API проходят через SendScheduler (rate_limiter
+# Application). Отправка сообщений берет токен из двух ведер:
+#   ведро чата  - SEND_CHAT_RATE сообщений/с (в группах SEND_GROUP_RATE) с
+#                 запасом SEND_CHAT_BURST (в группах SEND_GROUP_BURST) на
+#                 серии: создание клиента, конфиг и QR - это около 5 сообщений
+#                 подряд, и они не должны ждать по секунде;
+#   общее ведро - SEND_GLOBAL_RATE сообщений/с на всего бота.
+# Это лимиты Telegram, поэтому массовая отправка идет на максимальной
+# допустимой скорости, не упираясь во flood control. Редактирование (меню,
+# страницы списка) берет только общий токен - это ответ на нажатие кнопки, а
+# не новое сообщение в чат. Остальные методы (answerCallbackQuery,
+# answerInlineQuery, getMe и т.п.) не ограничиваются.
+#
+# Приоритет: ответы на действия пользователя идут первыми, фоновые рассылки
+# (rate_limit_args=BULK) ждут, пока очередь интерактивных пуста, и не берут
+# последние SEND_BULK_RESERVE токенов общего ведра. В ведре чата рассылка
+# ждет полного запаса и берет из него один токен: сколько бы уведомлений ни
+# пришло раньше, ответ админу найдет почти весь запас серии.
+#
+# RetryAfter (429): ведро чата (или общее, если чата нет) замирает на
+# указанное Telegram время, и запрос повторяется - до SEND_RETRIES раз.
+# Запрос, который не ждет ведро чата, сам выжидает это время перед повтором.
+
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", str(20 / 60)))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "10"))
+SEND_GROUP_BURST = int(os.getenv("SEND_GROUP_BURST", "3"))
+SEND_BULK_RESERVE = int(os.getenv("SEND_BULK_RESERVE", "5"))
+SEND_RETRIES = int(os.getenv("SEND_RETRIES", "3"))
+
+BULK = "bulk"  # rate_limit_args для фоновых рассылок
+INTERACTIVE_PRIORITY, BULK_PRIORITY = 0, 1
+THROTTLED_PREFIXES = ("send", "copy", "forward", "edit")
+CHAT_EXEMPT_PREFIXES = ("edit",)  # только общее ведро
+UNTHROTTLED_ENDPOINTS = {"sendChatAction"}
+CHAT_BUCKETS_LIMIT = 1000  # сверх этого простаивающие ведра чатов удаляются
+
+_sequence = itertools.count()
+
+
+class TokenBucket:
+    """Ведро токенов с очередью ожидающих по приоритету (меньше - раньше)."""
+
+    def __init__(self, rate: float, capacity: float, bulk_reserve: float = 0):
+        self.rate, self.capacity, self.bulk_reserve = rate, capacity, bulk_reserve
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: list = []  # куча (приоритет, номер, future)
+        self._timer: asyncio.TimerHandle | None = None
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _needed(self, priority: int) -> float:
+        return 1 + (self.bulk_reserve if priority else 0)
+
+    def _dispatch(self) -> None:
+        """Раздает накопленные токены ожидающим и планирует следующую раздачу."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        self._refill(now)
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.done():  # ожидание отменено
+                heapq.heappop(self._waiters)
+                continue
+            if now < self._paused_until or self._tokens < self._needed(priority):
+                break
+            heapq.heappop(self._waiters)
+            self._tokens -= 1
+            future.set_result(None)
+        if self._waiters:
+            priority = self._waiters[0][0]
+            delay = max(self._paused_until - now, (self._needed(priority) - self._tokens) / self.rate, 0.001)
+            self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    async def acquire(self, priority: int = INTERACTIVE_PRIORITY) -> None:
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(_sequence), future))
+        self._dispatch()
+        await future
+
+    def pause(self, seconds: float) -> None:
+        """Останавливает выдачу токенов на seconds (ответ RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._dispatch()
+
+    def idle(self) -> bool:
+        self._refill(time.monotonic())
+        return not self._waiters and self._tokens >= self.capacity and time.monotonic() >= self._paused_until
+
+    def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+
+def _seconds(retry_after) -> float:
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class SendScheduler(BaseRateLimiter[str]):
+    """Ограничитель запросов к Bot API: ведра чатов и общее, приоритет, повтор после RetryAfter."""
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 group_rate: float = SEND_GROUP_RATE, chat_burst: int = SEND_CHAT_BURST,
+                 group_burst: int = SEND_GROUP_BURST, bulk_reserve: int = SEND_BULK_RESERVE,
+                 retries: int = SEND_RETRIES):
+        self.chat_rate, self.group_rate, self.retries = chat_rate, group_rate, retries
+        self.chat_burst, self.group_burst = chat_burst, group_burst
+        self._global = TokenBucket(global_rate, global_rate, bulk_reserve)
+        self._chats: dict = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        for bucket in (self._global, *self._chats.values()):
+            bucket.close()
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS_LIMIT:
+                for key in [key for key, b in self._chats.items() if b.idle()]:
+                    del self._chats[key]
+            # Личные чаты - положительные id, группы и каналы - отрицательные id или @username
+            private = isinstance(chat_id, int) and chat_id > 0
+            rate, burst = (self.chat_rate, self.chat_burst) if private else (self.group_rate, self.group_burst)
+            # Рассылке нужен полный запас (1 + burst - 1), после нее в ведре остается burst - 1
+            bucket = self._chats[chat_id] = TokenBucket(rate, burst, bulk_reserve=max(0, burst - 1))
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = BULK_PRIORITY if rate_limit_args == BULK else INTERACTIVE_PRIORITY
+        chat_id = data.get("chat_id")
+        throttled = chat_id is not None and endpoint.startswith(THROTTLED_PREFIXES) and endpoint not in UNTHROTTLED_ENDPOINTS
+        per_chat = throttled and not endpoint.startswith(CHAT_EXEMPT_PREFIXES)
+        if isinstance(chat_id, str) and chat_id.lstrip("-").isdigit():
+            chat_id = int(chat_id)
+        for attempt in itertools.count():
+            if throttled:
+                start = time.perf_counter()
+                if per_chat:
+                    await self._chat_bucket(chat_id).acquire(priority)
+                await self._global.acquire(priority)
+                observe("telegram_send_wait_seconds", time.perf_counter() - start, priority="bulk" if priority else "interactive")
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.retries:
+                    raise
+                delay = _seconds(e.retry_after)
+                inc("telegram_flood_waits_total", endpoint=endpoint)
+                logging.warning(f"Telegram RetryAfter {delay:g} с для {endpoint} (чат {chat_id}), повтор {attempt + 1}/{self.retries}.")
+                if throttled:
+                    self._chat_bucket(chat_id).pause(delay)
+                elif chat_id is None:
+                    # Ограничение не привязано к чату - ждут все отправки бота
+                    self._global.pause(delay)
+                if not per_chat:
+                    await asyncio.sleep(delay)
@@ -0,0 +1,184 @@
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+
+from database import init_db, run_db, scoped_db_path, SERVER_KEY_PATTERN
+from wg_api import close_api_client
+
+# === РЕЕСТР СЕРВЕРОВ ===
+# Список серверов читается из JSON-файла SERVERS_FILE (любое число серверов,
+# у каждого может быть свой пароль wg-easy):
+#   [{"key": "germany", "name": "🇩🇪 Germany", "url": "http://1.2.3.4:51821", "password": "..."}]
+# Без пароля берется SESSION_PASSWORD. Если файла нет - серверы берутся из
+# переменных SERVER<N>_KEY / _NAME / _URL / _PASSWORD (N - любое число).
+#
+# Файл перечитывается на лету: get_servers() не чаще раза в SERVERS_RELOAD_CHECK
+# секунд сверяет mtime, и новый список подхватывается без перезапуска бота.
+# У удаленных и измененных серверов закрываются пул соединений и сессия.
+# БД сервера открывается и мигрирует лениво - при первом обращении к нему
+# (prepare_server), поэтому время запуска не зависит от числа серверов.
+#
+# Если задан DB_FILE, все серверы хранятся в одном файле SQLite (строки
+# различаются server_key, см. database.py); перенести туда существующие
+# файлы DB_DIR/<key>.db - python consolidate_db.py.
+#
+# Ключ сервера - буквы, цифры, "_", "." и "-" (SERVER_KEY_PATTERN): он входит
+# в имя файла БД и в db_path "<файл>#<key>" общей БД. Серверы с другими
+# ключами пропускаются при загрузке с предупреждением в логе.
+
+SERVERS_FILE = os.getenv("SERVERS_FILE", "servers.json")
+SERVERS_RELOAD_CHECK = float(os.getenv("SERVERS_RELOAD_CHECK", "5"))
+DB_FILE = os.getenv("DB_FILE", "")
+
+_db_dir = os.getenv("DB_DIR", "db")
+_servers: dict[str, dict] = {}
+_source_mtime: float | None = None
+_checked_at: float | None = None
+_ready: set[str] = set()                 # db_path, прошедшие init_db
+_ready_locks: dict[str, asyncio.Lock] = {}
+_closing: set = set()
+_warm_up_task: asyncio.Task | None = None
+
+
+def server_db_file(db_dir: str, key: str) -> str:
+    """Отдельный файл БД сервера (режим без DB_FILE)."""
+    return os.path.join(db_dir, f"{key}.db")
+
+
+def _server_entry(key: str, name: str, url: str, password: str | None, db_dir: str) -> dict:
+    return {
+        "key": key,
+        "name": name or key,
+        "url": url.rstrip("/"),
+        "password": password or os.getenv("SESSION_PASSWORD"),
+        "db_path": scoped_db_path(DB_FILE, key) if DB_FILE else server_db_file(db_dir, key),
+    }
+
+
+def _load_from_file(path: str, db_dir: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get("servers", [])
+    servers = {}
+    for item in data:
+        key, url = str(item.get("key", "")).strip(), str(item.get("url", "")).strip()
+        if not key or not url or not SERVER_KEY_PATTERN.fullmatch(key):
+            logging.warning(f"{path}: пропущена запись сервера без корректных key/url: {item.get('key')!r}")
+            continue
+        servers[key] = _server_entry(key, item.get("name"), url, item.get("password"), db_dir)
+    return servers
+
+
+def _load_from_env(db_dir: str) -> dict:
+    servers = {}
+    numbers = sorted(int(m.group(1)) for var in os.environ if (m := re.fullmatch(r"SERVER(\d+)_KEY", var)))
+    for n in numbers:
+        key, name, url = os.getenv(f"SERVER{n}_KEY"), os.getenv(f"SERVER{n}_NAME"), os.getenv(f"SERVER{n}_URL")
+        if not (key and name and url):
+            continue
+        if not SERVER_KEY_PATTERN.fullmatch(key):
+            logging.warning(f"SERVER{n}_KEY: пропущен сервер с некорректным ключом {key!r} (допустимы буквы, цифры, _ . -)")
+            continue
+        servers[key] = _server_entry(key, name, url, os.getenv(f"SERVER{n}_PASSWORD"), db_dir)
+    return servers
+
+
+def _close_later(base_url: str) -> None:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # вне event loop соединений еще нет
+    task = loop.create_task(close_api_client(base_url))
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
+
+
+def _apply(new_servers: dict) -> None:
+    """Подменяет реестр, закрывая соединения удаленных и измененных серверов."""
+    global _servers
+    for key, old in _servers.items():
+        new = new_servers.get(key)
+        if new is None or new["url"] != old["url"] or new["password"] != old["password"]:
+            _close_later(old["url"])
+    if _servers and new_servers != _servers:
+        added, removed = new_servers.keys() - _servers.keys(), _servers.keys() - new_servers.keys()
+        logging.info(f"Реестр серверов обновлен: {len(new_servers)} шт. (+{len(added)} / -{len(removed)}).")
+    _servers = new_servers
+
+
+def load_servers(force: bool = False) -> dict:
+    """Загружает (перезагружает при изменении файла) реестр серверов. Возвращает {key: server}."""
+    global _source_mtime, _checked_at
+    now = time.monotonic()
+    loaded = _checked_at is not None
+    if not force and loaded and now - _checked_at < SERVERS_RELOAD_CHECK:
+        return _servers
+    _checked_at = now
+    try:
+        mtime = os.stat(SERVERS_FILE).st_mtime
+    except OSError:
+        mtime = None
+    if not force and loaded and mtime == _source_mtime:
+        return _servers
+    try:
+        servers = _load_from_file(SERVERS_FILE, _db_dir) if mtime is not None else _load_from_env(_db_dir)
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        # Битый файл не должен ронять бота - остаемся на прежнем списке до следующего изменения файла
+        _source_mtime = mtime
+        logging.error(f"Ошибка чтения {SERVERS_FILE}: {e}. Используется прежний список серверов.")
+        return _servers
+    _source_mtime = mtime
+    _apply(servers)
+    return _servers
+
+
+def get_servers() -> dict:
+    """Текущий реестр серверов {key: server}. server - dict с key, name, url, password, db_path."""
+    return load_servers()
+
+
+def get_server(key: str | None) -> dict | None:
+    return get_servers().get(key) if key else None
+
+
+async def prepare_server(server: dict) -> str:
+    """Готовит БД сервера при первом обращении (init_db один раз на файл). Возвращает db_path."""
+    db_path = server["db_path"]
+    if db_path in _ready:
+        return db_path
+    lock = _ready_locks.setdefault(db_path, asyncio.Lock())
+    async with lock:
+        if db_path not in _ready:
+            await run_db(init_db, db_path)
+            _ready.add(db_path)
+    return db_path
+
+
+def warm_up() -> None:
+    """
+    Фоном готовит БД всех серверов реестра (init_db), не задерживая запуск:
+    к первому выбору сервера миграции уже проверены. Пользователь, выбравший
+    сервер раньше, просто подождет ту же подготовку в prepare_server.
+    """
+    global _warm_up_task
+
+    async def _run() -> None:
+        for key, server in list(get_servers().items()):
+            try:
+                await prepare_server(server)
+            except Exception as e:
+                logging.error(f"Не удалось подготовить БД сервера {key}: {e}")
+
+    if _warm_up_task is None or _warm_up_task.done():
+        _warm_up_task = asyncio.get_running_loop().create_task(_run())
+
+
+def configure(db_dir: str) -> dict:
+    """Задает каталог БД и загружает реестр (вызывается при запуске бота)."""
+    global _db_dir
+    _db_dir = db_dir
+    return load_servers(force=True)
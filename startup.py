@@ -0,0 +1,50 @@
+import sys
+import time
+import logging
+
+# === ПРОФИЛЬ ЗАПУСКА ===
+# python bot.py --profile-startup печатает, сколько заняли этапы запуска:
+# импорт модулей, чтение настроек и реестра серверов, сборка Application,
+# initialize (getMe, хранилище состояния) и время до первого апдейта.
+# Отсчет - от импорта этого модуля (первым делом в app.py).
+
+PROFILE = "--profile-startup" in sys.argv
+
+_started = time.perf_counter()
+_marks: list[tuple[str, float]] = []
+_first_update_seen = False
+
+
+def mark(phase: str) -> None:
+    """Отмечает конец этапа запуска."""
+    _marks.append((phase, time.perf_counter()))
+
+
+def report() -> str:
+    lines, previous = ["⏱ Профиль запуска:"], _started
+    for phase, at in _marks:
+        lines.append(f"  {phase:<28} {(at - previous) * 1000:8.1f} мс   (всего {(at - _started) * 1000:8.1f} мс)")
+        previous = at
+    return "\n".join(lines)
+
+
+def _print_report() -> None:
+    text = report()
+    print(text, flush=True)
+    logging.info(text)
+
+
+async def profile_initialized(*_args) -> None:
+    """post_init: Application готов (getMe выполнен, хранилище открыто)."""
+    if PROFILE:
+        mark("initialize (getMe и др.)")
+        _print_report()
+
+
+async def profile_first_update(*_args) -> None:
+    """Обработчик группы -1: отмечает первый полученный апдейт и печатает итог."""
+    global _first_update_seen
+    if PROFILE and not _first_update_seen:
+        _first_update_seen = True
+        mark("до первого апдейта")
+        _print_report()
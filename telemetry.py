@@ -0,0 +1,129 @@
+import os
+import html
+import time
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from database import record_traffic_sample, get_top_talkers, get_inactive_clients, run_db
+from wg_api import get_client_directory
+from servers import prepare_server
+
+# === ТЕЛЕМЕТРИЯ ТРАФИКА И РУКОПОЖАТИЙ ===
+# Раз в TELEMETRY_INTERVAL секунд берется список клиентов wg-easy (тот же
+# кэшированный запрос, что и для списка клиентов) и из transferRx/transferTx
+# считаются дельты с прошлого замера. Дельты сразу добавляются в три ряда:
+#   traffic_raw    - корзины по интервалу сбора, хранятся TELEMETRY_RAW_HOURS;
+#   traffic_hourly - по часам, TELEMETRY_HOURLY_DAYS;
+#   traffic_daily  - по суткам (UTC), TELEMETRY_DAILY_DAYS.
+# Отчеты читают самый грубый ряд, которого хватает для окна, диапазоном по
+# первичному ключу (bucket, name). "Неактивные" - диапазон по индексу active_at
+# в traffic_last. Пиры без трафика строк в рядах не занимают.
+
+TELEMETRY_INTERVAL = int(os.getenv("TELEMETRY_INTERVAL", "300"))
+TELEMETRY_RAW_HOURS = int(os.getenv("TELEMETRY_RAW_HOURS", "48"))
+TELEMETRY_HOURLY_DAYS = int(os.getenv("TELEMETRY_HOURLY_DAYS", "30"))
+TELEMETRY_DAILY_DAYS = int(os.getenv("TELEMETRY_DAILY_DAYS", "400"))
+INACTIVE_DAYS = int(os.getenv("INACTIVE_DAYS", "30"))
+
+BUCKETS = {"traffic_raw": max(TELEMETRY_INTERVAL, 60), "traffic_hourly": 3600, "traffic_daily": 86400}
+RETENTION = {
+    "traffic_raw": TELEMETRY_RAW_HOURS * 3600,
+    "traffic_hourly": TELEMETRY_HOURLY_DAYS * 86400,
+    "traffic_daily": TELEMETRY_DAILY_DAYS * 86400,
+}
+
+
+def _parse_ts(value) -> int | None:
+    """ISO-время wg-easy (latestHandshakeAt) в секунды Unix."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def _samples(api_clients: list) -> list:
+    return [(c["id"], c["name"], int(c.get("transferRx") or 0), int(c.get("transferTx") or 0), _parse_ts(c.get("latestHandshakeAt")))
+            for c in api_clients if c.get("id") and c.get("name")]
+
+
+async def collect_server(server: dict) -> int | None:
+    """Один замер сервера. Возвращает число клиентов с трафиком или None, если API недоступен."""
+    db_path = await prepare_server(server)
+    directory = await get_client_directory(server["url"], server["password"], fresh=True)
+    if directory is None or directory.stale:
+        return None  # по устаревшему снимку дельты были бы нулевыми, а "неактивные" - ложными
+    return await run_db(record_traffic_sample, db_path, int(time.time()), _samples(directory.clients), BUCKETS, RETENTION)
+
+
+async def collect_all(servers: dict) -> None:
+    """Замер всех серверов параллельно; ошибки одного сервера не мешают остальным."""
+    keys = list(servers)
+    results = await asyncio.gather(*(collect_server(servers[key]) for key in keys), return_exceptions=True)
+    for key, result in zip(keys, results):
+        if isinstance(result, Exception):
+            logging.error(f"Ошибка сбора телеметрии {key}: {result!r}")
+        elif result is None:
+            logging.info(f"Телеметрия {key}: API недоступен, замер пропущен.")
+
+
+def _source_table(window: int) -> str:
+    """Самый грубый ряд, корзины которого не крупнее окна и который хранится не меньше окна."""
+    for table in ("traffic_daily", "traffic_hourly", "traffic_raw"):
+        if BUCKETS[table] * 2 <= window <= RETENTION[table]:
+            return table
+    return "traffic_raw" if window <= RETENTION["traffic_raw"] else "traffic_daily"
+
+
+def format_bytes(value: int) -> str:
+    for unit in ("Б", "КБ", "МБ", "ГБ"):
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == "Б" else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} ТБ"
+
+
+def _format_age(ts: int, now: int) -> str:
+    days = (now - ts) // 86400
+    return f"{days} дн." if days else "< 1 дн."
+
+
+def parse_window(arg: str | None, default_days: int = 7) -> int | None:
+    """Окно отчета в секундах из аргумента команды: "7" / "7d" - дни, "6h" - часы."""
+    if not arg:
+        return default_days * 86400
+    arg = arg.strip().lower()
+    unit = 3600 if arg.endswith("h") else 86400
+    try:
+        value = int(arg.rstrip("hd"))
+    except ValueError:
+        return None
+    return value * unit if value > 0 else None
+
+
+async def format_traffic_report(server: dict, window: int, limit: int = 10) -> str:
+    """Отчет для команды /traffic: топ по трафику за окно и клиенты без рукопожатий INACTIVE_DAYS дней."""
+    db_path = await prepare_server(server)
+    now = int(time.time())
+    table = _source_table(window)
+    top = await run_db(get_top_talkers, db_path, table, now - window, limit)
+    inactive_total, inactive = await run_db(get_inactive_clients, db_path, now - INACTIVE_DAYS * 86400, limit * 3)
+
+    period = f"{window // 3600} ч" if window < 86400 else f"{window // 86400} дн."
+    lines = [f"📊 <b>{html.escape(server['name'])}</b>: трафик за {period}"]
+    if not top: lines.append("<i>Нет данных (телеметрия собирается раз в "
+                             f"{TELEMETRY_INTERVAL // 60} мин.).</i>")
+    for i, (name, rx, tx) in enumerate(top, 1):
+        lines.append(f"{i}. <b>{html.escape(name)}</b> — {format_bytes(rx + tx)} (⬇️ {format_bytes(tx)} · ⬆️ {format_bytes(rx)})")
+    lines.append(f"\n💤 Без рукопожатий {INACTIVE_DAYS}+ дн.: {inactive_total}")
+    for name, handshake_at, active_at in inactive:
+        seen = f"последнее {_format_age(handshake_at, now)} назад" if handshake_at else f"не было, на API {_format_age(active_at, now)}"
+        lines.append(f"• <b>{html.escape(name)}</b> — {seen}")
+    if inactive_total > len(inactive):
+        lines.append(f"... и еще {inactive_total - len(inactive)}")
+    return "\n".join(lines)
@@ -0,0 +1,58 @@
+import io
+import csv
+import asyncio
+import zipfile
+
+import bulk
+
+
+class _Directory:
+    def __init__(self, names):
+        self.by_name = {name: {"id": f"id-{name}", "name": name} for name in names}
+        self.stale = False
+
+
+def test_unique_filenames_do_not_collide():
+    filenames = bulk.unique_filenames(["a b", "a/b", "a_b", "A_B"])
+    assert filenames == {"a b": "a_b", "a/b": "a_b_2", "a_b": "a_b_3", "A_B": "A_B_4"}
+
+
+def test_provision_clients_keeps_every_config(monkeypatch):
+    """Имена, дающие один safe_filename, не затирают друг друга в ZIP."""
+    names = ["a b", "a/b", "a_b"]
+    created = set()
+
+    async def get_client_directory(base_url, password, fresh=False):
+        return _Directory(created)
+
+    async def create_clients_api(client_names, base_url, password, concurrency):
+        created.update(client_names)
+        return {name: None for name in client_names}
+
+    async def get_config_and_qr_by_id(client_id, base_url, password):
+        return f"[Interface]\n# {client_id}\n", b"PNG" + client_id.encode(), None
+
+    async def run_db(func, *args):
+        return True
+
+    async def invalidate_client_artifacts(db_path, name):
+        pass
+
+    monkeypatch.setattr(bulk, "get_client_directory", get_client_directory)
+    monkeypatch.setattr(bulk, "create_clients_api", create_clients_api)
+    monkeypatch.setattr(bulk, "get_config_and_qr_by_id", get_config_and_qr_by_id)
+    monkeypatch.setattr(bulk, "run_db", run_db)
+    monkeypatch.setattr(bulk, "invalidate_client_artifacts", invalidate_client_artifacts)
+
+    rows = [(name, "2030-01-01T23:59:59.999999") for name in names]
+    archive, report = asyncio.run(bulk.provision_clients(rows, "unused.db", "http://wg", "pw"))
+
+    assert [result for _, _, result in report] == ["OK"] * 3
+    with zipfile.ZipFile(io.BytesIO(archive)) as zf:
+        entries = zf.namelist()
+        assert len(entries) == len(set(entries))
+        report_rows = list(csv.DictReader(io.StringIO(zf.read("report.csv").decode())))
+        configs = {row["name"]: row["config"] for row in report_rows}
+        assert len(set(configs.values())) == 3
+        for name, config_file in configs.items():
+            assert f"# id-{name}" in zf.read(config_file).decode()
@@ -0,0 +1,83 @@
+import os
+import logging
+import secrets
+import importlib.util
+
+from telegram import Update
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, InlineQueryHandler, MessageHandler, TypeHandler
+
+# === ПОЛУЧЕНИЕ АПДЕЙТОВ ===
+# BOT_MODE=webhook: Telegram сам присылает апдейты на WEBHOOK_URL, бот слушает
+# локальный порт WEBHOOK_LISTEN:WEBHOOK_PORT (обычно за nginx/caddy с TLS).
+# Апдейт приходит сразу, без цикла getUpdates. Запросы без заголовка
+# X-Telegram-Bot-Api-Secret-Token = WEBHOOK_SECRET отклоняются; без
+# WEBHOOK_SECRET секрет генерируется заново при каждом запуске.
+# WEBHOOK_PATH - путь на локальном сервере и в публичном URL (для location в прокси).
+#
+# BOT_MODE=polling (по умолчанию) - long polling. В него же бот откатывается,
+# если WEBHOOK_URL не задан или не установлен python-telegram-bot[webhooks].
+#
+# В обоих режимах Telegram присылает только те типы апдейтов, которые есть у
+# зарегистрированных обработчиков (allowed_updates), а не Update.ALL_TYPES.
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram").strip().strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+
+# Тип обработчика -> типы апдейтов, которые он может обработать
+HANDLER_UPDATE_TYPES = {
+    CommandHandler: (Update.MESSAGE,),
+    MessageHandler: (Update.MESSAGE,),
+    CallbackQueryHandler: (Update.CALLBACK_QUERY,),
+    InlineQueryHandler: (Update.INLINE_QUERY,),
+    TypeHandler: (),  # служебные (профиль запуска) - видят то, что пришло для остальных
+}
+
+
+def allowed_update_types(app: Application) -> list[str]:
+    """Типы апдейтов, нужные зарегистрированным обработчикам app."""
+    types = set()
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            for handler_type, update_types in HANDLER_UPDATE_TYPES.items():
+                if isinstance(handler, handler_type):
+                    types.update(update_types)
+                    break
+            else:
+                # Неизвестный обработчик - лучше получать лишнее, чем терять апдейты
+                logging.warning(f"Тип апдейтов для {type(handler).__name__} неизвестен, подписка на все типы.")
+                return Update.ALL_TYPES
+    return sorted(types)
+
+
+def _webhook_available() -> bool:
+    if BOT_MODE != "webhook":
+        return False
+    if not WEBHOOK_URL:
+        logging.warning("BOT_MODE=webhook, но WEBHOOK_URL не задан - используется long polling.")
+        return False
+    if importlib.util.find_spec("tornado") is None:
+        logging.warning("Для webhook нужен python-telegram-bot[webhooks] - используется long polling.")
+        return False
+    return True
+
+
+def run(app: Application) -> None:
+    """Запускает получение апдейтов: webhook, если он настроен, иначе long polling."""
+    allowed_updates = allowed_update_types(app)
+    if not _webhook_available():
+        logging.info(f"Режим: long polling, апдейты: {', '.join(allowed_updates)}")
+        app.run_polling(allowed_updates=allowed_updates)
+        return
+    logging.info(f"Режим: webhook {WEBHOOK_URL}/{WEBHOOK_PATH} (слушаю {WEBHOOK_LISTEN}:{WEBHOOK_PORT}), апдейты: {', '.join(allowed_updates)}")
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+        allowed_updates=allowed_updates,
+    )
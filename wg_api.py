@@ -0,0 +1,530 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import httpx
+
+from qr_render import local_rendering_enabled, render_qr_png, svg_to_png
+from metrics import observe, inc, cache_result
+from health import get_breaker, server_state, request_timeout, remaining, retry_delay, DeadlineExceeded, GET_RETRIES, OPEN
+
+# === АСИНХРОННЫЙ КЛИЕНТ API wg-easy ===
+# Один httpx.AsyncClient на сервер: общий пул соединений с keep-alive и общая
+# cookie-сессия, которая переиспользуется между запросами. Все функции -
+# корутины, обработчики бота их просто await-ят, поэтому медленный сервер
+# не блокирует обработку остальных апдейтов.
+
+REQUEST_TIMEOUT = 10.0
+CREATE_TIMEOUT = 15.0
+MAX_CONNECTIONS_PER_SERVER = 10
+MAX_KEEPALIVE_PER_SERVER = 5
+KEEPALIVE_EXPIRY = 30.0
+
+_http_clients: dict[str, httpx.AsyncClient] = {}
+_ssl_context = None  # общий для всех пулов: сборка SSL-контекста (сертификаты certifi) стоит десятки мс
+
+
+def _get_http_client(base_url: str) -> httpx.AsyncClient:
+    """Возвращает (создает при первом обращении) пул соединений для сервера."""
+    client = _http_clients.get(base_url)
+    if client is None or client.is_closed:
+        global _ssl_context
+        if _ssl_context is None:
+            _ssl_context = httpx.create_ssl_context()
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            verify=_ssl_context,
+            timeout=REQUEST_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS_PER_SERVER,
+                max_keepalive_connections=MAX_KEEPALIVE_PER_SERVER,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        )
+        _http_clients[base_url] = client
+    return client
+
+
+async def close_api_clients(*_args) -> None:
+    """Закрывает все пулы соединений (вызывается при остановке бота)."""
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    for refresh in _refreshes.values():
+        refresh.cancel()
+    _refreshes.clear()
+    await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+
+async def close_api_client(base_url: str) -> None:
+    """Забывает сервер: закрывает его пул, сессию и кэш списка клиентов (сервер удален или изменен)."""
+    client = _http_clients.pop(base_url, None)
+    _sessions.pop(base_url, None)
+    _directories.pop(base_url, None)
+    _versions.pop(base_url, None)
+    refresh = _refreshes.pop(base_url, None)
+    if refresh is not None:
+        refresh.cancel()
+    if client is not None:
+        await client.aclose()
+
+
+class SessionError(httpx.HTTPError):
+    """Не удалось авторизоваться на сервере wg-easy."""
+
+
+class ClientExistsError(str):
+    """Текст ошибки "клиент уже есть на сервере" (409): вызывающий узнает ее по типу, а не по тексту."""
+
+
+# === КЭШ СЕССИЙ ===
+# Cookie сессии живет в пуле сервера; здесь только помним, когда и с каким
+# паролем логинились. Повторный логин - по истечении SESSION_TTL, при смене
+# пароля или если сервер ответил 401/403.
+SESSION_TTL = float(os.getenv("API_SESSION_TTL", "3600"))
+
+_sessions: dict[str, tuple[str, float]] = {}  # base_url -> (пароль, время логина)
+_session_locks: dict[str, asyncio.Lock] = {}
+
+
+async def create_session(base_url: str, password: str) -> bool:
+    """Логинится на сервере. Cookie сессии сохраняется в пуле этого сервера."""
+    try:
+        response = await _send("POST", base_url, "/api/session", json={"password": password})
+        response.raise_for_status()
+        _sessions[base_url] = (password, time.monotonic())
+        return True
+    except httpx.HTTPError as e:
+        _sessions.pop(base_url, None)
+        logging.error(f"Ошибка сессии {base_url}: {e}")
+        return False
+
+
+def _session_is_valid(base_url: str, password: str) -> bool:
+    session = _sessions.get(base_url)
+    return session is not None and session[0] == password and time.monotonic() - session[1] < SESSION_TTL
+
+
+async def ensure_session(base_url: str, password: str) -> bool:
+    """Возвращает True, если есть действующая сессия (из кэша или после логина)."""
+    if _session_is_valid(base_url, password):
+        cache_result("session", "hit")
+        return True
+    lock = _session_locks.setdefault(base_url, asyncio.Lock())
+    async with lock:
+        # Пока ждали блокировку, другой обработчик мог уже залогиниться
+        if _session_is_valid(base_url, password):
+            cache_result("session", "hit")
+            return True
+        cache_result("session", "miss")
+        return await create_session(base_url, password)
+
+
+def _endpoint(path: str) -> str:
+    """Путь без id клиента - метка эндпоинта для метрик."""
+    return re.sub(r"/client/[^/]+", "/client/{id}", path)
+
+
+def _record(method: str, base_url: str, path: str, started: float, outcome: str) -> None:
+    labels = {"server": base_url, "method": method, "endpoint": _endpoint(path)}
+    observe("wg_api_request_duration_seconds", time.perf_counter() - started, **labels)
+    inc("wg_api_requests_total", outcome=outcome, **labels)
+
+
+async def _send(method: str, base_url: str, path: str, timeout: float = REQUEST_TIMEOUT, **kwargs) -> httpx.Response:
+    """
+    Один HTTP-запрос с учетом breaker сервера и дедлайна действия. Сетевые
+    ошибки, таймауты и 5xx считаются отказами сервера; таймаут, урезанный
+    дедлайном, - нет (это DeadlineExceeded).
+    """
+    started = time.perf_counter()
+    try:
+        effective_timeout = request_timeout(timeout)
+    except DeadlineExceeded:
+        _record(method, base_url, path, started, "deadline")
+        raise
+    limited_by_deadline = effective_timeout < timeout
+    breaker = get_breaker(base_url)
+    try:
+        breaker.before_request()
+    except httpx.HTTPError:
+        _record(method, base_url, path, started, "circuit_open")
+        raise
+    try:
+        response = await asyncio.wait_for(
+            _get_http_client(base_url).request(method, path, timeout=effective_timeout, **kwargs), effective_timeout
+        )
+    except (asyncio.TimeoutError, httpx.TimeoutException) as e:
+        if limited_by_deadline:
+            breaker.release_probe()
+            _record(method, base_url, path, started, "deadline")
+            raise DeadlineExceeded() from e
+        breaker.record_failure()
+        _record(method, base_url, path, started, "timeout")
+        raise e if isinstance(e, httpx.TimeoutException) else httpx.ReadTimeout(f"Таймаут {effective_timeout:g} с") from e
+    except httpx.TransportError:
+        breaker.record_failure()
+        _record(method, base_url, path, started, "error")
+        raise
+    except BaseException:
+        breaker.release_probe()
+        raise
+    if response.status_code >= 500: breaker.record_failure()
+    else: breaker.record_success()
+    _record(method, base_url, path, started, f"{response.status_code // 100}xx")
+    return response
+
+
+async def _authorized_request(method: str, base_url: str, password: str, path: str, **kwargs) -> httpx.Response:
+    """Запрос с кэшированной сессией. При 401/403 - один повтор после нового логина."""
+    if not await ensure_session(base_url, password):
+        raise SessionError(f"Не удалось авторизоваться на {base_url}")
+    response = await _send(method, base_url, path, **kwargs)
+    if response.status_code in (401, 403):
+        logging.info(f"Сессия {base_url} истекла ({response.status_code}), повторный логин.")
+        cache_result("session", "reauth")
+        _sessions.pop(base_url, None)
+        if not await ensure_session(base_url, password):
+            raise SessionError(f"Не удалось авторизоваться на {base_url}")
+        response = await _send(method, base_url, path, **kwargs)
+    return response
+
+
+async def _api_request(method: str, base_url: str, password: str, path: str, **kwargs) -> httpx.Response:
+    """
+    Запрос к API. GET (идемпотентный) при сетевой ошибке или 5xx повторяется до
+    GET_RETRIES раз с джиттером, пока есть бюджет повторов и время до дедлайна.
+    """
+    retries = GET_RETRIES if method == "GET" else 0
+    attempt = 0
+    while True:
+        error, response = None, None
+        try:
+            response = await _authorized_request(method, base_url, password, path, **kwargs)
+        except DeadlineExceeded:
+            raise
+        except httpx.TransportError as e:
+            error = e
+        if error is None and response.status_code < 500:
+            return response
+        delay = retry_delay(attempt + 1)
+        left = remaining()
+        if attempt >= retries or (left is not None and delay >= left) or not get_breaker(base_url).take_retry():
+            if error is not None: raise error
+            return response
+        attempt += 1
+        reason = repr(error) if error is not None else f"HTTP {response.status_code}"
+        logging.info(f"Повтор {method} {path} на {base_url} ({attempt}/{retries}) через {delay:.2f} с: {reason}")
+        await asyncio.sleep(delay)
+
+
+async def get_api_clients(base_url: str, password: str):
+    try:
+        response = await _api_request("GET", base_url, password, "/api/wireguard/client")
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError as e:
+        logging.error(f"Ошибка get_clients {base_url}: {e}")
+        return None
+    except ValueError as e:
+        logging.error(f"Ошибка JSON {base_url}: {e}")
+        return None
+
+
+async def get_api_client_configuration(client_id, base_url: str, password: str):
+    try:
+        response = await _api_request("GET", base_url, password, f"/api/wireguard/client/{client_id}/configuration")
+        response.raise_for_status()
+        return response.text
+    except httpx.HTTPError as e:
+        logging.error(f"Ошибка конфига {client_id} с {base_url}: {e}")
+        return None
+
+
+async def get_api_qr_code_svg(client_id, base_url: str, password: str):
+    try:
+        response = await _api_request("GET", base_url, password, f"/api/wireguard/client/{client_id}/qrcode.svg")
+        response.raise_for_status()
+        return response.content
+    except httpx.HTTPError as e:
+        logging.error(f"Ошибка QR SVG {client_id} с {base_url}: {e}")
+        return None
+
+
+async def get_api_qr_png(client_id, base_url: str, password: str):
+    """QR-код клиента в PNG: (png или None, текст ошибки или None)."""
+    qr_svg = await get_api_qr_code_svg(client_id, base_url, password)
+    if not qr_svg: return None, "Ошибка получения QR SVG."
+    try: return await svg_to_png(qr_svg), None
+    except Exception as e: logging.error(f"Ошибка SVG->PNG {client_id}: {e}"); return None, "Ошибка QR SVG->PNG."
+
+
+async def get_client_qr_png(client_id, config: str | None, base_url: str, password: str):
+    """
+    QR-код клиента в PNG: (png или None, ошибка или None). Если включен локальный
+    рендер и конфиг уже скачан - строится из него без запроса к API, иначе (или
+    при ошибке рендера) - через qrcode.svg.
+    """
+    if config and local_rendering_enabled():
+        try: return await render_qr_png(config), None
+        except Exception as e: logging.error(f"Ошибка локального рендера QR {client_id}: {e!r}, пробуем API.")
+    return await get_api_qr_png(client_id, base_url, password)
+
+
+async def get_config_and_qr_by_id(client_id, base_url: str, password: str):
+    """(config, qr_png, qr_error). При локальном рендере QR строится из конфига, иначе оба запроса идут параллельно."""
+    if local_rendering_enabled():
+        config = await get_api_client_configuration(client_id, base_url, password)
+        qr_png, qr_error = await get_client_qr_png(client_id, config, base_url, password)
+        return config, qr_png, qr_error
+    config, (qr_png, qr_error) = await asyncio.gather(
+        get_api_client_configuration(client_id, base_url, password),
+        get_api_qr_png(client_id, base_url, password),
+    )
+    return config, qr_png, qr_error
+
+
+# === КЭШ СПИСКА КЛИЕНТОВ ===
+# Полный список /api/wireguard/client скачивается не чаще раза в DIRECTORY_TTL
+# секунд на сервер и индексируется по имени и id. Наши create/delete/toggle
+# сбрасывают кэш: увеличивают версию сервера, а снимок помнит версию на момент
+# начала загрузки. Поэтому список, который начали качать до create/delete/toggle,
+# не считается свежим после них, и следующий запрос ждет новый список.
+# Когда просто истек TTL (наших изменений не было), вызывающий сразу получает
+# прошлый снимок, а список обновляется фоновой задачей (stale-while-revalidate),
+# но только пока снимку меньше DIRECTORY_MAX_STALE: более старый (например, у
+# редких периодических задач) ждет загрузки. fresh=True - всегда ждать новый
+# список; так делают задачи, которые по списку что-то меняют или считают
+# (сверка, телеметрия, отключение истекших, массовое создание, экспорт).
+# Если API недоступен, отдается копия последнего снимка с флагом stale - сами
+# снимки после создания не меняются.
+DIRECTORY_TTL = float(os.getenv("API_DIRECTORY_TTL", "30"))
+DIRECTORY_MAX_STALE = 2 * DIRECTORY_TTL
+
+
+class ClientDirectory:
+    """Снимок списка клиентов сервера с индексами по имени и id."""
+    __slots__ = ("clients", "by_name", "by_id", "fetched_at", "stale", "version")
+
+    def __init__(self, clients: list, fetched_at: float, version: int = 0):
+        self.clients = clients
+        self.by_name = {c["name"]: c for c in clients}
+        self.by_id = {c["id"]: c for c in clients}
+        self.fetched_at = fetched_at
+        self.stale = False
+        self.version = version
+
+    def stale_copy(self) -> "ClientDirectory":
+        """Тот же снимок с флагом stale (списки и индексы общие)."""
+        copy = ClientDirectory.__new__(ClientDirectory)
+        for slot in self.__slots__:
+            setattr(copy, slot, getattr(self, slot))
+        copy.stale = True
+        return copy
+
+
+_directories: dict[str, ClientDirectory] = {}
+_directory_locks: dict[str, asyncio.Lock] = {}
+_versions: dict[str, int] = {}
+_refreshes: dict[str, asyncio.Task] = {}
+
+
+def invalidate_client_directory(base_url: str) -> None:
+    """Помечает кэш сервера устаревшим (данные остаются как запасные на случай недоступности API)."""
+    _versions[base_url] = _versions.get(base_url, 0) + 1
+
+
+def _directory_is_fresh(base_url: str) -> bool:
+    directory = _directories.get(base_url)
+    return (directory is not None and directory.version == _versions.get(base_url, 0)
+            and time.monotonic() - directory.fetched_at < DIRECTORY_TTL)
+
+
+async def _load_directory(base_url: str, password: str) -> ClientDirectory | None:
+    lock = _directory_locks.setdefault(base_url, asyncio.Lock())
+    async with lock:
+        # Параллельные запросы ждут одну загрузку вместо того, чтобы качать список каждый сам
+        if _directory_is_fresh(base_url):
+            cache_result("client_directory", "hit")
+            return _directories[base_url]
+        version = _versions.get(base_url, 0)
+        api_clients = await get_api_clients(base_url, password)
+        cache_result("client_directory", "miss" if api_clients is not None else ("stale" if base_url in _directories else "error"))
+        if api_clients is not None:
+            directory = ClientDirectory(api_clients, time.monotonic(), version)
+            _directories[base_url] = directory
+            return directory
+        directory = _directories.get(base_url)
+        if directory is None:
+            return None
+        logging.warning(f"API {base_url} недоступен, используется кэш списка клиентов от {time.monotonic() - directory.fetched_at:.0f} с. назад.")
+        if not directory.stale:
+            directory = _directories[base_url] = directory.stale_copy()
+        return directory
+
+
+async def _refresh_directory(base_url: str, password: str) -> None:
+    try:
+        await _load_directory(base_url, password)
+    except Exception as e:
+        logging.error(f"Ошибка фонового обновления списка клиентов {base_url}: {e!r}")
+    finally:
+        if _refreshes.get(base_url) is asyncio.current_task():
+            _refreshes.pop(base_url)
+
+
+async def get_client_directory(base_url: str, password: str, fresh: bool = False) -> ClientDirectory | None:
+    """
+    Возвращает список клиентов сервера из кэша или с API.
+    Если истек только TTL (снимку меньше DIRECTORY_MAX_STALE), сразу отдает
+    прошлый снимок и обновляет его в фоне (fresh=True - ждать новый список).
+    При ошибке API возвращает копию прошлого снимка с stale=True, а если его нет - None.
+    """
+    if _directory_is_fresh(base_url):
+        cache_result("client_directory", "hit")
+        return _directories[base_url]
+    directory = _directories.get(base_url)
+    if (not fresh and directory is not None and not directory.stale
+            and directory.version == _versions.get(base_url, 0)
+            and time.monotonic() - directory.fetched_at < DIRECTORY_MAX_STALE):
+        cache_result("client_directory", "revalidate")
+        if base_url not in _refreshes:
+            _refreshes[base_url] = asyncio.create_task(_refresh_directory(base_url, password))
+        return directory
+    return await _load_directory(base_url, password)
+
+
+async def find_client(client_name: str, base_url: str, password: str):
+    """Возвращает (данные клиента, снимок списка). Снимок None - список не получен."""
+    directory = await get_client_directory(base_url, password)
+    if directory is None: return None, None
+    return directory.by_name.get(client_name), directory
+
+
+async def _precheck(base_url: str, password: str) -> str | None:
+    """Ошибка для пользователя, если сервер заведомо недоступен или не удалось залогиниться, иначе None."""
+    if server_state(base_url) == OPEN:
+        return "Сервер временно недоступен, попробуйте позже."
+    if not await ensure_session(base_url, password):
+        return "Сервер временно недоступен, попробуйте позже." if server_state(base_url) == OPEN else "Не удалось создать сессию."
+    return None
+
+
+async def create_client_api(client_name: str, base_url: str, password: str):
+    if error := await _precheck(base_url, password): return None, None, error
+    try:
+        response = await _api_request("POST", base_url, password, "/api/wireguard/client", json={"name": client_name}, timeout=CREATE_TIMEOUT)
+        if response.status_code == 409: return None, None, ClientExistsError(f"Клиент '{client_name}' уже есть на сервере.")
+        response.raise_for_status()
+    except httpx.HTTPError as e: logging.error(f"Ошибка API создания {client_name}: {e}"); return None, None, f"Ошибка API создания '{client_name}'."
+    finally: invalidate_client_directory(base_url)
+    client_data, directory = await find_client(client_name, base_url, password)
+    if directory is None or directory.stale: return None, None, "Клиент создан (API), но ошибка получения данных."
+    if not client_data: return None, None, "Клиент создан (API), но не найден в списке."
+    client_id = client_data["id"]
+    config, qr_png, _ = await get_config_and_qr_by_id(client_id, base_url, password)
+    error = None
+    if config is None and qr_png is None: error = "Клиент создан (API), но ошибка получения конфига/QR."
+    return config, qr_png, error
+
+
+async def delete_client_api(client_name: str, base_url: str, password: str):
+    if error := await _precheck(base_url, password): return False, error
+    client_data, directory = await find_client(client_name, base_url, password)
+    if directory is None: logging.warning(f"Нет списка клиентов {base_url} перед удалением {client_name}.")
+    if client_data:
+        client_id = client_data["id"]
+        try:
+            response = await _api_request("DELETE", base_url, password, f"/api/wireguard/client/{client_id}")
+            response.raise_for_status(); logging.info(f"Клиент '{client_name}' удален с API {base_url}.")
+            return True, None
+        except httpx.HTTPError as e:
+            logging.error(f"Ошибка API удаления {client_name}: {e}")
+            return False, f"Ошибка API при удалении '{client_name}'."
+        finally:
+            invalidate_client_directory(base_url)
+    else:
+        logging.info(f"Клиент '{client_name}' не найден на API {base_url}.")
+        return True, None
+
+
+async def toggle_client_status_api(client_name: str, enable: bool, base_url: str, password: str):
+    if error := await _precheck(base_url, password): return False, error
+    client_data, directory = await find_client(client_name, base_url, password)
+    if directory is None: return False, "Не удалось получить список клиентов."
+    if not client_data: return False, f"Клиент '{client_name}' не найден на сервере."
+    client_id = client_data["id"]; action = "enable" if enable else "disable"
+    try:
+        response = await _api_request("POST", base_url, password, f"/api/wireguard/client/{client_id}/{action}")
+        response.raise_for_status()
+        return True, f"Статус клиента '{client_name}' изменен на API ✅"
+    except httpx.HTTPError as e:
+        logging.error(f"Ошибка API {action} {client_name}: {e}")
+        return False, f"Ошибка API при изменении статуса '{client_name}'."
+    finally:
+        invalidate_client_directory(base_url)
+
+
+async def set_clients_enabled(client_names: list, enable: bool, base_url: str, password: str, concurrency: int = 5) -> dict:
+    """
+    Включает/выключает сразу много клиентов: одно чтение списка, затем не более
+    concurrency параллельных запросов к серверу. Клиенты, которых нет на API или
+    которые уже в нужном состоянии, не трогаются.
+    Возвращает {имя: None при успехе или текст ошибки}.
+    """
+    if error := await _precheck(base_url, password):
+        return {name: error for name in client_names}
+    # Решение "уже в нужном состоянии" - только по свежему списку
+    directory = await get_client_directory(base_url, password, fresh=True)
+    if directory is None or directory.stale:
+        return {name: "Не удалось получить список клиентов." for name in client_names}
+    action = "enable" if enable else "disable"
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _toggle(name: str):
+        client_data = directory.by_name.get(name)
+        if client_data is None:
+            logging.info(f"Клиент '{name}' не найден на API {base_url}, {action} пропущен.")
+            return name, None
+        if client_data.get("enabled", True) == enable:
+            return name, None
+        async with semaphore:
+            try:
+                response = await _api_request("POST", base_url, password, f"/api/wireguard/client/{client_data['id']}/{action}")
+                response.raise_for_status()
+                return name, None
+            except httpx.HTTPError as e:
+                logging.error(f"Ошибка API {action} {name}: {e}")
+                return name, f"Ошибка API при изменении статуса '{name}'."
+
+    try:
+        return dict(await asyncio.gather(*(_toggle(name) for name in client_names)))
+    finally:
+        invalidate_client_directory(base_url)
+
+
+async def create_clients_api(client_names: list, base_url: str, password: str, concurrency: int = 5) -> dict:
+    """
+    Создает много клиентов на сервере (не более concurrency запросов одновременно).
+    Только POST-запросы: id, конфиги и QR потом берутся одним чтением списка.
+    Возвращает {имя: None при успехе или текст ошибки}.
+    """
+    if error := await _precheck(base_url, password):
+        return {name: error for name in client_names}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _create(name: str):
+        async with semaphore:
+            try:
+                response = await _api_request("POST", base_url, password, "/api/wireguard/client", json={"name": name}, timeout=CREATE_TIMEOUT)
+                if response.status_code == 409: return name, ClientExistsError(f"Клиент '{name}' уже есть на сервере.")
+                response.raise_for_status()
+                return name, None
+            except httpx.HTTPError as e:
+                logging.error(f"Ошибка API создания {name}: {e}")
+                return name, f"Ошибка API создания '{name}'."
+
+    try:
+        return dict(await asyncio.gather(*(_create(name) for name in client_names)))
+    finally:
+        invalidate_client_directory(base_url)